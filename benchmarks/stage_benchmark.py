@@ -0,0 +1,331 @@
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from glob import glob
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, "src")
+SAMPLE_DIR = os.path.join(REPO_ROOT, "test_wav", "samples_for_test")
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# Each run's results go outside the source tree, only the baseline is kept in it
+RESULTS_FILE = os.path.join(tempfile.gettempdir(), "zwazam_stage_results.json")
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "stage_baseline.json")
+sys.path.insert(0, SRC_DIR)
+
+from scipy.io import wavfile
+from process_audio import ProcessAudio, DEFAULT_SAMPLE_RATE
+from storage import open_storage
+from wav_fingerprint import WavFingerprint
+from zwazam_settings import MIN_FINGER_PRINT_WAV, RARITY_ORDERED_MATCHING, TOP_K_MATCHES
+
+STAGES = ['wav_load', 'spectrogram', 'peak_detection', 'pairing', 'hashing', 'index_insert', 'match']
+# A stage is flagged when its share of the run is this much larger than in the baseline
+REGRESSION_TOLERANCE = 0.25
+# and it takes at least this many seconds longer than that share of this run would give,
+# so timer noise on tiny stages is not flagged
+REGRESSION_MIN_SECONDS = 0.005
+# The catalogue is processed this many times and the fastest time of each stage kept
+REPEATS = 3
+QUERY_SECONDS = 5.
+SEED = 20190601
+
+
+def make_synthetic_track(seed, seconds, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    Deterministic stand-in for a song: a few steady tones, a few chirps sweeping between
+    random frequencies, two voices of short decaying notes with harmonics and a bed of
+    noise, all chosen from seed.
+    Return:
+    int16 array of samples
+    """
+    rng = np.random.RandomState(seed)
+    time_axis = np.arange(int(seconds * sample_rate)) / float(sample_rate)
+    signal = np.zeros_like(time_axis)
+    for _ in range(3):
+        signal += rng.uniform(0.2, 1.) * np.sin(2 * np.pi * rng.uniform(80, 4000) * time_axis)
+    for _ in range(2):
+        start_frequency, end_frequency = rng.uniform(200, 8000, size=2)
+        sweep = start_frequency + (end_frequency - start_frequency) * time_axis / max(seconds, 1e-9)
+        signal += rng.uniform(0.2, 0.8) * np.sin(2 * np.pi * np.cumsum(sweep) / sample_rate)
+    note_length = int(0.25 * sample_rate)
+    note_time = time_axis[:note_length]
+    envelope = np.exp(-note_time * 8.)
+    for voice in range(2):
+        for note_start in range(0, len(time_axis) - note_length, note_length):
+            if rng.rand() < 0.8:
+                fundamental = rng.uniform(100, 2000)
+                for harmonic in range(1, 4):
+                    signal[note_start:note_start + note_length] += (rng.uniform(1., 3.) / harmonic * envelope *
+                                                                    np.sin(2 * np.pi * fundamental * harmonic *
+                                                                           note_time))
+    signal += rng.normal(0, 0.05, size=len(signal))
+    signal /= np.abs(signal).max() or 1.
+    return (signal * 30000).astype(np.int16)
+
+
+def build_catalogue(work_dir, number_of_tracks, seconds):
+    """
+    Writes the synthetic tracks as WAV files next to copies of the sample clips.
+    Return:
+    list of WAV paths
+    """
+    paths = []
+    for track_number in range(number_of_tracks):
+        path = os.path.join(work_dir, "synthetic_{:03d}.wav".format(track_number))
+        wavfile.write(path, DEFAULT_SAMPLE_RATE, make_synthetic_track(SEED + track_number, seconds))
+        paths.append(path)
+    for sample in sorted(glob(os.path.join(SAMPLE_DIR, "*.wav"))):
+        path = os.path.join(work_dir, os.path.basename(sample))
+        shutil.copy(sample, path)
+        paths.append(path)
+    return paths
+
+
+def read_left_channel(path):
+    sample_rate, samples = wavfile.read(path)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    return sample_rate, samples
+
+
+def time_catalogue(paths, storage_url):
+    """
+    Runs every track through each stage separately, then matches a clip from the middle
+    of every track against the stored catalogue the way match_wav.py and the API do: by
+    time alignment, looked up rarest hash first when RARITY_ORDERED_MATCHING is on. The
+    hash frequencies that lookup orders by are collected as part of index_insert.
+    Return:
+    (dict of stage -> seconds, dict of counts)
+    """
+    seconds = dict.fromkeys(STAGES, 0.)
+    counts = {'tracks': 0, 'seconds_of_audio': 0., 'peaks': 0, 'pairs': 0, 'hashes': 0}
+    queries = []
+    storage = open_storage(storage_url)
+    with storage.bulk_writer(tracks_per_commit=1) as writer:
+        for path in paths:
+            start = time.perf_counter()
+            sample_rate, samples = read_left_channel(path)
+            seconds['wav_load'] += time.perf_counter() - start
+
+            fingerprinter = ProcessAudio(min_peak_amplitude=MIN_FINGER_PRINT_WAV, sample_rate=sample_rate)
+            start = time.perf_counter()
+            spectrogram = fingerprinter.make_spectrogram(samples)
+            seconds['spectrogram'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            peak_locations, _ = fingerprinter.find_peaks(spectrogram)
+            seconds['peak_detection'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            anchors, partners = fingerprinter.find_partner_indices(peak_locations)
+            seconds['pairing'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            hashes = fingerprinter.create_hashes_vectorized(peak_locations, anchors, partners)
+            seconds['hashing'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            writer.add_track(os.path.basename(path), hashes, peak_locations[anchors, 1])
+            seconds['index_insert'] += time.perf_counter() - start
+
+            counts['tracks'] += 1
+            counts['seconds_of_audio'] += len(samples) / float(sample_rate)
+            counts['peaks'] += len(peak_locations)
+            counts['pairs'] += len(anchors)
+            counts['hashes'] += len(hashes)
+
+            query_length = int(QUERY_SECONDS * sample_rate)
+            query_start = max((len(samples) - query_length) // 2, 0)
+            query = ProcessAudio(min_peak_amplitude=MIN_FINGER_PRINT_WAV, sample_rate=sample_rate)
+            query.process_track(samples[query_start:query_start + query_length])
+            queries.append((os.path.basename(path), query.hashes, query.offsets))
+    start = time.perf_counter()
+    storage.collect_document_frequencies()
+    seconds['index_insert'] += time.perf_counter() - start
+
+    counts['correct_matches'] = 0
+    for track_name, query_hashes, query_offsets in queries:
+        start = time.perf_counter()
+        if RARITY_ORDERED_MATCHING:
+            matches = storage.match_by_rarity(query_hashes, query_offsets, top_k=TOP_K_MATCHES)
+        else:
+            matches = storage.lookup_alignment(query_hashes, query_offsets, top_k=TOP_K_MATCHES)
+        seconds['match'] += time.perf_counter() - start
+        if matches and matches[0][0] == track_name:
+            counts['correct_matches'] += 1
+    storage.close()
+    return seconds, counts
+
+
+def check_equivalence(paths):
+    """
+    Checks that the optimised code paths give the hashes of the reference ones on every
+    track: vectorized against reference pairing, NumPy against matplotlib spectrograms,
+    chunked against whole-file WAV reading.
+    Return:
+    dict of check name -> list of tracks that differed
+    """
+    failures = {'pairing': [], 'spectrogram_engine': [], 'chunked_wav': []}
+    for path in paths:
+        track_name = os.path.basename(path)
+        sample_rate, samples = read_left_channel(path)
+        optimised = ProcessAudio(min_peak_amplitude=MIN_FINGER_PRINT_WAV, sample_rate=sample_rate)
+        optimised.process_track(samples)
+        hashes = np.asarray(optimised.hashes, dtype=np.int64)
+
+        reference = ProcessAudio(min_peak_amplitude=MIN_FINGER_PRINT_WAV, sample_rate=sample_rate,
+                                 pairing_mode='reference')
+        reference.process_track(samples)
+        if not np.array_equal(hashes, np.asarray(reference.hashes, dtype=np.int64)):
+            failures['pairing'].append(track_name)
+
+        matplotlib_engine = ProcessAudio(min_peak_amplitude=MIN_FINGER_PRINT_WAV, sample_rate=sample_rate,
+                                         spectrogram_engine='matplotlib')
+        matplotlib_engine.process_track(samples)
+        if not np.array_equal(hashes, matplotlib_engine.hashes):
+            failures['spectrogram_engine'].append(track_name)
+
+        chunked = WavFingerprint(path, chunked=True, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
+        if not np.array_equal(np.sort(hashes), np.sort(chunked.hashes)):
+            failures['chunked_wav'].append(track_name)
+    return failures
+
+
+def run_benchmark(number_of_tracks=10, seconds=30., check=True):
+    """
+    Builds the catalogue, times every stage REPEATS times and keeps the fastest run.
+    Return:
+    dict of results, as written to RESULTS_FILE
+    """
+    work_dir = tempfile.mkdtemp(prefix="zwazam_stages_")
+    try:
+        paths = build_catalogue(work_dir, number_of_tracks, seconds)
+        best_seconds = None
+        for repeat in range(REPEATS):
+            storage_url = "sqlite:///" + os.path.join(work_dir, "run_{}.db".format(repeat))
+            stage_seconds, counts = time_catalogue(paths, storage_url)
+            if best_seconds is None:
+                best_seconds = stage_seconds
+            else:
+                best_seconds = {stage: min(best_seconds[stage], stage_seconds[stage]) for stage in STAGES}
+        failures = check_equivalence(paths) if check else None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'config': {'synthetic_tracks': number_of_tracks, 'seconds_per_track': seconds,
+                       'sample_tracks': len(paths) - number_of_tracks, 'repeats': REPEATS},
+            'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform()},
+            'stages': best_seconds,
+            'stage_shares': stage_shares(best_seconds),
+            'counts': counts,
+            'equivalence_failures': failures}
+
+
+def stage_shares(stage_seconds):
+    """
+    Return:
+    dict of the part of the whole run each stage took, which unlike the seconds holds from
+    one machine to another
+    """
+    total_seconds = sum(stage_seconds.values())
+    return {stage: seconds / total_seconds if total_seconds else 0. for stage, seconds in stage_seconds.items()}
+
+
+def make_baseline(results):
+    """
+    Return:
+    dict of the catalogue and the stage shares of results, as kept in BASELINE_FILE
+    """
+    return {'config': results['config'], 'machine': results['machine'],
+            'stage_shares': results['stage_shares']}
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Return:
+    list of (stage, baseline share, current share) for every stage whose share of the run
+    grew by more than REGRESSION_TOLERANCE over the baseline
+    """
+    if baseline['config'] != results['config']:
+        print("Baseline was recorded with a different catalogue, not comparing:", baseline['config'])
+        return []
+    total_seconds = sum(results['stages'].values())
+    regressions = []
+    for stage in STAGES:
+        baseline_share = baseline['stage_shares'].get(stage)
+        growth = results['stage_shares'][stage] - (baseline_share or 0.)
+        if (baseline_share and growth > baseline_share * REGRESSION_TOLERANCE
+                and growth * total_seconds > REGRESSION_MIN_SECONDS):
+            regressions.append((stage, baseline_share, results['stage_shares'][stage]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    audio_seconds = results['counts']['seconds_of_audio']
+    print("{} tracks, {:.0f}s of audio, {} peaks, {} hashes, {}/{} clips matched".format(
+        results['counts']['tracks'], audio_seconds, results['counts']['peaks'], results['counts']['hashes'],
+        results['counts']['correct_matches'], results['counts']['tracks']))
+    print("{:<16}{:>12}{:>18}{:>10}{:>12}".format("stage", "seconds", "x real time", "share", "baseline"))
+    for stage in STAGES:
+        stage_seconds = results['stages'][stage]
+        speed = audio_seconds / stage_seconds if stage_seconds else float('inf')
+        baseline_share = baseline['stage_shares'].get(stage) if baseline else None
+        print("{:<16}{:>12.4f}{:>18.0f}{:>10.1%}{:>12}".format(
+            stage, stage_seconds, speed, results['stage_shares'][stage],
+            "-" if baseline_share is None else "{:.1%}".format(baseline_share)))
+    if results['equivalence_failures'] is not None:
+        for check, tracks in results['equivalence_failures'].items():
+            print("{} hashes {}".format(check, "match" if not tracks else "DIFFER on " + ", ".join(tracks)))
+
+
+def print_help_message():
+    print("Usage:")
+    print("python stage_benchmark.py [number_of_synthetic_tracks] [seconds_per_track] [--save-baseline] [--no-check]")
+    print("Times every fingerprinting stage on a synthetic catalogue plus the sample clips, checks that")
+    print("the optimised paths give the reference hashes and writes the results to {}.".format(RESULTS_FILE))
+    print("Stages whose share of the run is more than {:.0%} larger than in stage_baseline.json are".format(
+        REGRESSION_TOLERANCE))
+    print("reported and the exit status is 1. --save-baseline stores this run's shares as the new baseline.")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if "-h" in user_arguments:
+        print_help_message()
+    flags = [argument for argument in user_arguments[1:] if argument.startswith("--")]
+    arguments = [argument for argument in user_arguments[1:] if not argument.startswith("--")]
+    if len(arguments) > 2:
+        raise IndexError("At most a track count and a track length allowed. Use -h for help.")
+    number_of_tracks = int(arguments[0]) if arguments else 10
+    seconds = float(arguments[1]) if len(arguments) > 1 else 30.
+
+    results = run_benchmark(number_of_tracks, seconds, check="--no-check" not in flags)
+    with open(RESULTS_FILE, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    baseline = None
+    if "--save-baseline" in flags:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(make_baseline(results), baseline_file, indent=2)
+        print("Saved baseline to", BASELINE_FILE)
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    failed = bool(results['equivalence_failures'] and any(results['equivalence_failures'].values()))
+    for stage, baseline_share, current_share in compare_to_baseline(results, baseline) if baseline else []:
+        print("SLOWER: {} took {:.1%} of the run, baseline {:.1%}".format(stage, current_share, baseline_share))
+        failed = True
+    exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, "src")
+API_DIR = os.path.join(REPO_ROOT, "flask_api")
+SAMPLE_DIR = os.path.join(REPO_ROOT, "test_wav", "samples_for_test")
+QUERY_WAV = os.path.join(SAMPLE_DIR, "Bust_This_subsection.wav")
+
+# (module, directory it is run from)
+ENTRY_POINTS = [
+    ("match_wav", SRC_DIR),
+    ("match_recording", SRC_DIR),
+    ("fingerprint_directory_of_files", SRC_DIR),
+    ("export_hash_index", SRC_DIR),
+    ("listen_continuous", SRC_DIR),
+    ("zwazam_api", API_DIR),
+]
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+# Time from the first import to the first answer, as a shell pipeline or the first
+# request to a fresh API worker sees it
+FIRST_MATCH_SNIPPETS = {
+    "match_wav": """
+import time
+start = time.perf_counter()
+import match_wav
+match_wav.match_file({query_wav!r}, storage_url={storage_url!r})
+print(time.perf_counter() - start)
+""",
+    "zwazam_api": """
+import time
+start = time.perf_counter()
+import zwazam_api
+with open({query_pcm!r}, 'rb') as pcm_file:
+    body = pcm_file.read()
+response = zwazam_api.app.test_client().post('/match', data=body, headers={{
+    'Content-Type': 'application/octet-stream', 'X-Sample-Rate': '{sample_rate}'}})
+assert response.status_code == 200, response.data
+print(time.perf_counter() - start)
+""",
+}
+
+
+def run_snippet(snippet, directory, environment):
+    """
+    Runs snippet in a fresh interpreter.
+    Return:
+    (seconds the snippet reported, wall seconds of the whole process) or None if it failed
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-W", "ignore", "-c", snippet], cwd=directory, env=environment,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_seconds = time.perf_counter() - start
+    if result.returncode:
+        return None
+    return float(result.stdout.strip().splitlines()[-1]), wall_seconds
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def build_fixture(work_dir):
+    """
+    Fingerprints the sample WAVs into a SQLite database and writes the query clip as raw
+    PCM for the API.
+    Return:
+    (storage_url, path_to_pcm, sample_rate)
+    """
+    sys.path.insert(0, SRC_DIR)
+    from scipy.io import wavfile
+    from storage import open_storage
+    from wav_fingerprint import WavFingerprint
+    from zwazam_settings import MIN_FINGER_PRINT_WAV
+
+    storage_url = "sqlite:///" + os.path.join(work_dir, "zwazam.db")
+    storage = open_storage(storage_url)
+    with storage.bulk_writer() as writer:
+        for wav_file in glob(os.path.join(SAMPLE_DIR, "*.wav")):
+            track = WavFingerprint(wav_file, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
+            writer.add_track(os.path.basename(wav_file), track.hashes, track.offsets, track.track_details())
+    storage.close()
+
+    sample_rate, samples = wavfile.read(QUERY_WAV)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    query_pcm = os.path.join(work_dir, "query.pcm")
+    samples.astype('<i2').tofile(query_pcm)
+    return storage_url, query_pcm, sample_rate
+
+
+def run_benchmark(repeats=5):
+    """
+    Measures every entry point in fresh interpreters, repeats times each.
+    Return:
+    dict of entry point -> {'import': s, 'process': s, 'first_match': s}, medians
+    """
+    work_dir = tempfile.mkdtemp(prefix="zwazam_startup_")
+    try:
+        storage_url, query_pcm, sample_rate = build_fixture(work_dir)
+        # No fingerprint cache, so every first match is a cold start and nothing is written
+        # to the home directory
+        environment = dict(os.environ, ZWAZAM_STORAGE=storage_url, ZWAZAM_CACHE='')
+        results = {}
+
+        interpreter = [run_snippet(IMPORT_SNIPPET.format(module="sys"), SRC_DIR, environment)
+                       for _ in range(repeats)]
+        results["python"] = {"import": 0., "process": median([run[1] for run in interpreter]),
+                             "first_match": None}
+
+        for module, directory in ENTRY_POINTS:
+            imports = [run_snippet(IMPORT_SNIPPET.format(module=module), directory, environment)
+                       for _ in range(repeats)]
+            if None in imports:
+                results[module] = None
+                continue
+            results[module] = {"import": median([run[0] for run in imports]),
+                               "process": median([run[1] for run in imports]),
+                               "first_match": None}
+            if module in FIRST_MATCH_SNIPPETS:
+                snippet = FIRST_MATCH_SNIPPETS[module].format(query_wav=QUERY_WAV, storage_url=storage_url,
+                                                              query_pcm=query_pcm, sample_rate=sample_rate)
+                matches = [run_snippet(snippet, directory, environment) for _ in range(repeats)]
+                if None not in matches:
+                    results[module]["first_match"] = median([run[0] for run in matches])
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_seconds(seconds):
+    return "-" if seconds is None else "{:.3f}".format(seconds)
+
+
+def print_results(results):
+    print("{:<32}{:>10}{:>10}{:>13}".format("entry point", "import", "process", "first match"))
+    for name, timings in results.items():
+        if timings is None:
+            print("{:<32}{:>10}".format(name, "unavailable (import failed)"))
+            continue
+        print("{:<32}{:>10}{:>10}{:>13}".format(name, format_seconds(timings["import"]),
+                                                format_seconds(timings["process"]),
+                                                format_seconds(timings["first_match"])))
+
+
+def print_help_message():
+    print("Usage:")
+    print("python startup_benchmark.py [repeats] [--json]")
+    print("Times importing each entry point, the whole interpreter run and the first match,")
+    print("each in a fresh process, and prints the median of repeats runs (default 5).")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if "-h" in user_arguments:
+        print_help_message()
+    as_json = "--json" in user_arguments
+    arguments = [argument for argument in user_arguments[1:] if argument != "--json"]
+    if len(arguments) > 1:
+        raise IndexError("At most one repeat count allowed. Use -h for help.")
+    results = run_benchmark(int(arguments[0]) if arguments else 5)
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+set -e
+psql -v ON_ERROR_STOP=1 -f ../sql_scripts/add_time_offset_column.sql
+psql -v ON_ERROR_STOP=1 -f ../sql_scripts/create_zwazam_table.sql
+psql -v ON_ERROR_STOP=1 -f ../sql_scripts/migrate_to_tracks_and_postings.sql
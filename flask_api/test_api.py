@@ -1,9 +1,41 @@
+import numpy as np
 import requests
 import sys
+import time
 sys.path.append("../src")
 from wav_fingerprint import WavFingerprint
 
 track = WavFingerprint("../test_wav/samples_for_test/Bust_This_subsection.wav", min_peak_amplitude=50)
+
+# Send the samples as raw PCM bytes, the format travels in the headers.
+# The API only fingerprints the first of the interleaved channels.
+channels = track.raw_data.shape[1] if track.raw_data.ndim > 1 else 1
+response = requests.post('http://127.0.0.1:5000/match',
+                         data=track.raw_data.astype(track.raw_data.dtype.newbyteorder('<')).tobytes(),
+                         headers={'Content-Type': 'application/octet-stream',
+                                  'X-Sample-Rate': str(track.sample_rate),
+                                  'X-Dtype': track.raw_data.dtype.name,
+                                  'X-Channels': str(channels)})
+print(response.json())
+
+# The JSON format still works, but is much slower for the same clip
 response = requests.post('http://127.0.0.1:5000/match',
                          json={'waveform':track.raw_data_left.tolist()})
-print(response.json())
\ No newline at end of file
+print(response.json())
+
+# Silence has nothing to fingerprint, so it is refused with a 400
+silence = np.zeros(track.sample_rate, dtype='<i2')
+response = requests.post('http://127.0.0.1:5000/match',
+                         data=silence.tobytes(),
+                         headers={'Content-Type': 'application/octet-stream',
+                                  'X-Sample-Rate': str(track.sample_rate),
+                                  'X-Dtype': 'int16',
+                                  'X-Channels': '1'})
+print(response.status_code, response.json())
+
+# Queued as a job, the same silence fails the job with the reason
+response = requests.post('http://127.0.0.1:5000/add_track_to_database?async=1',
+                         json={'waveform': silence.tolist(), 'name': 'silence'})
+status_url = 'http://127.0.0.1:5000' + response.json()['status_url']
+time.sleep(1)
+print(requests.get(status_url).json())
@@ -1,33 +1,222 @@
 import flask
 import numpy as np
 import sys
-import psycopg2 as pg
 import os
-from collections import defaultdict
+import tempfile
+import threading
+import time
 sys.path.append("../src")
 from binary_stream_fingerprint import BinaryStreamFingerprint
 from stream_fingerprint import StreamFingerprint
 from wav_fingerprint import WavFingerprint
+from process_audio import DEFAULT_SAMPLE_RATE, index_settings
+from hash_matcher import best_match
+from alignment import alignment_confidence
+from fingerprint_cache import open_fingerprint_cache
+from instrumentation import MetricsRegistry, StageTimings, timed_stage
+from job_queue import (JobQueue, QueueFullError, SilentAudioError, fingerprint_waveform, fingerprint_wav_file,
+                       require_hashes)
+from posting_cache import PostingCache
+from request_coalescer import LookupCoalescer
+from storage import open_storage, StorageBusyError
 from zwazam_settings import *
 from werkzeug.utils import secure_filename
 
 UPLOAD_FOLDER = 'temp_file_storage/'
 ALLOWED_EXTENSIONS = set(['wav'])
+# Sample formats accepted as raw PCM on /match, little endian
+ALLOWED_PCM_DTYPES = set(['uint8', 'int16', 'int32', 'float32', 'float64'])
 
 # Initialize the app
 
 app = flask.Flask("zwazam")
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-base_match_query = "SELECT track, count(hash) FROM zwazam WHERE hash = {} GROUP BY track"
-base_insert_query = "INSERT INTO zwazam(track, hash) VALUES ('{}', {});"
-connection_args = {
-    'host': '', # You'll have to update this to your IP
-    'user': 'zachariahmiller',    # username
-    'dbname': 'zachariahmiller',   # DB that we are connecting to
-}
-connection = pg.connect(**connection_args)
-cursor = connection.cursor()
+storage = None
+storage_lock = threading.Lock()
+# Per worker process; with several workers each one reports its own numbers
+metrics = MetricsRegistry()
+fingerprint_cache = open_fingerprint_cache()
+posting_cache = PostingCache()
+metrics.register_callback("zwazam_posting_cache_hits_total", "Query hashes answered from the posting cache",
+                          lambda: posting_cache.hits, metric_type='counter')
+metrics.register_callback("zwazam_posting_cache_misses_total", "Query hashes looked up in storage",
+                          lambda: posting_cache.misses, metric_type='counter')
+metrics.register_callback("zwazam_posting_cache_entries", "Hashes held in the posting cache",
+                          lambda: len(posting_cache.entries))
+metrics.register_callback("zwazam_posting_cache_bytes", "Estimated memory used by the posting cache",
+                          lambda: posting_cache.bytes_used)
+job_queue = JobQueue()
+metrics.register_callback("zwazam_jobs_pending", "Background jobs queued or running", lambda: job_queue.pending)
+metrics.register_callback("zwazam_jobs_submitted_total", "Background jobs accepted",
+                          lambda: job_queue.submitted, metric_type='counter')
+metrics.register_callback("zwazam_jobs_rejected_total", "Background jobs refused because the queue was full",
+                          lambda: job_queue.rejected, metric_type='counter')
+coalescer = LookupCoalescer() if MATCH_COALESCE_WINDOW_MS > 0 else None
+if coalescer is not None:
+    metrics.register_callback("zwazam_coalescer_batches_total", "Merged storage lookups run",
+                              lambda: coalescer.batches, metric_type='counter')
+    metrics.register_callback("zwazam_coalescer_lookups_total", "Request lookups served by merged lookups",
+                              lambda: coalescer.requests, metric_type='counter')
+    metrics.register_callback("zwazam_coalescer_hashes_requested_total", "Hashes asked for by requests",
+                              lambda: coalescer.hashes_requested, metric_type='counter')
+    metrics.register_callback("zwazam_coalescer_hashes_fetched_total", "Distinct hashes sent to storage",
+                              lambda: coalescer.hashes_fetched, metric_type='counter')
+
+
+def get_storage():
+    """
+    Opens the storage on first use rather than at import, so every worker process of a
+    pre-forking server builds its own connection pool after the fork. Refuses storage
+    whose fingerprints were made with a different peak strategy.
+    """
+    global storage
+    with storage_lock:
+        if storage is None:
+            new_storage = open_storage(STORAGE_URL)
+            new_storage.check_fingerprint_settings(index_settings(PEAK_STRATEGY, hash_version=HASH_VERSION))
+            storage = new_storage
+    return storage
+
+
+def get_storage_session():
+    """
+    Returns the storage session of the current request, borrowing a connection from the
+    pool the first time a request needs one. Requests never share a connection; the
+    session's transaction is committed when the view answers with a status below 400 and
+    rolled back otherwise.
+    """
+    if 'storage_session' not in flask.g:
+        flask.g.storage_session_context = get_storage().session()
+        flask.g.storage_session = flask.g.storage_session_context.__enter__()
+    return flask.g.storage_session
+
+
+@app.before_request
+def start_request_timing():
+    flask.g.request_started = time.perf_counter()
+    flask.g.stage_timings = StageTimings()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in flask.g:
+        metrics.record_request(flask.request.endpoint or 'unknown', response.status_code,
+                               time.perf_counter() - flask.g.request_started, flask.g.stage_timings)
+    return response
+
+
+def debug_requested():
+    """
+    A request asks for its stage breakdown with ?debug=1 or an X-Debug-Stages: 1 header.
+    """
+    value = flask.request.headers.get('X-Debug-Stages', flask.request.args.get('debug', ''))
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def async_requested():
+    """
+    A request is queued as a background job with ?async=1 and run in the request with
+    ?async=0; without either ASYNC_JOBS decides.
+    """
+    value = flask.request.args.get('async')
+    if value is None:
+        return ASYNC_JOBS
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def match_result(ranking, seconds_per_column):
+    """
+    The best track of an alignment ranking, with where in it the clip starts and how
+    clearly it beat the runner-up when time offsets are stored.
+    """
+    result = {"result": best_match(ranking)}
+    if ranking and ranking[0][2] is not None:
+        result["offset_seconds"] = ranking[0][2] * seconds_per_column
+        result["confidence"] = alignment_confidence(ranking)
+    return result
+
+
+def match_response(ranking, seconds_per_column):
+    result = match_result(ranking, seconds_per_column)
+    if debug_requested():
+        result["timings"] = flask.g.stage_timings.as_dict()
+    return flask.jsonify(result)
+
+
+class RequestFailed(Exception):
+    """
+    Thrown into the storage session of a request that did not succeed, to roll it back.
+    """
+    pass
+
+
+def end_storage_session(error=None):
+    """
+    Commits the current request's storage session, or rolls it back when given the error
+    the request failed with, and hands its connection back.
+    """
+    session_context = flask.g.pop('storage_session_context', None)
+    flask.g.pop('storage_session', None)
+    inserted_hashes = flask.g.pop('inserted_hashes', None)
+    if session_context is None:
+        return
+    if error is not None:
+        session_context.__exit__(type(error), error, error.__traceback__)
+        return
+    session_context.__exit__(None, None, None)
+    # Only once the new rows are committed, or a lookup in between could cache the old ones
+    if inserted_hashes is not None:
+        posting_cache.invalidate(inserted_hashes)
+
+
+@app.after_request
+def commit_storage_session(response):
+    if response.status_code < 400:
+        end_storage_session()
+    else:
+        end_storage_session(RequestFailed("Request answered with status {}".format(response.status_code)))
+    return response
+
+
+@app.teardown_request
+def roll_back_storage_session(error):
+    # Left open only when the request raised before or while its response was finished
+    end_storage_session(error or RequestFailed("Request ended without a response"))
+
+
+@app.errorhandler(StorageBusyError)
+def storage_busy(error):
+    response = flask.jsonify({"result": "Server busy, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.errorhandler(QueueFullError)
+def job_queue_full(error):
+    response = flask.jsonify({"result": "Too many jobs waiting, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.errorhandler(SilentAudioError)
+def nothing_to_fingerprint(error):
+    response = flask.jsonify({"result": str(error)})
+    response.status_code = 400
+    return response
+
+
+def job_accepted(job):
+    """
+    The 202 response for a queued job, pointing at where its status can be polled.
+    """
+    status_url = flask.url_for('job_status', job_id=job.id)
+    response = flask.jsonify({"job_id": job.id, "status": job.status, "status_url": status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
 
 
 @app.route("/")
@@ -38,85 +227,195 @@ def api_information():
     a format:
     {
         'waveform': [1,95,83,47... rest, of, wave, form, data]
-    }\n"""
+    }
+    or, much faster, the raw PCM bytes with Content-Type: application/octet-stream and
+    the format in headers (or query parameters of the same name):
+    X-Sample-Rate (sample_rate): samples per second, default 44100
+    X-Dtype (dtype): one of uint8, int16, int32, float32, float64, default int16
+    X-Channels (channels): interleaved channels, only the first is used, default 1
+    Add ?debug=1 to see how long each processing stage took. Latency histograms and
+    counters for every endpoint are served at /metrics in the Prometheus text format.
+    /add_track_to_database and /wav_upload take ?async=1 to queue the work and answer
+    at once with a job id; poll /jobs/<job_id> for its status and result.\n"""
     return output
 
 
+def _pcm_parameter(header, query_parameter, default):
+    return flask.request.headers.get(header, flask.request.args.get(query_parameter, default))
+
+
+def decode_pcm_waveform():
+    """
+    Decodes a raw PCM request body without copying it: np.frombuffer wraps the body
+    bytes and the first channel is taken as a strided view.
+    Return:
+    (waveform, sample_rate)
+    """
+    dtype = str(_pcm_parameter('X-Dtype', 'dtype', 'int16'))
+    if dtype not in ALLOWED_PCM_DTYPES:
+        flask.abort(400, "dtype must be one of {}".format(sorted(ALLOWED_PCM_DTYPES)))
+    try:
+        sample_rate = int(_pcm_parameter('X-Sample-Rate', 'sample_rate', DEFAULT_SAMPLE_RATE))
+        channels = int(_pcm_parameter('X-Channels', 'channels', 1))
+    except ValueError:
+        flask.abort(400, "sample rate and channels must be integers")
+    if sample_rate <= 0 or channels <= 0:
+        flask.abort(400, "sample rate and channels must be positive")
+
+    body = flask.request.get_data(cache=False)
+    sample_dtype = np.dtype(dtype).newbyteorder('<')
+    if len(body) % (sample_dtype.itemsize * channels):
+        flask.abort(400, "body is not a whole number of {} channel {} frames".format(channels, dtype))
+    waveform = np.frombuffer(body, dtype=sample_dtype)[::channels]
+    return waveform, sample_rate
+
+
 @app.route("/match", methods=["POST"])
 def match_provided_track():
 
-    data = flask.request.json
-    waveform = np.array(data["waveform"]).ravel()
+    timings = flask.g.stage_timings
+    with timed_stage(timings, 'decode') as counts:
+        if flask.request.mimetype == 'application/octet-stream':
+            waveform, sample_rate = decode_pcm_waveform()
+        else:
+            data = flask.request.json
+            waveform = np.array(data["waveform"]).ravel()
+            sample_rate = DEFAULT_SAMPLE_RATE
+        counts['samples'] = len(waveform)
     datatype = waveform.dtype
     new_track = None
     if datatype == 'B':
-        new_track = BinaryStreamFingerprint(waveform, min_peak_amplitude=MIN_FINGER_PRINT_MIC)
-    elif datatype == int or datatype == float:
-        new_track = StreamFingerprint(waveform, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
+        new_track = BinaryStreamFingerprint(waveform, min_peak_amplitude=MIN_FINGER_PRINT_MIC,
+                                            sample_rate=sample_rate, peak_strategy=PEAK_STRATEGY,
+                                            hash_version=HASH_VERSION, stage_hook=timings)
+    elif datatype.kind in 'iuf':
+        new_track = StreamFingerprint(waveform, min_peak_amplitude=MIN_FINGER_PRINT_WAV,
+                                      sample_rate=sample_rate, peak_strategy=PEAK_STRATEGY,
+                                      hash_version=HASH_VERSION, stage_hook=timings)
     else:
-        print(api_information)
+        flask.abort(400, api_information())
+    require_hashes(new_track)
 
-    best_match = compare_hashes(new_track.hashes)
+    ranking = compare_hashes(new_track.hashes, new_track.offsets)
+    seconds_per_column = new_track.seconds_per_column()
     del waveform
-    del data
     del new_track
-    return flask.jsonify({"result": best_match})
+    return match_response(ranking, seconds_per_column)
 
 @app.route("/add_track_to_database", methods=["POST"])
 def add_track_to_database():
     data = flask.request.json
-    waveform = np.array(data["waveform"]).reshape(-1,1)
+    waveform = np.array(data["waveform"]).ravel()
     track_name = str(data['name'])
-    new_track = StreamFingerprint(waveform, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
-    if new_track:
-        for hash in set(new_track.hashes):
-            cursor.execute(base_insert_query.format(str(track_name), int(hash)))
-        cursor.execute("commit;")
-    print("{} added to database".format(track_name))
-
-def compare_hashes(hashes):
-    match_counter = defaultdict(int)
-    for hash in set(hashes):
-        cursor.execute(base_match_query.format(int(hash)))
-        for track_name, count in cursor.fetchall():
-            match_counter[track_name] += count
-    sorted_matches = sorted(match_counter.items(), key=lambda x: x[1], reverse=True)
-    try:
-        result = sorted_matches[0][0]
-    except IndexError:
-        result = "No track found"
-    return result
+    fingerprint_kwargs = dict(min_peak_amplitude=MIN_FINGER_PRINT_WAV, peak_strategy=PEAK_STRATEGY,
+                              hash_version=HASH_VERSION)
+    if async_requested():
+        job = job_queue.submit('add_track', fingerprint_waveform, (waveform, fingerprint_kwargs),
+                               finish=lambda fingerprint: store_fingerprint(track_name, fingerprint))
+        return job_accepted(job)
+    new_track = require_hashes(StreamFingerprint(waveform, **fingerprint_kwargs))
+    session = get_storage_session()
+    session.check_fingerprint_settings(new_track.index_settings(), record=True)
+    session.insert_fingerprints(track_name, new_track.hashes, new_track.offsets, new_track.track_details())
+    flask.g.inserted_hashes = new_track.hashes
+    return flask.jsonify({"result": "{} added to database".format(track_name)})
+
+def store_fingerprint(track_name, fingerprint):
+    """
+    Finish step of a queued /add_track_to_database job, run outside any request.
+    """
+    with get_storage().session() as session:
+        session.check_fingerprint_settings(fingerprint['index_settings'], record=True)
+        rows = session.insert_fingerprints(track_name, fingerprint['hashes'], fingerprint['offsets'],
+                                           fingerprint['track_details'])
+    posting_cache.invalidate(fingerprint['hashes'])
+    return {"result": "{} added to database".format(track_name), "rows": rows}
+
+
+def match_fingerprint(fingerprint):
+    """
+    Finish step of a queued /wav_upload job, run outside any request.
+    """
+    source = get_storage() if coalescer is None else coalescer.session(get_storage())
+    ranking = rank_tracks(source, fingerprint['hashes'], fingerprint['offsets'])
+    return match_result(ranking, fingerprint['seconds_per_column'])
+
+
+def get_lookup_session():
+    """
+    Returns what the current request looks hashes up through: its own storage session, or
+    with coalescing on, a session whose lookups are merged with those of concurrent
+    requests, each merged lookup on a connection borrowed just for it.
+    """
+    if coalescer is None:
+        return get_storage_session()
+    return coalescer.session(get_storage())
+
+
+def rank_tracks(source, hashes, offsets, stage_hook=None):
+    # A coalesced lookup waits out the window each time, so with coalescing on a clip's
+    # postings are fetched in one merged lookup instead of in rarity batches
+    if RARITY_ORDERED_MATCHING and coalescer is None:
+        return posting_cache.match_by_rarity(source, hashes, offsets, top_k=TOP_K_MATCHES, stage_hook=stage_hook)
+    return posting_cache.lookup_alignment(source, hashes, offsets, top_k=TOP_K_MATCHES, stage_hook=stage_hook)
+
+
+def compare_hashes(hashes, offsets):
+    return rank_tracks(get_lookup_session(), hashes, offsets, stage_hook=flask.g.stage_timings)
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        response = flask.jsonify({"result": "Unknown job"})
+        response.status_code = 404
+        return response
+    return flask.jsonify(status)
+
+
+@app.route("/metrics")
+def serve_metrics():
+    return flask.Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/wav_upload', methods=['POST'])
 def upload_file():
-    print("1")
     if flask.request.method == 'POST':
-        print("2")
-        print(flask.request.files)
         # check if the post request has the file part
         if 'file' not in flask.request.files:
             return {"result": "Invalid File Type"}
 
 
         file = flask.request.files['file']
-        print("YEAH ", allowed_file(file.filename))
         # if user does not select file, browser also
         # submit a empty part without filename
         if file.filename == '':
-            print('NAH')
             return {"result": "Invalid File Type"}
         if file and allowed_file(file.filename):
-            print("YEA")
-            print(file.filename)
-            filename = secure_filename(file.filename)
-            path_to_file = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # Concurrent uploads of the same file name must not overwrite each other
+            file_handle, path_to_file = tempfile.mkstemp(prefix=secure_filename(file.filename),
+                                                         suffix='.wav', dir=app.config['UPLOAD_FOLDER'])
+            os.close(file_handle)
             file.save(path_to_file)
-            new_track = WavFingerprint(path_to_file, peak_sensitivity=20,
-                           min_peak_amplitude=40, look_forward_time=10)
-            best_match = compare_hashes(new_track.hashes)
+            fingerprint_kwargs = dict(peak_sensitivity=20, min_peak_amplitude=40, look_forward_time=10,
+                                      peak_strategy=PEAK_STRATEGY, hash_version=HASH_VERSION)
+            if async_requested():
+                try:
+                    job = job_queue.submit('match_upload', fingerprint_wav_file,
+                                           (path_to_file, fingerprint_kwargs, True), finish=match_fingerprint)
+                except QueueFullError:
+                    os.remove(path_to_file)
+                    raise
+                return job_accepted(job)
+            try:
+                new_track = require_hashes(WavFingerprint(path_to_file, cache=fingerprint_cache,
+                                                          stage_hook=flask.g.stage_timings, **fingerprint_kwargs))
+            finally:
+                os.remove(path_to_file)
+            ranking = compare_hashes(new_track.hashes, new_track.offsets)
+            seconds_per_column = new_track.seconds_per_column()
             del new_track
-            os.remove(path_to_file)
-            return flask.jsonify({"result": best_match})
+            return match_response(ranking, seconds_per_column)
 
 
 def allowed_file(filename):
@@ -125,8 +424,9 @@ def allowed_file(filename):
 
 
 
-# For local development:
-app.run(debug=True)
+if __name__ == "__main__":
+    # For local development:
+    app.run(debug=True, threaded=True)
 
-# For public web serving:
-# app.run(host='0.0.0.0')
+    # For public web serving use a multi-threaded WSGI server, e.g.
+    # gunicorn --threads 8 --workers 4 zwazam_api:app
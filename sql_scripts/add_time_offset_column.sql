@@ -0,0 +1 @@
+ALTER TABLE zwazam ADD COLUMN IF NOT EXISTS time_offset integer;
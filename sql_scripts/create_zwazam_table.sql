@@ -1,8 +1,24 @@
-CREATE TABLE IF NOT EXISTS zwazam(
-  track varchar,
-  hash bigint,
-  PRIMARY KEY (track, hash)
+CREATE TABLE IF NOT EXISTS tracks(
+  id serial PRIMARY KEY,
+  name varchar UNIQUE NOT NULL,
+  duration real,
+  fingerprint_version integer
   );
 
-CREATE INDEX hash_index
-ON zwazam (hash)
+-- One row per time offset a hash occurs at in a track, -1 when the offset is not known
+CREATE TABLE IF NOT EXISTS postings(
+  hash bigint NOT NULL,
+  track_id integer NOT NULL REFERENCES tracks (id),
+  time_offset integer NOT NULL DEFAULT -1,
+  PRIMARY KEY (hash, track_id, time_offset)
+  );
+
+CREATE TABLE IF NOT EXISTS zwazam_metadata(
+  key varchar PRIMARY KEY,
+  value varchar NOT NULL
+  );
+
+CREATE TABLE IF NOT EXISTS zwazam_hash_frequency(
+  hash bigint PRIMARY KEY,
+  track_count integer NOT NULL
+  );
@@ -1 +1,6 @@
-DROP TABLE zwazam;
+DROP TABLE IF EXISTS postings;
+DROP TABLE IF EXISTS tracks;
+DROP TABLE IF EXISTS zwazam_metadata;
+DROP TABLE IF EXISTS zwazam_hash_frequency;
+DROP TABLE IF EXISTS zwazam;
+DROP TABLE IF EXISTS zwazam_before_migration;
@@ -0,0 +1,19 @@
+-- Moves fingerprints from the old zwazam table, which repeated the track name in every
+-- row, into tracks and postings. Run it once after create_zwazam_table.sql (and, for
+-- tables from before time offsets, add_time_offset_column.sql). The old table is kept as
+-- zwazam_before_migration; drop it once matching works. Rows stored without a time offset
+-- get -1, the postings table's value for an unknown offset.
+BEGIN;
+
+INSERT INTO tracks (name, fingerprint_version)
+  SELECT DISTINCT track,
+    COALESCE((SELECT CAST(value AS integer) FROM zwazam_metadata WHERE key = 'hash_version'), 1)
+  FROM zwazam;
+
+INSERT INTO postings (hash, track_id, time_offset)
+  SELECT DISTINCT zwazam.hash, tracks.id, COALESCE(zwazam.time_offset, -1)
+  FROM zwazam JOIN tracks ON tracks.name = zwazam.track;
+
+ALTER TABLE zwazam RENAME TO zwazam_before_migration;
+
+COMMIT;
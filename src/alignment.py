@@ -0,0 +1,107 @@
+import numpy as np
+from array_utils import expand_ranges
+from hash_index import NO_OFFSET
+from instrumentation import timed_stage
+from zwazam_settings import *
+
+
+def score_alignment(hashes, offsets, postings, top_k=None, tolerance=ALIGNMENT_TOLERANCE_COLUMNS,
+                    stage_hook=None):
+    """
+    Scores tracks by how many of the query clip's hashes line up in time. Every pairing of
+    a query hash with a stored posting of the same hash votes for
+    (track, stored offset - query offset); a clip taken from a track puts most of its votes
+    for that track on one offset, while chance matches spread theirs out. The votes are
+    counted with one np.unique over (track, offset difference) keys, and a track's score is
+    its best offset difference together with the differences up to tolerance columns
+    either side, which absorbs frames that straddle the hop.
+    Input:
+    hashes, offsets: the query clip's hashes and the time column of each
+    postings: list of (hash, track_name, time_offset) rows for the clip's distinct hashes,
+    one per offset a hash is stored at in a track, time_offset None where it was not stored
+    top_k: how many tracks to return, None returns every track with a match
+    tolerance: how many columns either side of an offset difference also count for it
+    stage_hook: optional callable told how long the scoring took, see
+    instrumentation.timed_stage
+    Return:
+    list of (track_name, aligned_score, offset, match_count) sorted from best to worst:
+    offset is where in the track, in columns, the clip starts (None without stored offsets)
+    and match_count is the plain number of shared distinct hashes, which breaks ties and
+    ranks tracks stored without offsets
+    """
+    with timed_stage(stage_hook, 'alignment') as counts:
+        if not postings:
+            counts['votes'] = 0
+            return []
+        posting_hashes, posting_tracks, posting_offsets = zip(*postings)
+        track_names, track_ids = np.unique(np.asarray(posting_tracks, dtype=object).astype(str),
+                                           return_inverse=True)
+        posting_hashes = np.asarray(posting_hashes, dtype=np.int64)
+        # A hash stored at several offsets of a track is still one shared hash
+        shared = np.unique(np.stack([track_ids, posting_hashes]), axis=1)
+        match_counts = np.bincount(shared[0], minlength=len(track_names))
+        posting_offsets = np.array([NO_OFFSET if offset is None else offset for offset in posting_offsets],
+                                   dtype=np.int64)
+
+        known = posting_offsets != NO_OFFSET
+        posting_hashes, posting_offsets, track_ids = posting_hashes[known], posting_offsets[known], track_ids[known]
+        order = np.argsort(posting_hashes, kind='stable')
+        query_hashes = np.asarray(hashes, dtype=np.int64)
+        query_offsets = np.asarray(offsets, dtype=np.int64)
+        starts = np.searchsorted(posting_hashes[order], query_hashes, side='left')
+        ends = np.searchsorted(posting_hashes[order], query_hashes, side='right')
+        query_index = np.repeat(np.arange(len(query_hashes)), ends - starts)
+        posting_index = order[expand_ranges(starts, ends)]
+        differences = posting_offsets[posting_index] - query_offsets[query_index]
+        counts['votes'] = len(differences)
+
+        best_scores = np.zeros(len(track_names), dtype=np.int64)
+        best_offsets = np.zeros(len(track_names), dtype=np.int64)
+        if len(differences):
+            # One key per (track, difference), padded so neighbours never cross into another track
+            lowest = differences.min()
+            span = differences.max() - lowest + 1 + 2 * tolerance
+            keys, votes = np.unique(track_ids[posting_index] * span + (differences - lowest + tolerance),
+                                    return_counts=True)
+            scores = votes.copy()
+            for shift in range(-tolerance, tolerance + 1):
+                if shift:
+                    positions = np.minimum(np.searchsorted(keys, keys + shift), len(keys) - 1)
+                    neighbours = keys[positions] == keys + shift
+                    scores[neighbours] += votes[positions[neighbours]]
+            key_tracks = keys // span
+            best = np.lexsort((keys, -scores, key_tracks))
+            first = np.ones(len(best), dtype=bool)
+            first[1:] = key_tracks[best[1:]] != key_tracks[best[:-1]]
+            best = best[first]
+            best_scores[key_tracks[best]] = scores[best]
+            best_offsets[key_tracks[best]] = keys[best] % span + lowest - tolerance
+
+        ranked = np.lexsort((np.arange(len(track_names)), -match_counts, -best_scores))[:top_k]
+        return [(str(track_names[track_id]), int(best_scores[track_id]),
+                 int(best_offsets[track_id]) if best_scores[track_id] else None, int(match_counts[track_id]))
+                for track_id in ranked]
+
+
+def lookup_alignment(source, hashes, offsets, top_k=None, stage_hook=None):
+    """
+    Fetches the postings for a query clip from source and scores them with
+    score_alignment, reporting the fetch as the 'lookup' stage.
+    Input:
+    source: StorageSession, FingerprintStorage or IndexStorage with lookup_postings
+    """
+    with timed_stage(stage_hook, 'lookup') as counts:
+        postings = source.lookup_postings(hashes)
+        counts.update(hashes=len(hashes), rows=len(postings))
+    return score_alignment(hashes, offsets, postings, top_k=top_k, stage_hook=stage_hook)
+
+
+def alignment_confidence(ranking):
+    """
+    How clearly the best track of a score_alignment ranking beats the runner-up, from 0
+    (a tie, or nothing aligned) to 1 (nothing else aligned at all).
+    """
+    if not ranking or not ranking[0][1]:
+        return 0.
+    runner_up_score = ranking[1][1] if len(ranking) > 1 else 0
+    return 1. - runner_up_score / float(ranking[0][1])
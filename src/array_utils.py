@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def expand_ranges(starts, ends):
+    """
+    Turns a set of half open [start, end) ranges into one flat array holding every
+    index inside those ranges, without a python loop.
+    Input:
+    starts, ends: integer arrays of equal length
+    Return:
+    integer array of all indices covered by the ranges, in order
+    """
+    lengths = np.maximum(ends - starts, 0)
+    range_starts = np.cumsum(lengths) - lengths
+    positions = np.arange(int(lengths.sum())) - np.repeat(range_starts, lengths)
+    return np.repeat(starts, lengths) + positions
+
+
+def window_matches(sorted_keys, query_keys, low_offset, high_offset):
+    """
+    For every query key, finds all sorted keys that fall strictly inside the window
+    (query + low_offset, query + high_offset) using two binary searches.
+    Input:
+    sorted_keys: ascending integer array to search
+    query_keys: integer array of window centres
+    low_offset, high_offset: window edges relative to each query key, both excluded
+    Return:
+    query_indices, key_positions: one entry per match, grouped by query in query
+    order and ascending position within each query
+    """
+    window_start = np.searchsorted(sorted_keys, query_keys + low_offset, side='right')
+    window_end = np.searchsorted(sorted_keys, query_keys + high_offset, side='left')
+    match_counts = np.maximum(window_end - window_start, 0)
+    query_indices = np.repeat(np.arange(len(query_keys)), match_counts)
+    return query_indices, expand_ranges(window_start, window_end)
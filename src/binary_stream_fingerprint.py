@@ -12,9 +12,12 @@ class BinaryStreamFingerprint(ProcessAudio):
         super class.
 
         Input:
-        read_data: array in binary format
+        read_data: bytes, or an array of unsigned bytes, of recorded audio
         """
-        self.raw_data = np.frombuffer(read_data, dtype='B')
+        if isinstance(read_data, np.ndarray):
+            self.raw_data = read_data
+        else:
+            self.raw_data = np.frombuffer(read_data, dtype='B')
         self.final_sample = self.raw_data.shape[0]
         super(BinaryStreamFingerprint, self).__init__(**kwargs)
 
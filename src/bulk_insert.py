@@ -0,0 +1,222 @@
+import io
+import time
+import numpy as np
+from hash_index import NO_OFFSET
+
+# Adds the track, or keeps its id and fills in details it did not have yet
+TRACK_QUERY = """
+    INSERT INTO tracks (name, duration, fingerprint_version) VALUES (%s, %s, %s)
+    ON CONFLICT (name) DO UPDATE SET
+        duration = COALESCE(EXCLUDED.duration, tracks.duration),
+        fingerprint_version = COALESCE(EXCLUDED.fingerprint_version, tracks.fingerprint_version)
+    RETURNING id
+"""
+STAGING_TABLE_QUERY = """
+    CREATE TEMP TABLE IF NOT EXISTS zwazam_staging (hash bigint, time_offset integer)
+"""
+COPY_QUERY = "COPY zwazam_staging (hash, time_offset) FROM STDIN"
+MERGE_QUERY = """
+    INSERT INTO postings (hash, track_id, time_offset)
+    SELECT hash, %s, time_offset FROM zwazam_staging
+    ON CONFLICT (hash, track_id, time_offset) DO NOTHING
+"""
+SQLITE_TRACK_QUERY = """
+    INSERT INTO tracks (name, duration, fingerprint_version) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET
+        duration = COALESCE(EXCLUDED.duration, tracks.duration),
+        fingerprint_version = COALESCE(EXCLUDED.fingerprint_version, tracks.fingerprint_version)
+"""
+SQLITE_INSERT_QUERY = "INSERT OR IGNORE INTO postings (hash, track_id, time_offset) VALUES (?, ?, ?)"
+
+
+def distinct_postings(hashes, offsets=None):
+    """
+    Reduces a track's hashes to its distinct (hash, time offset) postings. A hash that
+    repeats within the track keeps every offset it occurs at, as each one is a vote for
+    alignment scoring; only exact repeats are dropped. Without offsets that leaves one
+    posting per distinct hash.
+    Input:
+    hashes: list or array of hashes for the track
+    offsets: matching time offsets, or None when they are not known
+    Return:
+    (hashes, their offsets or None) as int64 arrays sorted by hash, then offset
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    if offsets is None:
+        return np.unique(hashes), None
+    offsets = np.asarray(offsets, dtype=np.int64)
+    order = np.lexsort((offsets, hashes))
+    hashes, offsets = hashes[order], offsets[order]
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = (hashes[1:] != hashes[:-1]) | (offsets[1:] != offsets[:-1])
+    return hashes[first], offsets[first]
+
+
+class HashWriter:
+
+    def __init__(self, connection, tracks_per_commit=1):
+        """
+        Parent class for writing whole tracks of fingerprints to a database. Handles the
+        bookkeeping shared by every backend: each track runs inside its own savepoint, so
+        a failing track is rolled back on its own and the rest of the batch still commits,
+        commits happen every tracks_per_commit tracks and throughput is tracked for
+        reporting. Children implement _write_track.
+
+        Input:
+        connection: open DB-API connection
+        tracks_per_commit: how many tracks to write before committing, 0 never commits
+        so the caller decides when the transaction ends
+        """
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.tracks_per_commit = max(int(tracks_per_commit), 0)
+        self.pending_tracks = 0
+        self.rows_written = 0
+        self.tracks_written = 0
+        self.failed_tracks = []
+        self.seconds_spent = 0.
+
+    def _write_track(self, track_name, hashes, offsets, details):
+        """
+        Adds the track to the tracks table if it is new, writes its (hash, offset) postings,
+        NO_OFFSET for an unknown offset, and returns the number of new rows.
+        """
+        raise NotImplementedError
+
+    def add_track(self, track_name, hashes, offsets=None, details=None):
+        """
+        Writes the distinct postings of one track to the database. Commits once
+        tracks_per_commit tracks have been written.
+        Input:
+        track_name: name of the track, stored once in the tracks table
+        hashes: list or array of hashes for the track
+        offsets: time offset of each hash, every one stored for alignment scoring
+        details: optional dict with the track's duration and fingerprint_version, see
+        ProcessAudio.track_details
+        Return:
+        number of new rows inserted for the track (0 if the track failed)
+        """
+        start_time = time.time()
+        self.cursor.execute("SAVEPOINT zwazam_track")
+        try:
+            distinct_hashes, distinct_offsets = distinct_postings(hashes, offsets)
+            distinct_hashes = distinct_hashes.tolist()
+            if distinct_offsets is None:
+                distinct_offsets = [NO_OFFSET] * len(distinct_hashes)
+            else:
+                distinct_offsets = distinct_offsets.tolist()
+            inserted_rows = self._write_track(str(track_name), distinct_hashes, distinct_offsets, details or {})
+            self.cursor.execute("RELEASE SAVEPOINT zwazam_track")
+        except Exception as error:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT zwazam_track")
+            self.failed_tracks.append((track_name, str(error)))
+            inserted_rows = 0
+        else:
+            self.rows_written += inserted_rows
+            self.tracks_written += 1
+
+        self.pending_tracks += 1
+        if self.tracks_per_commit and self.pending_tracks >= self.tracks_per_commit:
+            self.commit()
+        self.seconds_spent += time.time() - start_time
+        return inserted_rows
+
+    def commit(self):
+        """
+        Commits every track written since the last commit.
+        """
+        if self.pending_tracks:
+            self.connection.commit()
+            self.pending_tracks = 0
+
+    def close(self):
+        """
+        Commits anything outstanding.
+        """
+        self.commit()
+
+    def rows_per_second(self):
+        if not self.seconds_spent:
+            return 0.
+        return self.rows_written / self.seconds_spent
+
+    def report(self):
+        """
+        Human readable summary of the load so far.
+        """
+        return "{} rows from {} tracks in {:.2f}s ({:.0f} rows/s), {} tracks failed".format(
+            self.rows_written, self.tracks_written, self.seconds_spent,
+            self.rows_per_second(), len(self.failed_tracks))
+
+
+class BulkHashWriter(HashWriter):
+
+    def __init__(self, connection, tracks_per_commit=1):
+        """
+        Streams fingerprints into Postgres with COPY instead of one INSERT per hash.
+        Each track's hashes are written into an in-memory buffer, copied into a
+        temporary staging table, then merged into postings under the track's id so that
+        rows that already exist for (hash, track, offset) are skipped instead of aborting
+        the load.
+
+        Input:
+        connection: open psycopg2 connection
+        tracks_per_commit: how many tracks to write before committing
+        """
+        super(BulkHashWriter, self).__init__(connection, tracks_per_commit)
+        self.cursor.execute(STAGING_TABLE_QUERY)
+
+    def _write_track(self, track_name, hashes, offsets, details):
+        self.cursor.execute(TRACK_QUERY, (track_name, details.get('duration'), details.get('fingerprint_version')))
+        track_id = self.cursor.fetchone()[0]
+        buffer = io.StringIO()
+        for hash, offset in zip(hashes, offsets):
+            buffer.write("{}\t{}\n".format(hash, offset))
+        buffer.seek(0)
+        self.cursor.copy_expert(COPY_QUERY, buffer)
+        self.cursor.execute(MERGE_QUERY, (track_id,))
+        inserted_rows = self.cursor.rowcount
+        self.cursor.execute("TRUNCATE zwazam_staging")
+        return inserted_rows
+
+    def close(self):
+        """
+        Commits anything outstanding and drops the staging table.
+        """
+        self.commit()
+        self.cursor.execute("DROP TABLE IF EXISTS zwazam_staging")
+        self.connection.commit()
+
+
+class SQLiteHashWriter(HashWriter):
+
+    def __init__(self, connection, tracks_per_commit=1):
+        """
+        Writes fingerprints into a SQLite database with one executemany per track.
+        Rows that already exist for (hash, track, offset) are ignored.
+
+        Input:
+        connection: sqlite3 connection opened with isolation_level=None
+        tracks_per_commit: how many tracks to write before committing
+        """
+        super(SQLiteHashWriter, self).__init__(connection, tracks_per_commit)
+
+    def _write_track(self, track_name, hashes, offsets, details):
+        self.cursor.execute(SQLITE_TRACK_QUERY, (track_name, details.get('duration'),
+                                                 details.get('fingerprint_version')))
+        self.cursor.execute("SELECT id FROM tracks WHERE name = ?", (track_name,))
+        track_id = self.cursor.fetchone()[0]
+        rows_before = self.connection.total_changes
+        self.cursor.executemany(SQLITE_INSERT_QUERY, ((hash, track_id, offset)
+                                                      for hash, offset in zip(hashes, offsets)))
+        return self.connection.total_changes - rows_before
+
+    def add_track(self, track_name, hashes, offsets=None, details=None):
+        if not self.connection.in_transaction:
+            self.cursor.execute("BEGIN")
+        return super(SQLiteHashWriter, self).add_track(track_name, hashes, offsets, details)
+
+    def commit(self):
+        if self.pending_tracks:
+            self.cursor.execute("COMMIT")
+            self.pending_tracks = 0
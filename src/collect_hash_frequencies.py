@@ -0,0 +1,35 @@
+import sys
+from storage import open_storage
+from zwazam_settings import *
+
+
+def collect_hash_frequencies(storage_url=STORAGE_URL):
+    """
+    Recounts the zwazam_hash_frequency table, the number of tracks each stored hash belongs to,
+    which RARITY_ORDERED_MATCHING orders lookups by.
+    """
+    storage = open_storage(storage_url)
+    print("Counted tracks for {} distinct hashes".format(storage.collect_document_frequencies()))
+    storage.close()
+
+
+def print_help_message():
+    print("Usage:")
+    print("python collect_hash_frequencies.py [storage_url]")
+    print("storage_url defaults to ZWAZAM_STORAGE")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if len(user_arguments) > 2:
+        raise IndexError("Takes at most a storage url. -h' for help.")
+    if len(user_arguments) == 2 and user_arguments[1] == "-h":
+        print_help_message()
+    elif len(user_arguments) == 2:
+        collect_hash_frequencies(storage_url=user_arguments[1])
+    else:
+        collect_hash_frequencies()
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
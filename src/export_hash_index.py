@@ -0,0 +1,57 @@
+import numpy as np
+import sys
+from hash_index import HashIndex, NO_OFFSET
+from storage import open_storage
+from zwazam_settings import *
+
+EXPORT_BATCH_SIZE = 100000
+
+
+def export_index(output_path, storage_url=STORAGE_URL):
+    """
+    Reads every (track_id, hash, time_offset) row out of the storage in batches and writes them to a
+    memory-mappable HashIndex file, along with the settings the fingerprints were made with.
+    """
+    storage = open_storage(storage_url)
+    fingerprint_settings = storage.fingerprint_settings()
+    track_table = storage.track_table()
+    track_id_chunks = []
+    hash_chunks = []
+    offset_chunks = []
+    for rows in storage.iter_track_postings(batch_size=EXPORT_BATCH_SIZE):
+        track_ids, hashes, offsets = zip(*rows)
+        track_id_chunks.append(np.array(track_ids, dtype=np.int64))
+        hash_chunks.append(np.array(hashes, dtype=np.int64))
+        offset_chunks.append(np.array([NO_OFFSET if offset is None else offset for offset in offsets],
+                                      dtype=np.int32))
+    storage.close()
+
+    track_ids = np.concatenate(track_id_chunks) if track_id_chunks else np.zeros(0, dtype=np.int64)
+    hashes = np.concatenate(hash_chunks) if hash_chunks else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate(offset_chunks) if offset_chunks else np.zeros(0, dtype=np.int32)
+    index = HashIndex.from_track_ids(track_table, track_ids, hashes, offsets=offsets,
+                                     metadata={'fingerprint_settings': fingerprint_settings})
+    index.save(output_path)
+    print("Wrote {} postings for {} tracks to {}".format(len(index), len(index.track_names), output_path))
+
+
+def print_help_message():
+    print("Usage:")
+    print("python export_hash_index.py path_to_output_index_file [storage_url]")
+    print("storage_url defaults to ZWAZAM_STORAGE")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if len(user_arguments) not in (2, 3):
+        raise IndexError("Must provide location for the index file. -h' for help.")
+    if user_arguments[1] == "-h":
+        print_help_message()
+    elif len(user_arguments) == 3:
+        export_index(user_arguments[1], storage_url=user_arguments[2])
+    else:
+        export_index(user_arguments[1])
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from zwazam_settings import *
+
+# Bump when a code change alters the hashes made from the same audio and parameters
+CACHE_FORMAT_VERSION = 2
+# Fingerprint parameters that never change which hashes come out, only how they are
+# computed, so they are left out of the cache key
+HASH_NEUTRAL_PARAMETERS = ('chunk_seconds', 'pairing_mode', 'spectrogram_engine')
+
+
+class FingerprintCache:
+
+    def __init__(self, directory, max_bytes=FINGERPRINT_CACHE_MAX_BYTES,
+                 evict_fraction=FINGERPRINT_CACHE_EVICT_FRACTION):
+        """
+        On-disk cache of fingerprints, keyed by a digest of the audio samples together with
+        every parameter that changes the hashes, so the same audio fingerprinted the same
+        way is only processed once, whatever the file is called. Each entry is one .npy file
+        holding two int64 rows, the hashes and their time offsets. Reading an entry
+        refreshes its modification time and when the cache grows past max_bytes the least
+        recently used entries are deleted until it is back under evict_fraction of it, so
+        one eviction makes room for many puts. The directory is scanned once when the
+        cache is opened and the entry list kept up to date from then on. Entries are
+        written to a temporary file and renamed into place, so several processes can share
+        one cache directory; each only counts the entries it has seen.
+
+        Input:
+        directory: where the cache lives, created if needed
+        max_bytes: size cap of all entries together
+        evict_fraction: share of max_bytes the cache is brought down to when it is full
+        """
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.evict_fraction = evict_fraction
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.entries = {path: (size, last_used) for path, size, last_used in self._scan()}
+        self.bytes_used = sum(size for size, _ in self.entries.values())
+
+    def key(self, samples, sample_rate, fingerprint_parameters):
+        """
+        Content address of a fingerprint.
+        Input:
+        samples: array of the audio as read from the file, all channels
+        sample_rate: samples per second
+        fingerprint_parameters: dict from ProcessAudio.fingerprint_parameters()
+        Return:
+        hex digest
+        """
+        parameters = {name: value for name, value in fingerprint_parameters.items()
+                      if name not in HASH_NEUTRAL_PARAMETERS}
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps({'version': CACHE_FORMAT_VERSION, 'sample_rate': int(sample_rate),
+                                  'dtype': samples.dtype.str, 'shape': list(samples.shape),
+                                  'parameters': parameters}, sort_keys=True).encode())
+        digest.update(memoryview(np.ascontiguousarray(samples)).cast('B'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def get(self, key):
+        """
+        Return:
+        (hashes, offsets) int64 arrays from the cache, or None
+        """
+        path = self._path(key)
+        try:
+            hashes, offsets = np.load(path)
+            os.utime(path)
+            size = os.path.getsize(path)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self._record(path, size)
+        return hashes, offsets
+
+    def put(self, key, hashes, offsets):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(file_handle, "wb") as cache_file:
+            np.save(cache_file, np.stack([np.asarray(hashes, dtype=np.int64),
+                                          np.asarray(offsets, dtype=np.int64)]))
+        os.replace(temporary_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self._record(path, size)
+            if self.bytes_used > self.max_bytes:
+                self._evict()
+
+    def _record(self, path, size):
+        """
+        Notes that the entry at path, of size bytes, was just used. Called with the lock held.
+        """
+        previous_size, _ = self.entries.get(path, (0, None))
+        self.entries[path] = (size, time.time())
+        self.bytes_used += size - previous_size
+
+    def _scan(self):
+        """
+        Return:
+        list of (path, size, last used time) of every entry
+        """
+        entries = []
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.endswith(".npy"):
+                    path = os.path.join(root, file_name)
+                    try:
+                        status = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((path, status.st_size, status.st_mtime))
+        return entries
+
+    def _evict(self):
+        """
+        Deletes least recently used entries until the cache fits in evict_fraction of
+        max_bytes. Called with the lock held.
+        """
+        target_bytes = self.max_bytes * self.evict_fraction
+        for path, (size, _) in sorted(self.entries.items(), key=lambda entry: entry[1][1]):
+            if self.bytes_used <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            del self.entries[path]
+            self.bytes_used -= size
+
+    def __getstate__(self):
+        # Worker processes get their own counters and lock
+        state = dict(self.__dict__)
+        state.update(hits=0, misses=0)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def open_fingerprint_cache(directory=FINGERPRINT_CACHE_DIR, max_bytes=FINGERPRINT_CACHE_MAX_BYTES):
+    """
+    Return:
+    FingerprintCache in directory, or None when directory is empty (cache turned off)
+    """
+    if not directory:
+        return None
+    return FingerprintCache(directory, max_bytes=max_bytes)
@@ -1,48 +1,84 @@
-import psycopg2 as pg
 from wav_fingerprint import WavFingerprint
+from process_audio import index_settings
+from fingerprint_cache import open_fingerprint_cache
 from glob import glob
+from job_queue import require_hashes
+from storage import open_storage
+from parallel_ingest import run_parallel_ingest
 import sys
 from zwazam_settings import *
 
 
-def connect_to_sql():
-    connection_args = {
-        'host': '', # You'll have to update this to your IP
-        'user': 'zachariahmiller',    # username
-        'dbname': 'zachariahmiller',   # DB that we are connecting to
-    }
-    connection = pg.connect(**connection_args)
-    return connection.cursor()
+def process_batch_files(path, storage_url=STORAGE_URL):
+    storage = open_storage(storage_url)
+    storage.check_fingerprint_settings(index_settings(PEAK_STRATEGY, hash_version=HASH_VERSION), record=True)
+    cache = open_fingerprint_cache()
+    if path[-1] == "/":
+        path = path[:-1]
+
+    with storage.bulk_writer(tracks_per_commit=TRACKS_PER_COMMIT) as writer:
+        for file in glob("{}/*.wav".format(path)):
+            print("Working on File", file)
+            track_name = file.split(('/'))[-1]
+            try:
+                track = require_hashes(WavFingerprint(file, chunked=CHUNKED_WAV_INGEST, cache=cache,
+                                                      min_peak_amplitude=MIN_FINGER_PRINT_WAV,
+                                                      peak_strategy=PEAK_STRATEGY, hash_version=HASH_VERSION))
+            except Exception as error:
+                writer.failed_tracks.append((track_name, "{}: {}".format(type(error).__name__, error)))
+                continue
+            writer.add_track(track_name, track.hashes, track.offsets, track.track_details())
+    if RARITY_ORDERED_MATCHING and writer.rows_written:
+        print("Counted tracks for {} distinct hashes".format(storage.collect_document_frequencies()))
+    storage.close()
+    for track_name, error in writer.failed_tracks:
+        print("Failed to store", track_name, error)
+    if cache is not None:
+        print("Fingerprint cache: {} hits, {} misses".format(cache.hits, cache.misses))
+    print(writer.report())
+    return None
 
 
-def process_batch_files(path):
-    cursor = connect_to_sql()
-    base_insert_query = "INSERT INTO zwazam(track, hash) VALUES ('{}', {});"
+def process_batch_files_parallel(path, workers=INGEST_WORKERS, storage_url=STORAGE_URL):
+    storage = open_storage(storage_url)
+    storage.check_fingerprint_settings(index_settings(PEAK_STRATEGY, hash_version=HASH_VERSION), record=True)
     if path[-1] == "/":
         path = path[:-1]
 
-    for file in glob("{}/*.wav".format(path)):
-        print("Working on File", file)
-        track = WavFingerprint(file, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
-        track.process_track(track.raw_data_left)
-        track_name = file.split(('/'))[-1]
-        for hash in set(track.hashes):
-            cursor.execute(base_insert_query.format(str(track_name), int(hash)))
-    cursor.execute("commit;")
+    files = glob("{}/*.wav".format(path))
+    with storage.bulk_writer(tracks_per_commit=TRACKS_PER_COMMIT) as writer:
+        failed_files = run_parallel_ingest(files, writer, workers=workers,
+                                           fingerprint_kwargs={'chunked': CHUNKED_WAV_INGEST,
+                                                               'cache': open_fingerprint_cache(),
+                                                               'min_peak_amplitude': MIN_FINGER_PRINT_WAV,
+                                                               'peak_strategy': PEAK_STRATEGY,
+                                                               'hash_version': HASH_VERSION})
+    if RARITY_ORDERED_MATCHING and writer.rows_written:
+        print("Counted tracks for {} distinct hashes".format(storage.collect_document_frequencies()))
+    storage.close()
+    for file, error in failed_files:
+        print("Failed to fingerprint", file, error)
+    for track_name, error in writer.failed_tracks:
+        print("Failed to store", track_name, error)
+    print(writer.report())
     return None
 
 
 def print_help_message():
     print("Usage:")
-    print("python fingerprint_directory_of_files.py path_to_wav_file_directory")
+    print("python fingerprint_directory_of_files.py path_to_wav_file_directory [number_of_workers]")
+    print("Giving a number of workers fingerprints files in parallel, 0 uses every core.")
+    print("Fingerprints go to the storage in the ZWAZAM_STORAGE environment variable, e.g. sqlite:///zwazam.db")
     exit(0)
 
 
 def parse_args(user_arguments):
-    if len(user_arguments) > 2:
+    if len(user_arguments) > 3 or len(user_arguments) < 2:
         raise IndexError("Must provide location for files. -h' for help.")
     if user_arguments[1] == "-h":
         print_help_message()
+    elif len(user_arguments) == 3:
+        process_batch_files_parallel(user_arguments[1], workers=int(user_arguments[2]) or None)
     elif type(user_arguments[1]) == str:
         process_batch_files(user_arguments[1])
     else:
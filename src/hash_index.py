@@ -0,0 +1,195 @@
+import json
+import numpy as np
+from array_utils import expand_ranges
+
+INDEX_MAGIC = b"ZWZIDX1\n"
+INDEX_FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+NO_OFFSET = -1
+
+
+class HashIndex:
+
+    def __init__(self, track_names, hashes, track_ids, offsets, metadata=None):
+        """
+        Read-mostly inverted index of fingerprint postings held as flat NumPy arrays.
+        Postings are sorted by hash, so every lookup is a vectorized binary search
+        instead of a database query. Use from_postings to build one, save to write it
+        to a single file and load to memory-map it back; processes that map the same
+        file share its pages, so a cold start does not have to read the whole index.
+
+        Input:
+        track_names: list of track names, position in the list is the track id
+        hashes: int64 array of posting hashes, sorted
+        track_ids: int32 array, track id of each posting
+        offsets: int32 array, time offset of each posting (NO_OFFSET when unknown)
+        metadata: dict of extra information stored with the index
+        """
+        self.track_names = list(track_names)
+        self.hashes = hashes
+        self.track_ids = track_ids
+        self.offsets = offsets
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_postings(cls, track_names, hashes, offsets=None, metadata=None):
+        """
+        Builds an index from one row per posting.
+        Input:
+        track_names: sequence with the track name of each posting
+        hashes: sequence with the hash of each posting
+        offsets: optional sequence with the time offset of each posting
+        Return:
+        HashIndex
+        """
+        names, track_ids = np.unique(np.asarray(track_names, dtype=object).astype(str), return_inverse=True)
+        return cls._from_positions(names.tolist(), track_ids, hashes, offsets, metadata)
+
+    @classmethod
+    def from_track_ids(cls, track_table, track_ids, hashes, offsets=None, metadata=None):
+        """
+        Builds an index from one row per posting that names its track by id, so only the
+        track table holds names, once per track.
+        Input:
+        track_table: dict of track id to track name
+        track_ids: sequence with the track id of each posting
+        hashes: sequence with the hash of each posting
+        offsets: optional sequence with the time offset of each posting
+        Return:
+        HashIndex, same as from_postings with each id replaced by its name
+        """
+        stored_ids = np.unique(np.asarray(track_ids, dtype=np.int64))
+        stored_names = [str(track_table[track_id]) for track_id in stored_ids.tolist()]
+        name_order = sorted(range(len(stored_names)), key=stored_names.__getitem__)
+        positions = np.empty(len(stored_names), dtype=np.int32)
+        positions[name_order] = np.arange(len(stored_names), dtype=np.int32)
+        track_ids = positions[np.searchsorted(stored_ids, track_ids)]
+        return cls._from_positions([stored_names[i] for i in name_order], track_ids, hashes, offsets, metadata)
+
+    @classmethod
+    def _from_positions(cls, names, track_ids, hashes, offsets, metadata):
+        hashes = np.asarray(hashes, dtype=np.int64)
+        if offsets is None:
+            offsets = np.full(len(hashes), NO_OFFSET, dtype=np.int32)
+        offsets = np.asarray(offsets, dtype=np.int32)
+        track_ids = np.asarray(track_ids).astype(np.int32)
+
+        order = np.lexsort((offsets, track_ids, hashes))
+        hashes, track_ids, offsets = hashes[order], track_ids[order], offsets[order]
+        if len(hashes):
+            duplicate = np.zeros(len(hashes), dtype=bool)
+            duplicate[1:] = ((hashes[1:] == hashes[:-1]) & (track_ids[1:] == track_ids[:-1])
+                             & (offsets[1:] == offsets[:-1]))
+            hashes, track_ids, offsets = hashes[~duplicate], track_ids[~duplicate], offsets[~duplicate]
+        return cls(names, hashes, track_ids, offsets, metadata)
+
+    def save(self, path):
+        """
+        Writes the index to a single file: a magic string, a JSON header with the track
+        name table and the location of each array, then the raw arrays aligned so they can
+        be memory-mapped in place.
+        """
+        arrays = {'hashes': self.hashes.astype('<i8'),
+                  'track_ids': self.track_ids.astype('<i4'),
+                  'offsets': self.offsets.astype('<i4')}
+        array_layout = {}
+        position = 0
+        for name, array in arrays.items():
+            position = -(-position // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+            array_layout[name] = {'dtype': array.dtype.str, 'length': len(array), 'position': position}
+            position += array.nbytes
+        header = json.dumps({'version': INDEX_FORMAT_VERSION, 'tracks': self.track_names,
+                             'metadata': self.metadata, 'arrays': array_layout}).encode()
+
+        data_start = len(INDEX_MAGIC) + 8 + len(header)
+        data_start = -(-data_start // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+        with open(path, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(np.uint64(data_start).tobytes())
+            index_file.write(header)
+            for name, array in arrays.items():
+                index_file.seek(data_start + array_layout[name]['position'])
+                index_file.write(array.tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens an index written by save. With mmap=True the posting arrays stay on disk
+        and are paged in by the operating system as lookups touch them.
+        """
+        with open(path, 'rb') as index_file:
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("{} is not a zwazam hash index".format(path))
+            data_start = int(np.frombuffer(index_file.read(8), dtype=np.uint64)[0])
+            header_length = data_start - len(INDEX_MAGIC) - 8
+            header = json.loads(index_file.read(header_length).rstrip(b"\x00").decode())
+        if header['version'] != INDEX_FORMAT_VERSION:
+            raise ValueError("Unsupported hash index version {}".format(header['version']))
+
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            if mmap and layout['length']:
+                arrays[name] = np.memmap(path, dtype=layout['dtype'], mode='r', shape=(layout['length'],),
+                                         offset=data_start + layout['position'])
+            else:
+                arrays[name] = np.fromfile(path, dtype=layout['dtype'], count=layout['length'],
+                                           offset=data_start + layout['position'])
+        return cls(header['tracks'], arrays['hashes'], arrays['track_ids'], arrays['offsets'],
+                   header['metadata'])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _track_postings(self, postings):
+        """
+        Return:
+        mask of the postings that are the first of their (hash, track), as postings sorted
+        by hash and track list a hash stored at several offsets of a track together
+        """
+        first = np.ones(len(postings), dtype=bool)
+        first[1:] = ((self.hashes[postings[1:]] != self.hashes[postings[:-1]])
+                     | (self.track_ids[postings[1:]] != self.track_ids[postings[:-1]]))
+        return first
+
+    def lookup_postings(self, hashes):
+        """
+        Finds every posting for a set of query hashes.
+        Input:
+        hashes: list or array of query hashes
+        Return:
+        posting indices (into hashes, track_ids and offsets) of all matching postings
+        """
+        query_hashes = np.unique(np.asarray(hashes, dtype=np.int64))
+        starts = np.searchsorted(self.hashes, query_hashes, side='left')
+        ends = np.searchsorted(self.hashes, query_hashes, side='right')
+        return expand_ranges(starts, ends)
+
+    def document_frequencies(self, hashes):
+        """
+        Return:
+        dict of hash -> number of tracks it is stored for, for each stored query hash
+        """
+        postings = self.lookup_postings(hashes)
+        track_hashes = self.hashes[postings[self._track_postings(postings)]]
+        stored_hashes, track_counts = np.unique(track_hashes, return_counts=True)
+        return dict(zip(stored_hashes.tolist(), track_counts.tolist()))
+
+    def match_hashes(self, hashes, top_k=None):
+        """
+        Same scoring as hash_matcher.match_hashes, answered from the index: counts how many
+        of the query clip's distinct hashes each track has postings for.
+        Input:
+        hashes: list or array of hashes for the query clip
+        top_k: how many tracks to return, None returns every track with a match
+        Return:
+        list of (track_name, match_count) sorted from best to worst match
+        """
+        postings = self.lookup_postings(hashes)
+        postings = postings[self._track_postings(postings)]
+        counts = np.bincount(self.track_ids[postings], minlength=len(self.track_names))
+        ranked = np.argsort(-counts, kind='stable')
+        ranked = ranked[counts[ranked] > 0][:top_k]
+        return [(self.track_names[track_id], int(counts[track_id])) for track_id in ranked]
+
+    def list_tracks(self):
+        return list(self.track_names)
@@ -0,0 +1,101 @@
+import numpy as np
+
+# One set-based round trip per query clip: the whole distinct hash set goes to the
+# server as a single bigint[] parameter and Postgres does the counting and ranking,
+# grouping on the integer track id and looking up only the winners' names. A hash stored
+# at several offsets of a track still counts once.
+MATCH_QUERY = """
+    SELECT tracks.name, matches.match_count
+    FROM (
+        SELECT track_id, count(DISTINCT hash) AS match_count
+        FROM postings
+        WHERE hash = ANY(%s::bigint[])
+        GROUP BY track_id
+        ORDER BY match_count DESC
+        LIMIT %s
+    ) AS matches JOIN tracks ON tracks.id = matches.track_id
+    ORDER BY matches.match_count DESC
+"""
+
+POSTINGS_QUERY = """
+    SELECT postings.hash, tracks.name, NULLIF(postings.time_offset, -1)
+    FROM postings JOIN tracks ON tracks.id = postings.track_id
+    WHERE postings.hash = ANY(%s::bigint[])
+"""
+FREQUENCY_QUERY = "SELECT hash, track_count FROM zwazam_hash_frequency WHERE hash = ANY(%s::bigint[])"
+
+
+def unique_hashes(hashes):
+    """
+    Reduces a clip's hashes to the distinct values as plain python ints, which is
+    what the database driver needs to adapt them to a bigint array.
+    Input:
+    hashes: list or array of hashes for the query clip
+    Return:
+    list of distinct hashes
+    """
+    return np.unique(np.asarray(hashes, dtype=np.int64)).tolist()
+
+
+def match_hashes(cursor, hashes, top_k=None):
+    """
+    Counts, per track, how many of the query clip's distinct hashes are stored for that
+    track and returns the best scoring tracks. This gives the same counts as looking up
+    every hash separately, but costs a single query.
+    Input:
+    cursor: open database cursor
+    hashes: list or array of hashes for the query clip
+    top_k: how many tracks to return, None returns every track with a match
+    Return:
+    list of (track_name, match_count) sorted from best to worst match
+    """
+    query_hashes = unique_hashes(hashes)
+    if not query_hashes:
+        return []
+    cursor.execute(MATCH_QUERY, (query_hashes, top_k))
+    return cursor.fetchall()
+
+
+def fetch_postings(cursor, hashes):
+    """
+    Fetches the stored rows for the query clip's distinct hashes without counting them,
+    for callers that keep posting lists of their own, like posting_cache.PostingCache.
+    Input:
+    cursor: open database cursor
+    hashes: list or array of hashes
+    Return:
+    list of (hash, track_name, time_offset), one per stored row
+    """
+    query_hashes = unique_hashes(hashes)
+    if not query_hashes:
+        return []
+    cursor.execute(POSTINGS_QUERY, (query_hashes,))
+    return cursor.fetchall()
+
+
+def fetch_document_frequencies(cursor, hashes):
+    """
+    Reads how many tracks each of the distinct hashes is stored for from the
+    zwazam_hash_frequency table, as last collected by collect_document_frequencies.
+    Input:
+    cursor: open database cursor
+    hashes: list or array of hashes
+    Return:
+    dict of hash -> number of tracks, without the hashes missing from the table
+    """
+    query_hashes = unique_hashes(hashes)
+    if not query_hashes:
+        return {}
+    cursor.execute(FREQUENCY_QUERY, (query_hashes,))
+    return dict(cursor.fetchall())
+
+
+def best_match(sorted_matches):
+    """
+    Picks the name of the best matching track out of the output of match_hashes or
+    alignment.score_alignment.
+    """
+    try:
+        return sorted_matches[0][0]
+    except IndexError:
+        return "No track found"
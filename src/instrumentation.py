@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+@contextmanager
+def timed_stage(stage_hook, stage):
+    """
+    Times the body of a with block and reports it to stage_hook as
+    stage_hook(stage, seconds, **counts). The block fills in the yielded dict with the
+    sizes it wants reported (samples, peaks, hashes...). Does nothing when stage_hook is
+    None, so uninstrumented callers pay next to nothing.
+    """
+    counts = {}
+    if stage_hook is None:
+        yield counts
+        return
+    start = time.perf_counter()
+    yield counts
+    stage_hook(stage, time.perf_counter() - start, **counts)
+
+
+class StageTimings:
+
+    def __init__(self):
+        """
+        Stage hook that keeps every stage reported to it, in order, for one request or
+        one track. Pass it as stage_hook= to a fingerprinter or to lookup_hashes.
+        """
+        self.stages = []
+
+    def __call__(self, stage, seconds, **counts):
+        self.stages.append((stage, seconds, counts))
+
+    def as_dict(self):
+        """
+        Return:
+        JSON friendly breakdown: list of {stage, seconds, counts} plus the total seconds
+        """
+        return {'stages': [{'stage': stage, 'seconds': seconds, 'counts': counts}
+                           for stage, seconds, counts in self.stages],
+                'total_seconds': sum(seconds for _, seconds, _ in self.stages)}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, help_text):
+        """
+        Monotonic count per label set, rendered as a Prometheus counter.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def increment(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} counter".format(self.name)]
+        for labels, value in sorted(self.values.items()):
+            lines.append("{}{} {}".format(self.name, _format_labels(labels), value))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """
+        Distribution of observed values per label set, rendered as a Prometheus histogram
+        with cumulative buckets.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0., 'count': 0}
+        series = self.values[key]
+        for position, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                series['buckets'][position] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        for labels, series in sorted(self.values.items()):
+            for upper_bound, count in zip(self.buckets, series['buckets']):
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(labels + (('le', repr(upper_bound)),)),
+                                                     count))
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(labels + (('le', '+Inf'),)),
+                                                 series['count']))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), repr(series['sum'])))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(labels), series['count']))
+        return lines
+
+
+class CallbackMetric:
+
+    def __init__(self, name, help_text, callback, metric_type='gauge'):
+        """
+        Single value read from callback() at render time, for numbers another object
+        already keeps, like the hit count of a cache.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help_text),
+                "# TYPE {} {}".format(self.name, self.metric_type),
+                "{} {}".format(self.name, self.callback())]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        """
+        Thread safe collection of the API's counters and histograms. record_request folds
+        one request's StageTimings into per-stage latency histograms and item counters;
+        render produces the Prometheus text exposition format served at /metrics.
+        """
+        self.lock = threading.Lock()
+        self.requests = Counter("zwazam_requests_total", "Requests handled, by endpoint and HTTP status")
+        self.request_seconds = Histogram("zwazam_request_seconds", "Time to handle a request, by endpoint")
+        self.stage_seconds = Histogram("zwazam_stage_seconds", "Time spent in each processing stage")
+        self.stage_items = Counter("zwazam_stage_items_total",
+                                   "Items handled by each stage: samples, peaks, pairs, hashes, rows")
+        self.callback_metrics = []
+
+    def register_callback(self, name, help_text, callback, metric_type='gauge'):
+        """
+        Adds a metric whose value is read from callback() every time /metrics is rendered.
+        """
+        with self.lock:
+            self.callback_metrics.append(CallbackMetric(name, help_text, callback, metric_type))
+
+    def record_request(self, endpoint, status, seconds, timings=None):
+        with self.lock:
+            self.requests.increment(endpoint=endpoint, status=status)
+            self.request_seconds.observe(seconds, endpoint=endpoint)
+            for stage, stage_seconds, counts in (timings.stages if timings else []):
+                self.stage_seconds.observe(stage_seconds, endpoint=endpoint, stage=stage)
+                for item, count in counts.items():
+                    self.stage_items.increment(count, stage=stage, item=item)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in [self.requests, self.request_seconds, self.stage_seconds,
+                           self.stage_items] + self.callback_metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fingerprint_cache import open_fingerprint_cache
+from stream_fingerprint import StreamFingerprint
+from wav_fingerprint import WavFingerprint
+from zwazam_settings import *
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue already holds its maximum number of
+    unfinished jobs.
+    """
+    pass
+
+
+class SilentAudioError(ValueError):
+    """
+    Raised when audio gives no hashes to store or match, because it is silent or too
+    quiet for any peak to pass min_peak_amplitude.
+    """
+    pass
+
+
+def require_hashes(track):
+    """
+    Raises SilentAudioError if fingerprinting track gave no hashes.
+    Input:
+    track: ProcessAudio that has fingerprinted its audio
+    Return:
+    track
+    """
+    if track.hashes is None or not len(track.hashes):
+        raise SilentAudioError("No hashes to fingerprint, the audio is silent or too quiet")
+    return track
+
+
+class Job:
+
+    def __init__(self, kind):
+        """
+        One unit of background work and what came of it. The status goes from 'queued'
+        to 'running' once a worker process has it, 'finishing' while its result is
+        stored or matched in the web process, then 'done' or 'failed'.
+
+        Input:
+        kind: name of the work, reported with the status
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self.finishing = False
+        self.result = None
+        self.error = None
+
+    @property
+    def status(self):
+        if self.finished_at is not None:
+            return 'failed' if self.error is not None else 'done'
+        if self.finishing:
+            return 'finishing'
+        if self.future.running():
+            return 'running'
+        return 'queued'
+
+    def as_dict(self):
+        status = self.status
+        end = self.finished_at if self.finished_at is not None else time.time()
+        job = {"job_id": self.id, "kind": self.kind, "status": status,
+               "elapsed_seconds": end - self.submitted_at}
+        if status == 'done':
+            job["result"] = self.result
+        elif status == 'failed':
+            job["error"] = self.error
+        return job
+
+
+class JobQueue:
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_MAX_PENDING, keep_seconds=JOB_KEEP_SECONDS):
+        """
+        Runs CPU heavy work on a pool of local worker processes so web workers only queue
+        it and answer at once. The pool is started on the first submission, so every
+        process of a pre-forking server gets its own after the fork. What a job's result
+        needs afterwards in this process, like storing hashes, runs as its finish step on
+        a small thread pool. Finished jobs are remembered for keep_seconds. Thread safe.
+
+        Input:
+        workers: number of worker processes, defaults to the number of cores
+        max_pending: unfinished jobs allowed before submit raises QueueFullError
+        keep_seconds: how long a finished job can still be looked up
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self.jobs = OrderedDict()
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.pool = None
+        self.finishers = None
+        self.lock = threading.Lock()
+
+    def _forget_finished_jobs(self):
+        oldest_allowed = time.time() - self.keep_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished_at is not None and job.finished_at < oldest_allowed]:
+            del self.jobs[job_id]
+
+    def submit(self, kind, function, args=(), finish=None):
+        """
+        Queues function(*args) for a worker process.
+        Input:
+        kind: name of the work, reported with the status
+        function: module level function, so it can be sent to a worker process
+        args: picklable arguments for function
+        finish: optional callable run in this process with the function's return value;
+        what it returns becomes the job's result
+        Return:
+        Job
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError("{} jobs already waiting".format(self.pending))
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                self.finishers = self.finishers or ThreadPoolExecutor(max_workers=self.workers)
+            self._forget_finished_jobs()
+            job = Job(kind)
+            job.future = self.pool.submit(function, *args)
+            self.jobs[job.id] = job
+            self.pending += 1
+            self.submitted += 1
+            finishers = self.finishers
+        job.future.add_done_callback(lambda future: finishers.submit(self._finish, job, finish))
+        return job
+
+    def _finish(self, job, finish):
+        try:
+            result = job.future.result()
+            if finish is not None:
+                job.finishing = True
+                result = finish(result)
+            job.result = result
+        except Exception as error:
+            job.error = "{}: {}".format(type(error).__name__, error)
+            if isinstance(error, BrokenProcessPool):
+                # A worker died; start a fresh pool for the next submission
+                with self.lock:
+                    self.pool = None
+        finally:
+            job.finished_at = time.time()
+            with self.lock:
+                self.pending -= 1
+
+    def status(self, job_id):
+        """
+        Return:
+        dict describing the job, with how many queued jobs are ahead of it while it is
+        queued, None if the job is unknown
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = job.as_dict()
+            if status["status"] == 'queued':
+                status["queue_position"] = sum(1 for other in self.jobs.values()
+                                               if other.submitted_at < job.submitted_at
+                                               and other.status == 'queued')
+        return status
+
+    def close(self):
+        """
+        Waits for the submitted jobs to finish and stops the worker processes.
+        """
+        with self.lock:
+            pool, finishers = self.pool, self.finishers
+            self.pool = self.finishers = None
+        # The pool first: its last jobs still hand their finish steps to the finishers
+        if pool is not None:
+            pool.shutdown()
+        if finishers is not None:
+            finishers.shutdown()
+
+
+# Work done in the worker processes, at module level so it can be pickled
+
+def fingerprint_waveform(waveform, fingerprint_kwargs):
+    """
+    Fingerprints raw samples. Raises SilentAudioError if they give no hashes.
+    Return:
+    dict of hashes, offsets, seconds_per_column, index_settings and track_details
+    """
+    track = require_hashes(StreamFingerprint(waveform, **fingerprint_kwargs))
+    return {'hashes': track.hashes, 'offsets': track.offsets, 'seconds_per_column': track.seconds_per_column(),
+            'index_settings': track.index_settings(), 'track_details': track.track_details()}
+
+
+def fingerprint_wav_file(file_path, fingerprint_kwargs, remove_file=False):
+    """
+    Fingerprints a wav file, through the fingerprint cache, optionally deleting the file
+    afterwards whether or not it could be read. Raises SilentAudioError if it gives no
+    hashes.
+    Return:
+    dict of hashes, offsets, seconds_per_column, index_settings and track_details
+    """
+    try:
+        track = WavFingerprint(file_path, cache=open_fingerprint_cache(), **fingerprint_kwargs)
+    finally:
+        if remove_file:
+            os.remove(file_path)
+    require_hashes(track)
+    return {'hashes': track.hashes, 'offsets': track.offsets, 'seconds_per_column': track.seconds_per_column(),
+            'index_settings': track.index_settings(), 'track_details': track.track_details()}
@@ -0,0 +1,321 @@
+import sys
+import threading
+import time
+import numpy as np
+from posting_cache import PostingCache
+from storage import open_storage
+from streaming_fingerprint import StreamingFingerprint
+from zwazam_settings import *
+
+
+class RingBuffer:
+
+    def __init__(self, capacity):
+        """
+        Fixed size, thread safe buffer of audio samples between the capture thread and
+        the fingerprinting loop. Writing never allocates. If the reader falls more than
+        capacity samples behind, the oldest unread samples are overwritten and counted
+        in overrun_samples instead of blocking the audio callback.
+
+        Input:
+        capacity: number of samples the buffer holds
+        """
+        self.capacity = int(capacity)
+        self.samples = np.zeros(self.capacity, dtype=np.int16)
+        self.write_position = 0
+        self.read_position = 0
+        self.overrun_samples = 0
+        self.condition = threading.Condition()
+
+    def available(self):
+        return self.write_position - self.read_position
+
+    def write(self, new_samples, block=False):
+        """
+        Appends samples. With block=True waits for room instead of overwriting unread
+        samples, which suits sources that can pause, like files.
+        """
+        new_samples = np.asarray(new_samples, dtype=np.int16)
+        with self.condition:
+            if len(new_samples) > self.capacity:
+                self.overrun_samples += len(new_samples) - self.capacity
+                new_samples = new_samples[-self.capacity:]
+            if block:
+                self.condition.wait_for(lambda: self.capacity - self.available() >= len(new_samples))
+            start = self.write_position % self.capacity
+            first_part = min(len(new_samples), self.capacity - start)
+            self.samples[start:start + first_part] = new_samples[:first_part]
+            self.samples[:len(new_samples) - first_part] = new_samples[first_part:]
+            self.write_position += len(new_samples)
+            if self.available() > self.capacity:
+                self.overrun_samples += self.available() - self.capacity
+                self.read_position = self.write_position - self.capacity
+            self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Takes every unread sample out of the buffer, waiting up to timeout seconds for
+        at least one to arrive.
+        Return:
+        int16 array, empty if nothing arrived in time
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.available() > 0, timeout=timeout)
+            unread = self.available()
+            start = self.read_position % self.capacity
+            indices = (start + np.arange(unread)) % self.capacity
+            chunk = self.samples[indices]
+            self.read_position = self.write_position
+            self.condition.notify_all()
+            return chunk
+
+
+class MicrophoneSource:
+
+    def __init__(self, rate=44100, channels=2, frames_per_buffer=1024):
+        """
+        Captures the microphone with a pyAudio callback. Each callback decodes the
+        interleaved int16 frames, keeps the first channel and pushes it into the ring
+        buffer, so capture never waits on fingerprinting.
+        """
+        self.sample_rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.finished = False
+        self.audio = None
+        self.stream = None
+
+    def start(self, ring_buffer):
+        import pyaudio
+
+        def on_audio(in_data, frame_count, time_info, status):
+            ring_buffer.write(np.frombuffer(in_data, dtype='<i2')[::self.channels])
+            return None, pyaudio.paContinue
+
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16, channels=self.channels, rate=self.sample_rate,
+                                      input=True, frames_per_buffer=self.frames_per_buffer,
+                                      stream_callback=on_audio)
+        self.stream.start_stream()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+        self.finished = True
+
+
+class WavFileSource:
+
+    def __init__(self, filename, frames_per_buffer=1024, realtime=False):
+        """
+        Stand-in for MicrophoneSource that plays a wav file into the ring buffer from a
+        background thread, for testing the listen loop without pyAudio or a microphone.
+
+        Input:
+        filename: wav file to play
+        frames_per_buffer: samples delivered per simulated callback
+        realtime: pace delivery at the file's sample rate like a real microphone,
+        otherwise deliver as fast as the listener reads
+        """
+        from scipy.io import wavfile
+        self.sample_rate, read_data = wavfile.read(filename, mmap=True)
+        self.samples = read_data[:, 0] if read_data.ndim > 1 else read_data
+        self.frames_per_buffer = frames_per_buffer
+        self.realtime = realtime
+        self.finished = False
+        self.stop_requested = threading.Event()
+        self.thread = None
+
+    def start(self, ring_buffer):
+        def play():
+            for start in range(0, len(self.samples), self.frames_per_buffer):
+                if self.stop_requested.is_set():
+                    break
+                ring_buffer.write(self.samples[start:start + self.frames_per_buffer], block=not self.realtime)
+                if self.realtime:
+                    time.sleep(self.frames_per_buffer / self.sample_rate)
+            self.finished = True
+
+        self.thread = threading.Thread(target=play, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_requested.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.finished = True
+
+
+class ListenWindow:
+
+    def __init__(self, started_at, **fingerprint_kwargs):
+        """
+        One sliding window of the listen loop: a streaming fingerprinter started at
+        started_at seconds, and the time alignment of every hash it produced with the
+        stored tracks, rescored whenever new hashes come out.
+        """
+        self.started_at = started_at
+        self.fingerprint = StreamingFingerprint(**fingerprint_kwargs)
+        self.alignment = []
+
+    def add_samples(self, samples, storage, posting_cache):
+        if len(self.fingerprint.feed(samples)):
+            self.alignment = posting_cache.lookup_alignment(storage, self.fingerprint.hashes,
+                                                            self.fingerprint.offsets)
+
+    def ranking(self):
+        """
+        Return:
+        list of (track_name, score) from best to worst: the number of hashes that line
+        up in time, or of shared hashes for tracks stored without time offsets
+        """
+        ranking = [(track_name, score if offset is not None else match_count)
+                   for track_name, score, offset, match_count in self.alignment]
+        return sorted(ranking, key=lambda x: x[1], reverse=True)
+
+    def offset_seconds(self, track_name):
+        """
+        Where in track_name the window's audio starts, None if not known.
+        """
+        for aligned_track, _, offset, _ in self.alignment:
+            if aligned_track == track_name and offset is not None:
+                return offset * self.fingerprint.seconds_per_column()
+        return None
+
+
+class ContinuousListener:
+
+    def __init__(self, storage, source, window_seconds=LISTEN_WINDOW_SECONDS, hop_seconds=LISTEN_HOP_SECONDS,
+                 min_matches=LISTEN_MIN_MATCHES, min_margin=LISTEN_MIN_MARGIN, buffer_seconds=30.,
+                 **fingerprint_kwargs):
+        """
+        Always-on identification. The source fills a ring buffer from its own thread;
+        run() drains it, fingerprints the audio incrementally in overlapping windows
+        (a new one starts every hop_seconds and each lives window_seconds) and looks up
+        every new hash as soon as it is final. Tracks are scored by how many hashes line up
+        in time with them, so chance matches do not build up. Overlapping windows hear the same audio, so
+        lookups go through a PostingCache and each hash is fetched from storage once. A
+        match is reported the moment a window's best track is confident, which is usually
+        well before a full window of audio.
+
+        Input:
+        storage: FingerprintStorage to match against
+        source: MicrophoneSource or WavFileSource
+        window_seconds: longest stretch of audio a single window scores
+        hop_seconds: time between the starts of consecutive windows
+        min_matches: hashes the best track needs before it can be reported
+        min_margin: how many times the runner-up's score the best track needs
+        buffer_seconds: capacity of the capture ring buffer
+        fingerprint_kwargs: passed to every StreamingFingerprint
+        """
+        self.storage = storage
+        self.posting_cache = PostingCache()
+        self.source = source
+        self.sample_rate = source.sample_rate
+        self.window_seconds = window_seconds
+        self.hop_seconds = hop_seconds
+        self.min_matches = min_matches
+        self.min_margin = min_margin
+        self.fingerprint_kwargs = dict(fingerprint_kwargs, sample_rate=self.sample_rate)
+        storage.check_fingerprint_settings(StreamingFingerprint(**self.fingerprint_kwargs).index_settings())
+        self.ring_buffer = RingBuffer(buffer_seconds * self.sample_rate)
+        self.stop_requested = threading.Event()
+        self.windows = []
+        self.seconds_listened = 0.
+
+    def confident_match(self, ranking):
+        """
+        Decides if a window's ranking is good enough to report.
+        Return:
+        (track_name, score, runner_up_score) or None
+        """
+        if not ranking or ranking[0][1] < self.min_matches:
+            return None
+        runner_up_score = ranking[1][1] if len(ranking) > 1 else 0
+        if ranking[0][1] < self.min_margin * runner_up_score:
+            return None
+        return ranking[0][0], ranking[0][1], runner_up_score
+
+    def process(self, samples):
+        """
+        Feeds newly captured samples to the live windows.
+        Return:
+        dict describing the match if one became confident, otherwise None
+        """
+        if not self.windows or self.seconds_listened - self.windows[-1].started_at >= self.hop_seconds:
+            self.windows.append(ListenWindow(self.seconds_listened, **self.fingerprint_kwargs))
+        self.seconds_listened += len(samples) / self.sample_rate
+
+        for window in self.windows:
+            window.add_samples(samples, self.storage, self.posting_cache)
+            match = self.confident_match(window.ranking())
+            if match:
+                self.windows = []
+                return {'track': match[0], 'score': match[1], 'runner_up_score': match[2],
+                        'seconds_of_audio': self.seconds_listened - window.started_at,
+                        'heard_at': self.seconds_listened, 'offset_seconds': window.offset_seconds(match[0])}
+        self.windows = [window for window in self.windows
+                        if self.seconds_listened - window.started_at < self.window_seconds]
+        return None
+
+    def run(self, on_match, max_matches=None):
+        """
+        Listens until stop() is called, the source runs out or max_matches matches
+        have been reported, calling on_match(match) for each match.
+        """
+        matches_reported = 0
+        self.source.start(self.ring_buffer)
+        try:
+            while not self.stop_requested.is_set():
+                samples = self.ring_buffer.read(timeout=0.1)
+                if not len(samples):
+                    if self.source.finished:
+                        break
+                    continue
+                match = self.process(samples)
+                if match:
+                    on_match(match)
+                    matches_reported += 1
+                    if max_matches and matches_reported >= max_matches:
+                        break
+        finally:
+            self.source.stop()
+
+    def stop(self):
+        self.stop_requested.set()
+
+
+def print_match(match):
+    print("Heard {track} after {seconds_of_audio:.1f}s of audio "
+          "(score {score} vs {runner_up_score})".format(**match))
+
+
+def print_help_message():
+    print("Usage:")
+    print("python listen_continuous.py [storage_url] [path_to_wav_to_play_instead_of_microphone]")
+    print("Listens forever and prints every track it recognises. Ctrl-C to stop.")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if len(user_arguments) > 3:
+        raise IndexError("At most two arguments allowed. Use -h for help.")
+    if len(user_arguments) > 1 and user_arguments[1] == "-h":
+        print_help_message()
+    storage_url = user_arguments[1] if len(user_arguments) > 1 else STORAGE_URL
+    if len(user_arguments) == 3:
+        source = WavFileSource(user_arguments[2], realtime=True)
+    else:
+        source = MicrophoneSource()
+    listener = ContinuousListener(open_storage(storage_url), source, min_peak_amplitude=MIN_FINGER_PRINT_WAV,
+                                  peak_strategy=PEAK_STRATEGY, hash_version=HASH_VERSION)
+    try:
+        listener.run(print_match)
+    except KeyboardInterrupt:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
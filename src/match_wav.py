@@ -1,49 +1,43 @@
-import psycopg2 as pg
 from wav_fingerprint import WavFingerprint
 import sys
-from collections import defaultdict
+from hash_matcher import best_match
+from storage import open_storage
+from fingerprint_cache import open_fingerprint_cache
 from zwazam_settings import *
 
 DEBUG = True
 
-def connect_to_sql():
-    connection_args = {
-        'host': '', # You'll have to update this to your IP
-        'user': 'zachariahmiller',    # username
-        'dbname': 'zachariahmiller',   # DB that we are connecting to
-    }
-    connection = pg.connect(**connection_args)
-    return connection.cursor()
-
 
 def print_help_message():
     print("Usage:")
-    print("python match_wav.py path_to_wav_file_directory")
+    print("python match_wav.py path_to_wav_file_directory [storage_url]")
+    print("storage_url defaults to ZWAZAM_STORAGE, e.g. sqlite:///zwazam.db or index:///zwazam.idx")
     exit(0)
 
 
-def match_file(file_path):
-    cursor = connect_to_sql()
-    match_counter = defaultdict(int)
-    base_match_query = "SELECT track, count(hash) FROM zwazam WHERE hash = {} GROUP BY track"
-
-    new_track = WavFingerprint(file_path, min_peak_amplitude=MIN_FINGER_PRINT_WAV)
-    for hash in set(new_track.hashes):
-        cursor.execute(base_match_query.format(int(hash)))
-        for track_name, count in cursor.fetchall():
-            match_counter[track_name] += count
-    sorted_matches = sorted(match_counter.items(), key=lambda x: x[1], reverse=True)
+def match_file(file_path, storage_url=STORAGE_URL):
+    new_track = WavFingerprint(file_path, cache=open_fingerprint_cache(), min_peak_amplitude=MIN_FINGER_PRINT_WAV,
+                               peak_strategy=PEAK_STRATEGY, hash_version=HASH_VERSION)
+    storage = open_storage(storage_url)
+    storage.check_fingerprint_settings(new_track.index_settings())
+    if RARITY_ORDERED_MATCHING:
+        sorted_matches = storage.match_by_rarity(new_track.hashes, new_track.offsets, top_k=TOP_K_MATCHES)
+    else:
+        sorted_matches = storage.lookup_alignment(new_track.hashes, new_track.offsets, top_k=TOP_K_MATCHES)
+    storage.close()
     if DEBUG:
         return sorted_matches
     else:
-        return sorted_matches[0][0]
+        return best_match(sorted_matches)
 
 
 def parse_args(user_arguments):
-    if len(user_arguments) > 2:
+    if len(user_arguments) > 3:
         raise IndexError("Must provide location of one wav file. -h' for help.")
     if user_arguments[1] == "-h":
         print_help_message()
+    elif len(user_arguments) == 3:
+        print(match_file(user_arguments[1], storage_url=user_arguments[2]))
     elif type(user_arguments[1]) == str:
         print(match_file(user_arguments[1]))
     else:
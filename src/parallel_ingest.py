@@ -0,0 +1,107 @@
+import multiprocessing as mp
+import os
+import queue
+import time
+from collections import Counter
+from bulk_insert import distinct_postings
+from job_queue import require_hashes
+from wav_fingerprint import WavFingerprint
+
+_WORKER_DONE = None
+
+
+def fingerprint_worker(task_queue, result_queue, fingerprint_kwargs):
+    """
+    Worker process loop. Takes file paths off the task queue, fingerprints them and puts
+    (file_path, hashes, offsets, details, error) on the result queue. A failing file is reported back with
+    its error instead of taking down the worker. Exits after receiving a None task.
+    """
+    while True:
+        file_path = task_queue.get()
+        if file_path is _WORKER_DONE:
+            result_queue.put(_WORKER_DONE)
+            return
+        try:
+            track = require_hashes(WavFingerprint(file_path, **fingerprint_kwargs))
+            hashes, offsets = distinct_postings(track.hashes, track.offsets)
+            result_queue.put((file_path, hashes, offsets, track.track_details(), None))
+        except Exception as error:
+            result_queue.put((file_path, None, None, None, "{}: {}".format(type(error).__name__, error)))
+
+
+def run_parallel_ingest(file_paths, writer, workers=None, queue_size=None, fingerprint_kwargs=None):
+    """
+    Fingerprints files on a pool of worker processes and feeds every result to a single
+    writer in this process. Results travel through a bounded queue, so workers block
+    instead of piling up fingerprints in memory when the writer falls behind.
+
+    Input:
+    file_paths: list of wav files to fingerprint
+    writer: object with an add_track(track_name, hashes, offsets, details) method, e.g. BulkHashWriter
+    workers: number of worker processes, defaults to the number of cores
+    queue_size: maximum number of finished fingerprints waiting for the writer,
+    defaults to twice the number of workers
+    fingerprint_kwargs: keyword arguments passed to every WavFingerprint
+    Return:
+    list of (file_path, error) for the files that could not be fingerprinted, including
+    those that never came back because the worker process died (out of memory, a crash in
+    native code)
+    """
+    workers = workers or os.cpu_count() or 1
+    queue_size = queue_size or 2 * workers
+    fingerprint_kwargs = fingerprint_kwargs or {}
+
+    task_queue = mp.Queue()
+    result_queue = mp.Queue(maxsize=queue_size)
+    for file_path in file_paths:
+        task_queue.put(file_path)
+    for _ in range(workers):
+        task_queue.put(_WORKER_DONE)
+
+    processes = [mp.Process(target=fingerprint_worker, args=(task_queue, result_queue, fingerprint_kwargs))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    failed_files = []
+    files_missing = Counter(file_paths)
+    files_done = 0
+    hashes_done = 0
+    workers_running = workers
+    workers_exited = False
+    start_time = time.time()
+    while workers_running:
+        try:
+            result = result_queue.get(timeout=1.)
+        except queue.Empty:
+            # A worker that died never sends _WORKER_DONE. Once none is alive, wait one
+            # more timeout for results still on their way through the queue
+            if any(process.is_alive() for process in processes):
+                continue
+            if workers_exited:
+                break
+            workers_exited = True
+            continue
+        if result is _WORKER_DONE:
+            workers_running -= 1
+            continue
+
+        file_path, hashes, offsets, details, error = result
+        files_missing[file_path] -= 1
+        files_done += 1
+        track_name = file_path.split('/')[-1]
+        if error is None:
+            writer.add_track(track_name, hashes, offsets, details)
+            hashes_done += len(hashes)
+        else:
+            failed_files.append((file_path, error))
+        elapsed = time.time() - start_time
+        print("[{}/{}] {} ({}) | {:.2f} files/s, {:.0f} hashes/s".format(
+            files_done, len(file_paths), track_name, error or "{} hashes".format(len(hashes)),
+            files_done / elapsed, hashes_done / elapsed))
+
+    for process in processes:
+        process.join()
+    for file_path, missing in files_missing.items():
+        failed_files.extend([(file_path, "worker process exited before finishing it")] * missing)
+    return failed_files
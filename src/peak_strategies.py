@@ -0,0 +1,124 @@
+import numpy as np
+
+DEFAULT_PEAK_STRATEGY = 'local_maximum'
+
+PEAK_STRATEGIES = {}
+
+
+def register_peak_strategy(strategy_class):
+    """
+    Class decorator that makes a PeakStrategy selectable by its name, as
+    ProcessAudio(peak_strategy=name).
+    """
+    PEAK_STRATEGIES[strategy_class.name] = strategy_class
+    return strategy_class
+
+
+def get_peak_strategy(name):
+    """
+    Return:
+    an instance of the peak strategy registered as name
+    """
+    if name not in PEAK_STRATEGIES:
+        raise ValueError("peak_strategy must be one of {}".format(sorted(PEAK_STRATEGIES)))
+    return PEAK_STRATEGIES[name]()
+
+
+class PeakStrategy:
+
+    name = None
+    # 'decibel' for 10 * log10(psd), 'power' for the linear PSD
+    spectrogram_scale = 'decibel'
+
+    def find_peaks(self, fingerprinter, spectrogram):
+        """
+        Picks the peaks of a spectrogram. Children implement this.
+
+        Input:
+        fingerprinter: the ProcessAudio object, for its settings
+        spectrogram: matrix of frequency (rows) by time (columns) in spectrogram_scale
+        Return:
+        peak_locations: array of [frequency row, time column], 1 row per peak, sorted by
+        row then column
+        amplitudes: spectrogram value at each peak
+        """
+        raise NotImplementedError
+
+    def peak_map(self, fingerprinter, spectrogram):
+        """
+        The peaks as a dense 0/1 matrix the size of the spectrogram, for the reference
+        pairing loop and plotting. Children may override this with their original,
+        unvectorized implementation.
+        """
+        peak_locations, _ = self.find_peaks(fingerprinter, spectrogram)
+        peak_map = np.zeros(spectrogram.shape, dtype=bool)
+        peak_map[peak_locations[:, 0], peak_locations[:, 1]] = True
+        return peak_map
+
+    def context_columns(self, fingerprinter):
+        """
+        How many time columns on either side of a column can change whether it holds a
+        peak. The streaming fingerprinter keeps this many columns between blocks.
+        """
+        return 0
+
+
+@register_peak_strategy
+class LocalMaximumStrategy(PeakStrategy):
+    """
+    The original method: a peak is a point that is the maximum of its neighbourhood in
+    the decibel spectrogram and louder than min_peak_amplitude.
+    """
+
+    name = 'local_maximum'
+
+    def find_peaks(self, fingerprinter, spectrogram):
+        return fingerprinter.extract_peaks(spectrogram)
+
+    def peak_map(self, fingerprinter, spectrogram):
+        return fingerprinter.detect_peaks(spectrogram)
+
+    def context_columns(self, fingerprinter):
+        return fingerprinter.peak_sensitivity
+
+
+@register_peak_strategy
+class WeightedCentroidStrategy(PeakStrategy):
+    """
+    One peak per time column, at the spectral centroid: the mean frequency row weighted
+    by the power in each row, truncated to whole units of power as the original loop
+    did. Works on the linear power spectrogram and ignores min_peak_amplitude.
+    """
+
+    name = 'weighted_centroid'
+    spectrogram_scale = 'power'
+
+    def find_peaks(self, fingerprinter, spectrogram):
+        weights = np.floor(spectrogram).astype(np.int64)
+        total_weight = weights.sum(axis=0)
+        weighted_rows = np.arange(spectrogram.shape[0], dtype=np.int64).dot(weights)
+        columns = np.flatnonzero(total_weight)
+        rows = (weighted_rows[columns] / total_weight[columns]).astype(np.int64)
+        order = np.lexsort((columns, rows))
+        rows, columns = rows[order], columns[order]
+        return np.stack([rows, columns], axis=1), spectrogram[rows, columns]
+
+    def peak_map(self, fingerprinter, spectrogram):
+        """
+        The original loop from process_audio_test_method, which adds each row index once
+        per unit of power. Only practical on short clips; kept as the reference.
+        """
+        if fingerprinter.pairing_mode != 'reference':
+            return super(WeightedCentroidStrategy, self).peak_map(fingerprinter, spectrogram)
+        filtered_peak_locations = np.zeros_like(spectrogram)
+        for sample, frequency_readings in enumerate(spectrogram.T):
+            avg_weighted_freq = 0
+            counter = 0
+            for weight_selection, frequency in enumerate(frequency_readings):
+                for _ in range(int(frequency)):
+                    avg_weighted_freq += weight_selection
+                    counter += 1
+            if counter:
+                mean_frequency = int(avg_weighted_freq / counter)
+                filtered_peak_locations[mean_frequency][sample] = 1
+        return filtered_peak_locations
@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from alignment import score_alignment
+from hash_matcher import unique_hashes
+from instrumentation import timed_stage
+from rarity_matcher import match_by_rarity
+from zwazam_settings import *
+
+# Rough python memory of one cached hash: dict slot, key, tuples and timestamp, plus per
+# posting a pointer to the (shared) track name and a pointer to its offset int
+ENTRY_OVERHEAD_BYTES = 300
+BYTES_PER_POSTING = 44
+
+
+class PostingCache:
+
+    def __init__(self, max_bytes=POSTING_CACHE_MAX_BYTES, ttl_seconds=POSTING_CACHE_TTL_SECONDS):
+        """
+        In-process LRU cache of posting lists: for each hash, the tracks it is stored for
+        and the time offset it is stored at in each.
+        A small set of hashes turns up in almost every query clip, so answering those from
+        memory and sending only the misses to storage saves most of the lookup work. Hashes
+        that are stored for no track are cached too. Each track name is kept once, shared
+        by every entry holding it, and dropped with the last of them. Thread safe.
+
+        Tracks added through this process are handled by invalidate(); tracks added by
+        other processes become visible once the cached entries are ttl_seconds old.
+
+        Input:
+        max_bytes: memory budget, least recently used hashes are dropped beyond it
+        ttl_seconds: how long a cached posting list is trusted, None for ever
+        """
+        self.max_bytes = int(max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.track_names = {}
+        self.track_name_uses = Counter()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _entry_size(self, postings):
+        return ENTRY_OVERHEAD_BYTES + BYTES_PER_POSTING * len(postings[0])
+
+    def _intern(self, tracks):
+        """
+        Return:
+        tuple of tracks with every name replaced by the shared copy. Called with the lock held.
+        """
+        self.track_name_uses.update(tracks)
+        return tuple(self.track_names.setdefault(track, track) for track in tracks)
+
+    def _drop(self, postings):
+        """
+        Accounts for a cached posting list leaving the cache. Called with the lock held.
+        """
+        self.bytes_used -= self._entry_size(postings)
+        self.track_name_uses.subtract(postings[0])
+        for track in set(postings[0]):
+            if self.track_name_uses[track] <= 0:
+                del self.track_name_uses[track]
+                del self.track_names[track]
+
+    def get_many(self, hashes):
+        """
+        Return:
+        (dict of hash -> (tuple of track names, tuple of offsets) for the cached hashes,
+        list of the other hashes)
+        """
+        found = {}
+        missing = []
+        oldest_allowed = time.time() - self.ttl_seconds if self.ttl_seconds is not None else None
+        with self.lock:
+            for hash in hashes:
+                entry = self.entries.get(hash)
+                if entry is None or (oldest_allowed is not None and entry[1] < oldest_allowed):
+                    missing.append(hash)
+                    continue
+                self.entries.move_to_end(hash)
+                found[hash] = entry[0]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, postings):
+        """
+        Caches posting lists, evicting the least recently used ones to stay in budget.
+        Input:
+        postings: dict of hash -> (list of track names, list of offsets)
+        """
+        stored_at = time.time()
+        with self.lock:
+            for hash, (tracks, offsets) in postings.items():
+                entry = (self._intern(tracks), tuple(offsets))
+                previous = self.entries.pop(hash, None)
+                if previous is not None:
+                    self._drop(previous[0])
+                self.entries[hash] = (entry, stored_at)
+                self.bytes_used += self._entry_size(entry)
+            while self.bytes_used > self.max_bytes and self.entries:
+                _, (entry, _) = self.entries.popitem(last=False)
+                self._drop(entry)
+                self.evictions += 1
+
+    def invalidate(self, hashes):
+        """
+        Forgets the cached posting lists of hashes, e.g. after a track with them was stored.
+        """
+        with self.lock:
+            for hash in unique_hashes(hashes):
+                entry = self.entries.pop(hash, None)
+                if entry is not None:
+                    self._drop(entry[0])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.track_names.clear()
+            self.track_name_uses.clear()
+            self.bytes_used = 0
+
+    def _postings(self, storage, query_hashes, counts):
+        """
+        Posting lists of the distinct query hashes, fetching the cache misses from storage.
+        """
+        postings, missing = self.get_many(query_hashes)
+        if missing:
+            fetched = {hash: ([], []) for hash in missing}
+            for hash, track, offset in storage.lookup_postings(missing):
+                fetched[hash][0].append(track)
+                fetched[hash][1].append(offset)
+            self.put_many(fetched)
+            postings.update(fetched)
+        counts.update(hashes=len(query_hashes), cache_hits=len(query_hashes) - len(missing))
+        return postings
+
+    def lookup_hashes(self, storage, hashes, top_k=None, stage_hook=None):
+        """
+        Same result as storage.lookup_hashes, with only the cache misses sent to storage.
+        Input:
+        storage: FingerprintStorage or StorageSession with lookup_postings
+        hashes: list or array of hashes for the query clip
+        top_k: how many tracks to return, None returns every track with a match
+        stage_hook: optional callable told how long the lookup took, see
+        instrumentation.timed_stage
+        Return:
+        list of (track_name, match_count) sorted from best to worst match
+        """
+        with timed_stage(stage_hook, 'lookup') as counts:
+            postings = self._postings(storage, unique_hashes(hashes), counts)
+            scores = Counter(track for tracks, _ in postings.values() for track in set(tracks))
+            ranked = sorted(scores.items(), key=lambda score: (-score[1], score[0]))[:top_k]
+            counts['rows'] = len(ranked)
+        return ranked
+
+    def lookup_alignment(self, storage, hashes, offsets, top_k=None, stage_hook=None):
+        """
+        Same result as storage.lookup_alignment, with only the cache misses sent to storage.
+        Return:
+        list of (track_name, aligned_score, offset, match_count), see
+        alignment.score_alignment
+        """
+        with timed_stage(stage_hook, 'lookup') as counts:
+            postings = self._postings(storage, unique_hashes(hashes), counts)
+            rows = [(hash, track, offset) for hash, (tracks, track_offsets) in postings.items()
+                    for track, offset in zip(tracks, track_offsets)]
+            counts['rows'] = len(rows)
+        return score_alignment(hashes, offsets, rows, top_k=top_k, stage_hook=stage_hook)
+
+    def _rows(self, storage, hashes):
+        postings = self._postings(storage, hashes, {})
+        return [(hash, track, offset) for hash, (tracks, track_offsets) in postings.items()
+                for track, offset in zip(tracks, track_offsets)]
+
+    def _document_frequencies(self, storage, hashes):
+        """
+        Number of tracks in the posting lists of the cached hashes, read without touching
+        the LRU order or the hit counts, and the collected frequencies from storage for the
+        others.
+        """
+        frequencies = {}
+        with self.lock:
+            for hash in hashes:
+                entry = self.entries.get(hash)
+                if entry is not None:
+                    frequencies[hash] = len(set(entry[0][0]))
+        missing = [hash for hash in hashes if hash not in frequencies]
+        if missing:
+            frequencies.update(storage.document_frequencies(missing))
+        return frequencies
+
+    def match_by_rarity(self, storage, hashes, offsets=None, top_k=None, stage_hook=None):
+        """
+        Same result as storage.match_by_rarity, with each batch's cache misses sent to
+        storage.
+        Return:
+        list of ranking tuples with an upper bound on each score, see
+        rarity_matcher.match_by_rarity
+        """
+        return match_by_rarity(lambda batch: self._rows(storage, batch),
+                               lambda batch: self._document_frequencies(storage, batch),
+                               hashes, offsets=offsets, top_k=top_k, stage_hook=stage_hook)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes_used}
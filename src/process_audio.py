@@ -1,14 +1,74 @@
-from matplotlib.mlab import specgram
-import matplotlib.pyplot as plt
 import scipy.ndimage as ndi
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion
+from scipy.ndimage import generate_binary_structure, binary_erosion
 import numpy as np
-from matplotlib.mlab import window_hanning
+from array_utils import window_matches
+from instrumentation import timed_stage
+from peak_strategies import get_peak_strategy, DEFAULT_PEAK_STRATEGY
+from spectrogram import make_engine, REFERENCE_SAMPLE_RATE
+
+PAIRING_MODES = ('vectorized', 'reference')
+PEAK_NEIGHBORHOODS = ('diamond', 'square')
+DEFAULT_SAMPLE_RATE = REFERENCE_SAMPLE_RATE
+# Spectrogram columns extract_peaks filters at a time
+PEAK_BLOCK_COLUMNS = 512
+
+# Hash formats. 1 is the original (x_difference * 0x1f1f1f1f) ^ y_difference. 2 packs the
+# anchor's frequency row, the partner's frequency row and the signed time difference into
+# fixed bit fields under a version tag, see pack_hashes.
+HASH_VERSIONS = (1, 2)
+DEFAULT_HASH_VERSION = 1
+HASH_TIME_BITS = 20
+HASH_FREQUENCY_BITS = 16
+HASH_VERSION_SHIFT = 60
+
+
+def index_settings(peak_strategy=DEFAULT_PEAK_STRATEGY, peak_neighborhood='diamond',
+                   hash_version=DEFAULT_HASH_VERSION):
+    """
+    The settings that decide which hashes a track gets. A stored index only matches queries
+    fingerprinted with the same values, so they are recorded with it.
+    """
+    return {'peak_strategy': peak_strategy, 'peak_neighborhood': peak_neighborhood,
+            'hash_version': int(hash_version)}
+
+
+def pack_hashes(anchor_frequency, partner_frequency, time_difference):
+    """
+    Version 2 hash layout of an int64, from the least significant bit:
+    time_difference in HASH_TIME_BITS bits (two's complement, so +-524287 columns),
+    partner_frequency then anchor_frequency in HASH_FREQUENCY_BITS bits each, and the
+    format version from bit HASH_VERSION_SHIFT. Works on scalars and arrays alike.
+    """
+    time_mask = (1 << HASH_TIME_BITS) - 1
+    frequency_mask = (1 << HASH_FREQUENCY_BITS) - 1
+    return ((2 << HASH_VERSION_SHIFT)
+            | ((anchor_frequency & frequency_mask) << (HASH_TIME_BITS + HASH_FREQUENCY_BITS))
+            | ((partner_frequency & frequency_mask) << HASH_TIME_BITS)
+            | (time_difference & time_mask))
+
+
+def unpack_hashes(hashes):
+    """
+    Splits version 2 hashes back into their fields.
+    Return:
+    (anchor_frequency, partner_frequency, time_difference) arrays
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    time_mask = (1 << HASH_TIME_BITS) - 1
+    frequency_mask = (1 << HASH_FREQUENCY_BITS) - 1
+    time_difference = hashes & time_mask
+    time_difference = np.where(time_difference >= 1 << (HASH_TIME_BITS - 1),
+                               time_difference - (1 << HASH_TIME_BITS), time_difference)
+    return ((hashes >> (HASH_TIME_BITS + HASH_FREQUENCY_BITS)) & frequency_mask,
+            (hashes >> HASH_TIME_BITS) & frequency_mask, time_difference)
 
 
 class ProcessAudio:
 
-    def __init__(self, chunk_seconds=5., peak_sensitivity=10, look_forward_time=200, min_peak_amplitude=None):
+    def __init__(self, chunk_seconds=5., peak_sensitivity=10, look_forward_time=200, min_peak_amplitude=None,
+                 pairing_mode='vectorized', sample_rate=DEFAULT_SAMPLE_RATE, spectrogram_engine='numpy',
+                 spectrogram_dtype='float64', fft_size=None, fft_hop=None, peak_neighborhood='diamond',
+                 peak_strategy=DEFAULT_PEAK_STRATEGY, hash_version=DEFAULT_HASH_VERSION, stage_hook=None):
         """
         Parent class for processing audio clips and extracting fingerprints via peaks
         in the spectrogram. This class does not accept input and should only be used
@@ -27,12 +87,52 @@ class ProcessAudio:
         to create hashes
         min_peak_amplitude: A filter to remove small peaks. Larger value makes fewer peaks,
         but may lower accuracy by removing useful peaks.
+        pairing_mode: 'vectorized' pairs peaks with a sorted binary search and hashes all
+        pairs at once. 'reference' uses the original per-peak loop; both give identical hashes.
+        sample_rate: samples per second of the audio being processed
+        spectrogram_engine: 'numpy' computes the spectrogram with batched rfft calls,
+        'matplotlib' uses matplotlib's specgram as a reference; both agree to rounding.
+        spectrogram_dtype: 'float64' or 'float32' for a spectrogram half the size
+        fft_size, fft_hop: frame size and hop in samples, None scales 4096/2048 to the
+        sample rate so columns and bins mean the same thing at every rate
+        peak_neighborhood: 'diamond' is the original iterated cross footprint, 'square'
+        is a (2 * peak_sensitivity + 1) box filtered with fast separable passes. They find
+        different peaks, so tracks and queries must use the same one.
+        peak_strategy: name of the method that picks peaks from the spectrogram, one of
+        peak_strategies.PEAK_STRATEGIES: 'local_maximum' (neighbourhood maxima, the default)
+        or 'weighted_centroid' (one spectral centroid per time column).
+        hash_version: 1 for the original hash of the peak differences, 2 for a packed hash
+        that also holds the anchor frequency, so each hash value is stored for far fewer
+        rows. Tracks and queries must use the same one.
+        stage_hook: optional callable, stage_hook(stage, seconds, **counts), told how long
+        each stage of process_track took and how much it produced, e.g.
+        instrumentation.StageTimings
         """
+        if pairing_mode not in PAIRING_MODES:
+            raise ValueError("pairing_mode must be one of {}".format(PAIRING_MODES))
+        if peak_neighborhood not in PEAK_NEIGHBORHOODS:
+            raise ValueError("peak_neighborhood must be one of {}".format(PEAK_NEIGHBORHOODS))
+        if int(hash_version) not in HASH_VERSIONS:
+            raise ValueError("hash_version must be one of {}".format(HASH_VERSIONS))
         self.chunk_seconds = chunk_seconds
         self.peak_sensitivity = int(peak_sensitivity)
         self.look_forward_time = look_forward_time
         self.min_peak_amplitude = min_peak_amplitude
+        self.pairing_mode = pairing_mode
+        self.peak_neighborhood = peak_neighborhood
+        self.peak_strategy = peak_strategy
+        self.peak_picker = get_peak_strategy(peak_strategy)
+        self.stage_hook = stage_hook
+        self.sample_rate = sample_rate
+        self.stft = make_engine(spectrogram_engine, sample_rate=sample_rate, fft_size=fft_size,
+                                fft_hop=fft_hop, dtype=spectrogram_dtype)
+        self.spectrogram_engine = spectrogram_engine
+        self.hash_version = int(hash_version)
+        if self.hash_version == 2 and self.stft.fft_size // 2 + 1 > 1 << HASH_FREQUENCY_BITS:
+            raise ValueError("fft_size {} has too many frequency rows for hash_version 2".format(
+                self.stft.fft_size))
         self.hashes = None
+        self.offsets = None
 
     def _generate_chunks_of_wav(self, raw_data):
         """
@@ -45,11 +145,44 @@ class ProcessAudio:
         samples_per_chunk = int(self.sample_rate * self.chunk_seconds)
         current_chunk_min = 0
         current_chunk_max = 0
-        while current_chunk_min < self.final_sample:
+        while current_chunk_max < self.final_sample:
             current_chunk_min = current_chunk_max
             current_chunk_max += samples_per_chunk
             yield raw_data[current_chunk_min:current_chunk_max]
 
+    def fingerprint_parameters(self):
+        """
+        The keyword arguments that reproduce this object's fingerprinting settings,
+        for building another fingerprinter that has to produce compatible hashes.
+        """
+        return {'chunk_seconds': self.chunk_seconds, 'peak_sensitivity': self.peak_sensitivity,
+                'look_forward_time': self.look_forward_time, 'min_peak_amplitude': self.min_peak_amplitude,
+                'pairing_mode': self.pairing_mode, 'sample_rate': self.sample_rate,
+                'spectrogram_engine': self.spectrogram_engine, 'spectrogram_dtype': self.stft.dtype.name,
+                'fft_size': self.stft.fft_size, 'fft_hop': self.stft.fft_hop,
+                'peak_neighborhood': self.peak_neighborhood, 'peak_strategy': self.peak_strategy,
+                'hash_version': self.hash_version}
+
+    def seconds_per_column(self):
+        """
+        Length of one spectrogram column, to turn time offsets into seconds.
+        """
+        return self.stft.fft_hop / float(self.sample_rate)
+
+    def track_details(self):
+        """
+        Return:
+        dict of what storage keeps about a track besides its hashes: its duration in
+        seconds and fingerprint_version, the hash format
+        """
+        return {'duration': self.final_sample / float(self.sample_rate), 'fingerprint_version': self.hash_version}
+
+    def index_settings(self):
+        """
+        The settings an index built with this fingerprinter is recorded with.
+        """
+        return index_settings(self.peak_strategy, self.peak_neighborhood, self.hash_version)
+
     def fft(self, data):
         """
         Computes the fourier transform of the provided data
@@ -68,11 +201,43 @@ class ProcessAudio:
         Input:
         data_chunk: array of 1D time series data
         Return:
-        Spectrogram (Matrix object) time on x axis, frequency on y axis
+        Spectrogram (Matrix object) time on x axis, frequency on y axis, in decibels
+        or linear power as the peak strategy expects
         """
-        spectrogram, _, _ = specgram(data_chunk, NFFT=4096, Fs=44100, noverlap=2048, window=window_hanning)
-        spectrogram = 10. * np.log10(spectrogram+1e-6)
-        return spectrogram
+        if self.peak_picker.spectrogram_scale == 'power':
+            return self.stft.power(data_chunk)
+        return self.stft.log_spectrogram(data_chunk)
+
+    def _neighborhood_footprint(self):
+        """
+        The neighbourhood a peak has to be the maximum of: a diamond of radius
+        peak_sensitivity for 'diamond', None for 'square' which maximum_filter then
+        runs as two separable 1D passes.
+        """
+        if self.peak_neighborhood == 'square':
+            return None
+        neighborhood_structure = generate_binary_structure(2, 1)
+        return ndi.iterate_structure(neighborhood_structure, self.peak_sensitivity)
+
+    def _peak_mask(self, spectrogram):
+        """
+        Boolean mask of the local maxima of spectrogram, before the amplitude filter.
+        """
+        neighborhood = self._neighborhood_footprint()
+        if neighborhood is None:
+            size = 2 * self.peak_sensitivity + 1
+            local_max = ndi.maximum_filter(spectrogram, size=size) == spectrogram
+            neighborhood = np.ones((size, size), dtype=bool)
+        else:
+            local_max = ndi.maximum_filter(spectrogram, footprint=neighborhood) == spectrogram
+
+        # The erosion only changes anything where the spectrogram is exactly zero, which
+        # a decibel spectrogram almost never is, so skip it when there are no zeros
+        background = (spectrogram == 0)
+        if not background.any():
+            return local_max
+        eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
+        return local_max != eroded_background
 
     def detect_peaks(self, spectrogram):
         """
@@ -87,16 +252,7 @@ class ProcessAudio:
         Returns a boolean mask of the peaks (i.e. 1 when
         the pixel's value is the neighborhood maximum, 0 otherwise)
         """
-
-        # define a connected neighborhood and find max values in neighborhood
-        neighborhood_structure = generate_binary_structure(2, 1)
-        neighborhood = ndi.iterate_structure(neighborhood_structure, self.peak_sensitivity)
-        local_max = ndi.filters.maximum_filter(spectrogram, footprint=neighborhood) == spectrogram
-
-        background = (spectrogram == 0)
-        eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
-
-        detected_peaks = local_max != eroded_background
+        detected_peaks = self._peak_mask(spectrogram)
 
         if self.min_peak_amplitude:
             filtered_peak_locations = self.filter_peaks_by_size(detected_peaks, spectrogram)
@@ -105,18 +261,89 @@ class ProcessAudio:
 
         return filtered_peak_locations
 
+    def extract_peaks(self, spectrogram):
+        """
+        Sparse version of detect_peaks + get_peak_locations. Works through the spectrogram
+        PEAK_BLOCK_COLUMNS time columns at a time, each with peak_sensitivity columns of
+        context on either side, so the full-size filter output and masks never exist,
+        and keeps only the coordinates and amplitudes of the peaks.
+
+        Input:
+        spectrogram: a matrix of time-frequency strengths
+        Return:
+        peak_locations: array of [frequency row, time column], 1 row per peak, in the
+        same order as get_peak_locations(detect_peaks(spectrogram))
+        amplitudes: spectrogram value at each peak
+        """
+        radius = self.peak_sensitivity
+        number_of_columns = spectrogram.shape[1]
+        rows, columns, amplitudes = [], [], []
+        for block_start in range(0, number_of_columns, PEAK_BLOCK_COLUMNS):
+            block_stop = min(block_start + PEAK_BLOCK_COLUMNS, number_of_columns)
+            slab_start = max(block_start - radius, 0)
+            slab = spectrogram[:, slab_start:min(block_stop + radius, number_of_columns)]
+            mask = self._peak_mask(slab)[:, block_start - slab_start:block_stop - slab_start]
+            block_rows, block_columns = np.nonzero(mask)
+            block_amplitudes = slab[block_rows, block_columns + block_start - slab_start]
+            if self.min_peak_amplitude:
+                loud_enough = block_amplitudes > self.min_peak_amplitude
+                block_rows, block_columns = block_rows[loud_enough], block_columns[loud_enough]
+                block_amplitudes = block_amplitudes[loud_enough]
+            rows.append(block_rows)
+            columns.append(block_columns + block_start)
+            amplitudes.append(block_amplitudes)
+
+        if not rows:
+            return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=spectrogram.dtype)
+        rows, columns, amplitudes = np.concatenate(rows), np.concatenate(columns), np.concatenate(amplitudes)
+        order = np.lexsort((columns, rows))
+        peak_locations = np.stack([rows[order], columns[order]], axis=1).astype(np.int64)
+        return peak_locations, amplitudes[order]
+
+    def find_peaks(self, spectrogram):
+        """
+        Picks peaks with the configured peak strategy.
+        Return:
+        peak_locations: array of [frequency row, time column], 1 row per peak
+        amplitudes: spectrogram value at each peak
+        """
+        return self.peak_picker.find_peaks(self, spectrogram)
+
     def process_track(self, track_data):
         """
         A process controller that will take given track data and compute all of the
-        relevant hashes.
+        relevant hashes, along with the time column of each hash's anchor peak in offsets.
         Input:
         track_data: Array of floats consisting of the amplitude at a given time.
         """
-        spectrogram = self.make_spectrogram(track_data)
-        peak_map = self.detect_peaks(spectrogram)
-        partner_peaks_map = self.find_partner_peaks(peak_map)
-        list_of_hashes = self.create_hashes(partner_peaks_map)
+        with timed_stage(self.stage_hook, 'spectrogram') as counts:
+            spectrogram = self.make_spectrogram(track_data)
+            counts.update(samples=len(track_data), frames=spectrogram.shape[1])
+        if self.pairing_mode == 'reference':
+            with timed_stage(self.stage_hook, 'peaks') as counts:
+                peak_map = self.peak_picker.peak_map(self, spectrogram)
+                counts['peaks'] = int(np.count_nonzero(peak_map))
+            with timed_stage(self.stage_hook, 'pairing') as counts:
+                partner_peaks_map = self.find_partner_peaks(peak_map)
+                counts['pairs'] = sum(len(partners) for partners in partner_peaks_map.values())
+            with timed_stage(self.stage_hook, 'hashing') as counts:
+                list_of_hashes = self.create_hashes(partner_peaks_map)
+                offsets = np.array([peak[1] for peak, partners in partner_peaks_map.items() for _ in partners],
+                                   dtype=np.int64)
+                counts['hashes'] = len(list_of_hashes)
+        else:
+            with timed_stage(self.stage_hook, 'peaks') as counts:
+                peak_locations, _ = self.find_peaks(spectrogram)
+                counts['peaks'] = len(peak_locations)
+            with timed_stage(self.stage_hook, 'pairing') as counts:
+                anchors, partners = self.find_partner_indices(peak_locations)
+                counts['pairs'] = len(anchors)
+            with timed_stage(self.stage_hook, 'hashing') as counts:
+                list_of_hashes = self.create_hashes_vectorized(peak_locations, anchors, partners)
+                offsets = peak_locations[anchors, 1].astype(np.int64)
+                counts['hashes'] = len(list_of_hashes)
         self.hashes = list_of_hashes
+        self.offsets = offsets
 
     def filter_peaks_by_size(self, peak_map, spectrogram):
         """
@@ -130,14 +357,7 @@ class ProcessAudio:
         Matrix of 0's (non peak) and 1's (peaks), but with small peaks removed based on an
         amplitude filter
         """
-
-        # TO DO: Refactor to use broadcasting. Needs thought on process.
-        peak_locations = self.get_peak_locations(peak_map)
-        filtered_peaks = np.zeros_like(peak_map)
-        for peak in peak_locations:
-            if spectrogram[peak[0],peak[1]] > self.min_peak_amplitude:
-                filtered_peaks[peak[0],peak[1]] = 1
-        return filtered_peaks
+        return peak_map.astype(bool) & (spectrogram > self.min_peak_amplitude)
 
     def create_hashes(self, partner_peaks_map):
         """
@@ -152,9 +372,12 @@ class ProcessAudio:
         list_of_hashes = []
         for peak, partners in partner_peaks_map.items():
             for partner in partners:
-                x_difference = partner[0] - peak[0]
-                y_difference = partner[1] - peak[1]
-                hash = self.hash_function(x_difference, y_difference)
+                if self.hash_version == 2:
+                    hash = pack_hashes(int(peak[0]), int(partner[0]), int(partner[1] - peak[1]))
+                else:
+                    x_difference = partner[0] - peak[0]
+                    y_difference = partner[1] - peak[1]
+                    hash = self.hash_function(x_difference, y_difference)
                 list_of_hashes.append(hash)
         return list_of_hashes
 
@@ -206,18 +429,73 @@ class ProcessAudio:
                 partner_peak_map[tuple(peak)] = list_of_partners
         return partner_peak_map
 
+    def find_partner_indices(self, peak_locations):
+        """
+        Vectorized replacement for find_partner_peaks. Sorts the peaks on the first coordinate
+        and uses a binary search to find the start and end of each peak's forward window, so
+        no per-peak mask over every other peak is needed. Pairs come out in the same order
+        that find_partner_peaks + create_hashes would visit them.
+
+        Inputs:
+        peak_locations: array of peak coordinates, 1 row per peak (from get_peak_locations)
+        Returns:
+        anchors, partners: integer arrays of row indices into peak_locations, one entry per pair
+        """
+        order = np.argsort(peak_locations[:, 0], kind='stable')
+        sorted_keys = peak_locations[order, 0]
+        anchors, partners = window_matches(sorted_keys, sorted_keys, 0, self.look_forward_time)
+
+        # get_peak_locations already returns peaks sorted on the first coordinate, so the
+        # sorted positions are the row indices. Otherwise map back and restore the reference
+        # loop's order: anchors in their original order, then partners in their original order.
+        if np.any(order != np.arange(len(order))):
+            anchors = order[anchors]
+            partners = order[partners]
+            pair_order = np.lexsort((partners, anchors))
+            anchors, partners = anchors[pair_order], partners[pair_order]
+        return anchors, partners
+
+    def create_hashes_vectorized(self, peak_locations, anchors, partners):
+        """
+        Computes the hash of every (anchor, partner) pair as a single NumPy expression.
+        Inputs:
+        peak_locations: array of peak coordinates, 1 row per peak
+        anchors, partners: index arrays from find_partner_indices
+        Return:
+        int64 array of all hashes for the processed track
+        """
+        peak_locations = peak_locations.astype(np.int64)
+        return self.hash_peak_pairs(peak_locations[anchors], peak_locations[partners])
+
+    def hash_peak_pairs(self, anchor_peaks, partner_peaks):
+        """
+        Hashes pairs of peaks in the format picked by hash_version.
+        Inputs:
+        anchor_peaks, partner_peaks: int64 arrays of [frequency row, time column], one row
+        per pair
+        Return:
+        int64 array of hashes
+        """
+        if self.hash_version == 2:
+            return pack_hashes(anchor_peaks[:, 0], partner_peaks[:, 0], partner_peaks[:, 1] - anchor_peaks[:, 1])
+        x_difference = partner_peaks[:, 0] - anchor_peaks[:, 0]
+        y_difference = partner_peaks[:, 1] - anchor_peaks[:, 1]
+        return self.hash_function(x_difference, y_difference)
+
     def _plot_spectrograms(self, spectrogram):
         """
         Diagnostic method that plots the spectrogram and the
-        peaks found from that spectrogram.
+        peaks found from that spectrogram. matplotlib is only
+        imported here so fingerprinting never pays for it.
 
         Input:
         spectrogram: numpy matrix of time-frequency strength
         """
+        import matplotlib.pyplot as plt
         fig, axes = plt.subplots(2,1, dpi=150)
 
         axes[0].imshow(spectrogram[::-1])
-        axes[1].imshow(self.detect_peaks(spectrogram)[::-1])
+        axes[1].imshow(self.peak_picker.peak_map(self, spectrogram)[::-1])
         axes[0].set_aspect('equal', adjustable='box')
         axes[1].set_aspect('equal', adjustable='box')
         axes[0].set_title("Left Channel Spectrogram")
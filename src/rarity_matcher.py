@@ -0,0 +1,78 @@
+from collections import Counter
+import numpy as np
+from alignment import score_alignment
+from hash_matcher import unique_hashes
+from instrumentation import timed_stage
+from zwazam_settings import *
+
+
+def _count_ranking(rows):
+    scores = Counter(track for _, track in set((hash, track) for hash, track, _ in rows))
+    return sorted(scores.items(), key=lambda score: (-score[1], score[0]))
+
+
+def match_by_rarity(lookup_postings, document_frequencies, hashes, offsets=None, top_k=None,
+                    batch_size=RARITY_BATCH_SIZE, tolerance=ALIGNMENT_TOLERANCE_COLUMNS, stage_hook=None):
+    """
+    Scores a query clip while looking up as few of its hashes as possible. The distinct
+    hashes are looked up in batches from the rarest to the most common (by the number of
+    tracks each is stored for), so the cheap, telling hashes come first and the long
+    posting lists last. Every hash still to be looked up can raise a track's count by at
+    most one. Scoring by alignment, each occurrence in the clip can add at most
+    2 * tolerance + 1 to a track's score, one per stored offset that falls in the scored
+    window. As soon as the leader is further ahead of the runner-up than that, no
+    remaining hash can change the winner and the rest are skipped. Hashes that
+    are not in the frequency table are treated as the rarest; the table only decides the
+    order, never the result.
+
+    Input:
+    lookup_postings: callable taking a list of hashes and returning their
+    (hash, track_name, time_offset) rows, e.g. StorageSession.lookup_postings
+    document_frequencies: callable taking a list of hashes and returning a dict of
+    hash -> number of tracks it is stored for
+    hashes: list or array of hashes for the query clip
+    offsets: time offset of each hash to score by alignment, None to count shared hashes
+    top_k: how many tracks to return, None returns every track with a match
+    batch_size: distinct hashes per lookup
+    tolerance: how many columns either side of an offset difference also count for it, see
+    alignment.score_alignment
+    stage_hook: optional callable told how long the matching took, see
+    instrumentation.timed_stage
+    Return:
+    list of tuples from best to worst match, each the ranking tuple of the scoring used,
+    (track_name, match_count) or (track_name, aligned_score, offset, match_count), followed
+    by the highest score the track could have reached had every hash been looked up
+    """
+    with timed_stage(stage_hook, 'lookup') as counts:
+        query_hashes = np.asarray(hashes, dtype=np.int64)
+        distinct_hashes = unique_hashes(query_hashes)
+        frequencies = document_frequencies(distinct_hashes) if distinct_hashes else {}
+        lookup_order = sorted(distinct_hashes, key=lambda hash: (frequencies.get(hash, 0), hash))
+        if offsets is None:
+            remaining = len(distinct_hashes)
+        else:
+            votes_per_occurrence = 2 * tolerance + 1
+            occurrences = Counter(query_hashes.tolist())
+            remaining = votes_per_occurrence * len(query_hashes)
+
+        rows = []
+        ranking = []
+        looked_up = 0
+        batches = 0
+        while looked_up < len(lookup_order):
+            batch = lookup_order[looked_up:looked_up + batch_size]
+            rows.extend(lookup_postings(batch))
+            looked_up += len(batch)
+            batches += 1
+            if offsets is None:
+                remaining -= len(batch)
+                ranking = _count_ranking(rows)
+            else:
+                remaining -= votes_per_occurrence * sum(occurrences[hash] for hash in batch)
+                ranking = score_alignment(query_hashes, offsets, rows, tolerance=tolerance)
+            leader_score = ranking[0][1] if ranking else 0
+            runner_up_score = ranking[1][1] if len(ranking) > 1 else 0
+            if leader_score - runner_up_score > remaining:
+                break
+        counts.update(hashes=len(distinct_hashes), looked_up=looked_up, batches=batches, rows=len(rows))
+    return [match + (match[1] + remaining,) for match in ranking[:top_k]]
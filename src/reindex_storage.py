@@ -0,0 +1,109 @@
+import os
+import sys
+import numpy as np
+from fingerprint_cache import open_fingerprint_cache
+from job_queue import require_hashes
+from parallel_ingest import run_parallel_ingest
+from process_audio import HASH_VERSIONS, index_settings
+from storage import open_storage
+from wav_fingerprint import WavFingerprint
+from zwazam_settings import *
+
+
+def posting_statistics(storage):
+    """
+    Return:
+    (number of stored rows, number of distinct hashes)
+    """
+    hash_chunks = [np.array([row[1] for row in rows], dtype=np.int64) for rows in storage.iter_postings()]
+    if not hash_chunks:
+        return 0, 0
+    hashes = np.concatenate(hash_chunks)
+    return len(hashes), len(np.unique(hashes))
+
+
+def report_postings(label, storage):
+    rows, distinct_hashes = posting_statistics(storage)
+    print("{}: {} rows, {} distinct hashes, {:.1f} rows per hash".format(
+        label, rows, distinct_hashes, rows / max(distinct_hashes, 1)))
+
+
+def reindex(audio_path, target_url, hash_version=max(HASH_VERSIONS), workers=None, source_url=STORAGE_URL):
+    """
+    Rebuilds every track of the source storage in the target storage with another hash
+    format. Hashes cannot be converted from one format to another, so each track is
+    fingerprinted again from its wav file, found in audio_path under its stored name.
+    Peak picking settings are carried over from the source. Tracks already in the target
+    are skipped, so an interrupted run can be started again; a target holding a different
+    format is refused.
+    """
+    source = open_storage(source_url)
+    source_settings = source.fingerprint_settings()
+    tracks = source.list_tracks()
+    report_postings("Source", source)
+    source.close()
+
+    settings = index_settings(source_settings['peak_strategy'], source_settings['peak_neighborhood'],
+                              hash_version)
+    target = open_storage(target_url)
+    target.check_fingerprint_settings(settings, record=True)
+    done_tracks = set(target.list_tracks())
+
+    files = []
+    for track_name in tracks:
+        file_path = os.path.join(audio_path, track_name)
+        if track_name in done_tracks:
+            continue
+        if not os.path.exists(file_path):
+            print("No audio for", track_name, "at", file_path)
+            continue
+        files.append(file_path)
+    print("Reindexing {} of {} tracks with hash_version {}".format(len(files), len(tracks), hash_version))
+
+    fingerprint_kwargs = dict(settings, chunked=CHUNKED_WAV_INGEST, cache=open_fingerprint_cache(),
+                              min_peak_amplitude=MIN_FINGER_PRINT_WAV)
+    with target.bulk_writer(tracks_per_commit=TRACKS_PER_COMMIT) as writer:
+        if workers is None:
+            for file_path in files:
+                print("Working on File", file_path)
+                try:
+                    track = require_hashes(WavFingerprint(file_path, **fingerprint_kwargs))
+                except Exception as error:
+                    print("Failed to fingerprint", file_path, "{}: {}".format(type(error).__name__, error))
+                    continue
+                writer.add_track(os.path.basename(file_path), track.hashes, track.offsets, track.track_details())
+        else:
+            for file_path, error in run_parallel_ingest(files, writer, workers=workers or None,
+                                                        fingerprint_kwargs=fingerprint_kwargs):
+                print("Failed to fingerprint", file_path, error)
+    for track_name, error in writer.failed_tracks:
+        print("Failed to store", track_name, error)
+    print(writer.report())
+    if RARITY_ORDERED_MATCHING and writer.rows_written:
+        target.collect_document_frequencies()
+    report_postings("Target", target)
+    target.close()
+
+
+def print_help_message():
+    print("Usage:")
+    print("python reindex_storage.py path_to_wav_file_directory target_storage_url [hash_version] [number_of_workers]")
+    print("Copies every track of the ZWAZAM_STORAGE storage into the target storage, fingerprinted again")
+    print("with hash_version (default {}). Point ZWAZAM_STORAGE and HASH_VERSION at the target".format(
+        max(HASH_VERSIONS)))
+    print("once it is done. Giving a number of workers fingerprints files in parallel, 0 uses every core.")
+    exit(0)
+
+
+def parse_args(user_arguments):
+    if len(user_arguments) > 1 and user_arguments[1] == "-h":
+        print_help_message()
+    if len(user_arguments) < 3 or len(user_arguments) > 5:
+        raise IndexError("Must provide location for files and the target storage. -h' for help.")
+    hash_version = int(user_arguments[3]) if len(user_arguments) > 3 else max(HASH_VERSIONS)
+    workers = int(user_arguments[4]) if len(user_arguments) > 4 else None
+    reindex(user_arguments[1], user_arguments[2], hash_version=hash_version, workers=workers)
+
+
+if __name__ == "__main__":
+    requested_action = parse_args(sys.argv)
@@ -0,0 +1,145 @@
+import threading
+from hash_matcher import unique_hashes
+from zwazam_settings import *
+
+
+class _Batch:
+
+    def __init__(self):
+        self.hashes = set()
+        self.requests = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.rows = {}
+        self.error = None
+
+
+class LookupCoalescer:
+
+    def __init__(self, window_seconds=MATCH_COALESCE_WINDOW_MS / 1000., max_requests=MATCH_COALESCE_MAX_REQUESTS):
+        """
+        Merges the storage lookups of concurrent requests. The first request to look
+        something up opens a batch and waits up to window_seconds for others to join it,
+        or until max_requests have; it then runs one lookup for the distinct hashes of the
+        whole batch and hands every request the rows for its own hashes, so at peak traffic
+        one connection serves several clips. Each lookup merged waits at most
+        window_seconds longer than it would alone. Postings and hash frequencies are
+        batched separately. Thread safe.
+
+        Input:
+        window_seconds: longest a batch waits for more requests
+        max_requests: requests in a batch that close it at once
+        """
+        self.window_seconds = window_seconds
+        self.max_requests = max(int(max_requests), 1)
+        self.open_batches = {}
+        self.batches = 0
+        self.requests = 0
+        self.hashes_requested = 0
+        self.hashes_fetched = 0
+        self.lock = threading.Lock()
+
+    def _close(self, kind, batch):
+        if self.open_batches.get(kind) is batch:
+            del self.open_batches[kind]
+        batch.full.set()
+
+    def _lookup(self, kind, hashes, fetch):
+        """
+        Input:
+        kind: name of the lookup, only requests of the same kind share a batch
+        hashes: distinct hashes of one request
+        fetch: callable taking a list of hashes and returning rows that start with the
+        hash; only called for the request that opened the batch
+        Return:
+        list of the rows for hashes
+        """
+        if not hashes:
+            return []
+        with self.lock:
+            batch = self.open_batches.get(kind)
+            opened = batch is None
+            if opened:
+                batch = self.open_batches[kind] = _Batch()
+            batch.hashes.update(hashes)
+            batch.requests += 1
+            self.requests += 1
+            self.hashes_requested += len(hashes)
+            if batch.requests >= self.max_requests:
+                self._close(kind, batch)
+
+        if opened:
+            batch.full.wait(self.window_seconds)
+            with self.lock:
+                self._close(kind, batch)
+                self.batches += 1
+                self.hashes_fetched += len(batch.hashes)
+            try:
+                for row in fetch(sorted(batch.hashes)):
+                    batch.rows.setdefault(row[0], []).append(row)
+            except Exception as error:
+                batch.error = error
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return [row for hash in hashes for row in batch.rows.get(hash, ())]
+
+    def lookup_postings(self, hashes, storage):
+        """
+        Same result as storage.lookup_postings, looked up together with the other requests
+        of the batch.
+        Input:
+        hashes: list or array of hashes
+        storage: FingerprintStorage to look up in if this request runs the batch's lookup
+        """
+        return self._lookup('postings', unique_hashes(hashes), storage.lookup_postings)
+
+    def document_frequencies(self, hashes, storage):
+        """
+        Same result as storage.document_frequencies, looked up together with the other
+        requests of the batch.
+        """
+        rows = self._lookup('frequencies', unique_hashes(hashes),
+                            lambda batch_hashes: storage.document_frequencies(batch_hashes).items())
+        return dict(rows)
+
+    def session(self, storage):
+        """
+        Return:
+        CoalescedSession for one request, to pass wherever a StorageSession is only used
+        for lookups, e.g. to PostingCache
+        """
+        return CoalescedSession(self, storage)
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches, 'requests': self.requests,
+                    'hashes_requested': self.hashes_requested, 'hashes_fetched': self.hashes_fetched}
+
+
+class CoalescedSession:
+
+    def __init__(self, coalescer, storage):
+        """
+        The lookup half of a StorageSession for one request, with every lookup sent
+        through a LookupCoalescer. Each lookup runs in a session of its own rather than the
+        request's, so no request holds a connection while it waits for a batch another
+        request is running. Every lookup pays up to the coalescing window, so callers
+        should look a clip's hashes up at once rather than in rarity batches.
+
+        Input:
+        coalescer: LookupCoalescer shared by the requests
+        storage: FingerprintStorage the merged lookups borrow a connection from
+        """
+        self.coalescer = coalescer
+        self.storage = storage
+
+    def lookup_postings(self, hashes):
+        return self.coalescer.lookup_postings(hashes, self.storage)
+
+    def document_frequencies(self, hashes):
+        return self.coalescer.document_frequencies(hashes, self.storage)
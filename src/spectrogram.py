@@ -0,0 +1,133 @@
+import numpy as np
+import scipy.fft
+
+REFERENCE_SAMPLE_RATE = 44100
+REFERENCE_FFT_SIZE = 4096
+REFERENCE_FFT_HOP = 2048
+SPECTROGRAM_ENGINES = ('numpy', 'matplotlib')
+# Frames transformed per rfft call, bounds the temporary complex array
+FRAMES_PER_BLOCK = 256
+
+_window_cache = {}
+
+
+def hanning_window(size, dtype=np.float64):
+    """
+    Hanning window of the given size, computed once per (size, dtype) and shared.
+    """
+    key = (size, np.dtype(dtype).str)
+    if key not in _window_cache:
+        window = np.hanning(size).astype(dtype)
+        window.flags.writeable = False
+        _window_cache[key] = window
+    return _window_cache[key]
+
+
+class SpectrogramEngine:
+
+    def __init__(self, sample_rate=REFERENCE_SAMPLE_RATE, fft_size=None, fft_hop=None, dtype=np.float64):
+        """
+        Computes the log power spectrogram used for fingerprinting with plain NumPy: the
+        signal is cut into overlapping frames with a strided view (no copy), and blocks
+        of frames are windowed and transformed with one batched rfft each. The result
+        is the same PSD as matplotlib's specgram (Hanning window, no detrending, one
+        sided, scaled by frequency) without going through matplotlib.
+
+        By default the frame size and hop scale with the sample rate, so every file gets
+        the same frequency bin width and the same time per column as 44.1kHz audio with
+        4096 sample frames, and hashes from different sample rates line up.
+
+        Input:
+        sample_rate: samples per second of the audio
+        fft_size: samples per frame, None scales 4096 to the sample rate
+        fft_hop: samples between frame starts, None scales 2048 to the sample rate
+        dtype: float type of the output, np.float32 halves the memory
+        """
+        scale = sample_rate / float(REFERENCE_SAMPLE_RATE)
+        self.sample_rate = sample_rate
+        self.fft_size = int(fft_size or max(int(round(REFERENCE_FFT_SIZE * scale)), 2))
+        self.fft_hop = int(fft_hop or max(int(round(REFERENCE_FFT_HOP * scale)), 1))
+        if self.fft_hop > self.fft_size:
+            raise ValueError("fft_hop can not be larger than fft_size")
+        self.dtype = np.dtype(dtype)
+        self.window = hanning_window(self.fft_size, self.dtype)
+        self.psd_scale = 1. / (sample_rate * float(np.sum(self.window.astype(np.float64) ** 2)))
+
+    def frame_count(self, number_of_samples):
+        """
+        How many frames a signal of number_of_samples gives. Signals shorter than one
+        frame are zero padded to a single frame.
+        """
+        if number_of_samples < self.fft_size:
+            return 1
+        return (number_of_samples - self.fft_size) // self.fft_hop + 1
+
+    def frames(self, samples):
+        """
+        Read-only strided view of samples with one frame per row.
+        """
+        samples = np.asarray(samples)
+        if len(samples) < self.fft_size:
+            samples = np.concatenate([samples, np.zeros(self.fft_size - len(samples), dtype=samples.dtype)])
+        samples = np.ascontiguousarray(samples)
+        return np.lib.stride_tricks.as_strided(samples, shape=(self.frame_count(len(samples)), self.fft_size),
+                                               strides=(samples.strides[0] * self.fft_hop, samples.strides[0]),
+                                               writeable=False)
+
+    def power(self, samples):
+        """
+        Power spectral density of samples.
+        Return:
+        array of shape (fft_size // 2 + 1, frames), frequency on the first axis
+        """
+        frames = self.frames(samples)
+        power = np.empty((len(frames), self.fft_size // 2 + 1), dtype=self.dtype)
+        for start in range(0, len(frames), FRAMES_PER_BLOCK):
+            block = frames[start:start + FRAMES_PER_BLOCK].astype(self.dtype) * self.window
+            spectrum = scipy.fft.rfft(block, axis=1)
+            np.multiply(spectrum.real, spectrum.real, out=power[start:start + len(block)])
+            power[start:start + len(block)] += spectrum.imag * spectrum.imag
+        # One sided spectrum: every bin except DC (and Nyquist for even sizes) doubles
+        if self.fft_size % 2:
+            power[:, 1:] *= 2
+        else:
+            power[:, 1:-1] *= 2
+        power *= self.psd_scale
+        return power.T
+
+    def log_spectrogram(self, samples):
+        """
+        Spectrogram in decibels, 10 * log10(psd + 1e-6), as used by detect_peaks.
+        """
+        spectrogram = self.power(samples)
+        spectrogram += 1e-6
+        np.log10(spectrogram, out=spectrogram)
+        spectrogram *= 10.
+        return spectrogram
+
+
+class MatplotlibSpectrogramEngine(SpectrogramEngine):
+
+    def power(self, samples):
+        """
+        Reference implementation through matplotlib's specgram, kept to check the NumPy
+        engine against.
+        """
+        from matplotlib.mlab import specgram, window_hanning
+        samples = np.asarray(samples)
+        if len(samples) < self.fft_size:
+            samples = np.concatenate([samples, np.zeros(self.fft_size - len(samples), dtype=samples.dtype)])
+        power, _, _ = specgram(samples, NFFT=self.fft_size, Fs=self.sample_rate,
+                               noverlap=self.fft_size - self.fft_hop, window=window_hanning)
+        return power.astype(self.dtype, copy=False)
+
+
+def make_engine(engine='numpy', **kwargs):
+    """
+    Builds the spectrogram engine named by engine, one of SPECTROGRAM_ENGINES.
+    """
+    if engine not in SPECTROGRAM_ENGINES:
+        raise ValueError("spectrogram_engine must be one of {}".format(SPECTROGRAM_ENGINES))
+    if engine == 'matplotlib':
+        return MatplotlibSpectrogramEngine(**kwargs)
+    return SpectrogramEngine(**kwargs)
@@ -0,0 +1,687 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+from contextlib import contextmanager
+from alignment import lookup_alignment
+from bulk_insert import BulkHashWriter, SQLiteHashWriter
+from hash_index import HashIndex, NO_OFFSET
+from hash_matcher import fetch_document_frequencies, fetch_postings, match_hashes, unique_hashes
+from instrumentation import timed_stage
+from rarity_matcher import match_by_rarity
+from zwazam_settings import *
+
+SQL_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sql_scripts")
+SQLITE_SCHEMA_FILE = os.path.join(SQL_SCRIPTS_DIR, "create_zwazam_table_sqlite.sql")
+MIGRATION_FILE = os.path.join(SQL_SCRIPTS_DIR, "migrate_to_tracks_and_postings.sql")
+
+SQLITE_MATCH_QUERY = """
+    SELECT tracks.name, matches.match_count
+    FROM (
+        SELECT postings.track_id, count(DISTINCT postings.hash) AS match_count
+        FROM postings JOIN query_hashes ON postings.hash = query_hashes.hash
+        GROUP BY postings.track_id
+        ORDER BY match_count DESC
+        LIMIT ?
+    ) AS matches JOIN tracks ON tracks.id = matches.track_id
+    ORDER BY matches.match_count DESC
+"""
+SQLITE_POSTINGS_QUERY = """
+    SELECT postings.hash, tracks.name, NULLIF(postings.time_offset, -1)
+    FROM postings JOIN query_hashes ON postings.hash = query_hashes.hash
+    JOIN tracks ON tracks.id = postings.track_id
+"""
+EXPORT_QUERY = """
+    SELECT tracks.name, postings.hash, NULLIF(postings.time_offset, -1)
+    FROM postings JOIN tracks ON tracks.id = postings.track_id
+"""
+EXPORT_TRACK_ID_QUERY = "SELECT track_id, hash, NULLIF(time_offset, -1) FROM postings"
+SQLITE_FREQUENCY_QUERY = """
+    SELECT zwazam_hash_frequency.hash, zwazam_hash_frequency.track_count
+    FROM zwazam_hash_frequency JOIN query_hashes ON zwazam_hash_frequency.hash = query_hashes.hash
+"""
+# Same statement for both dialects, run in one transaction so readers never see the table half built
+COLLECT_FREQUENCIES_STATEMENTS = (
+    "DELETE FROM zwazam_hash_frequency",
+    "INSERT INTO zwazam_hash_frequency (hash, track_count) SELECT hash, count(DISTINCT track_id) FROM postings GROUP BY hash",
+)
+
+METADATA_QUERY = "SELECT key, value FROM zwazam_metadata"
+# Fingerprints stored before their settings were recorded were all made with these
+UNRECORDED_FINGERPRINT_SETTINGS = {'peak_strategy': 'local_maximum', 'peak_neighborhood': 'diamond',
+                                   'hash_version': 1}
+
+
+class StorageBusyError(Exception):
+    """
+    Raised when no database connection frees up within the pool timeout.
+    """
+    pass
+
+
+class IncompatibleFingerprintError(ValueError):
+    """
+    Raised when hashes are stored in or looked up against fingerprints that were made
+    with different peak picking settings or hash format, which could never match.
+    """
+    pass
+
+
+def _settings_to_record(recorded, settings, has_fingerprints=True):
+    """
+    Compares settings with the recorded settings of a storage, treating settings that
+    were never recorded as UNRECORDED_FINGERPRINT_SETTINGS when fingerprints are stored.
+    An empty storage takes any settings.
+    Return:
+    dict of the settings that are not recorded yet
+    """
+    stored = dict(UNRECORDED_FINGERPRINT_SETTINGS if has_fingerprints else {}, **recorded)
+    for key, value in settings.items():
+        if key in stored and str(stored[key]) != str(value):
+            raise IncompatibleFingerprintError("Stored fingerprints use {}={}, not {}".format(
+                key, stored[key], value))
+    return {key: str(value) for key, value in settings.items() if key not in recorded}
+
+
+class StorageSession:
+
+    writer_class = None
+    set_metadata_query = None
+
+    def __init__(self, connection):
+        """
+        Parent class for a unit of work on one database connection. Everything done
+        through a session runs on the same connection and, for the SQL backends, in
+        the same transaction, which the storage commits or rolls back when the session
+        ends. Children implement _lookup_hashes for their SQL dialect.
+
+        Input:
+        connection: open DB-API connection owned by the session
+        """
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def insert_fingerprints(self, track_name, hashes, offsets=None, details=None):
+        """
+        Stores the postings of one track as part of the session's transaction.
+        Input:
+        track_name: name of the track
+        hashes: list or array of hashes for the track
+        offsets: time offset of each hash, None if not known
+        details: optional dict with the track's duration and fingerprint_version, see
+        ProcessAudio.track_details
+        Return:
+        number of new rows stored
+        """
+        writer = self.writer_class(self.connection, tracks_per_commit=0)
+        inserted_rows = writer.add_track(track_name, hashes, offsets, details)
+        if writer.failed_tracks:
+            raise RuntimeError("Could not store {}: {}".format(*writer.failed_tracks[0]))
+        return inserted_rows
+
+    def lookup_hashes(self, hashes, top_k=None, stage_hook=None):
+        """
+        Counts, per track, how many of the query clip's distinct hashes are stored for
+        that track, reporting the time and row counts to stage_hook as the 'lookup' stage.
+        """
+        with timed_stage(stage_hook, 'lookup') as counts:
+            matches = self._lookup_hashes(hashes, top_k=top_k)
+            counts.update(hashes=len(hashes), rows=len(matches))
+        return matches
+
+    def _lookup_hashes(self, hashes, top_k=None):
+        raise NotImplementedError
+
+    def lookup_postings(self, hashes):
+        """
+        Return:
+        list of (hash, track_name, time_offset), one per stored row with one of the
+        distinct hashes
+        """
+        raise NotImplementedError
+
+    def lookup_alignment(self, hashes, offsets, top_k=None, stage_hook=None):
+        """
+        Scores tracks by how many of the query clip's hashes line up in time, see
+        alignment.score_alignment.
+        """
+        return lookup_alignment(self, hashes, offsets, top_k=top_k, stage_hook=stage_hook)
+
+    def document_frequencies(self, hashes):
+        """
+        Return:
+        dict of hash -> number of tracks it is stored for, as last collected by
+        collect_document_frequencies; hashes stored since then may be missing
+        """
+        raise NotImplementedError
+
+    def collect_document_frequencies(self):
+        """
+        Rebuilds the table of how many tracks each hash is stored for, which
+        match_by_rarity uses to look up rare hashes first.
+        Return:
+        number of distinct hashes counted
+        """
+        for statement in COLLECT_FREQUENCIES_STATEMENTS:
+            self.cursor.execute(statement)
+        self.cursor.execute("SELECT count(*) FROM zwazam_hash_frequency")
+        return self.cursor.fetchone()[0]
+
+    def match_by_rarity(self, hashes, offsets=None, top_k=None, stage_hook=None):
+        """
+        Looks up the query clip's hashes from the rarest up and stops once the best track
+        can no longer be overtaken, see rarity_matcher.match_by_rarity.
+        """
+        return match_by_rarity(self.lookup_postings, self.document_frequencies, hashes, offsets=offsets,
+                               top_k=top_k, stage_hook=stage_hook)
+
+    def list_tracks(self):
+        self.cursor.execute("SELECT name FROM tracks ORDER BY name")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def track_table(self):
+        self.cursor.execute("SELECT id, name FROM tracks")
+        return dict(self.cursor.fetchall())
+
+    def get_metadata(self):
+        self.cursor.execute(METADATA_QUERY)
+        return dict(self.cursor.fetchall())
+
+    def set_metadata(self, values):
+        self.cursor.executemany(self.set_metadata_query, list(values.items()))
+
+    def check_fingerprint_settings(self, settings, record=False):
+        """
+        Raises IncompatibleFingerprintError if settings differ from the settings the
+        stored fingerprints were made with.
+        Input:
+        settings: dict from ProcessAudio.index_settings()
+        record: also record any of the settings that are not recorded yet, for use
+        before storing tracks
+        """
+        to_record = _settings_to_record(self.get_metadata(), settings, self.has_fingerprints())
+        if record and to_record:
+            self.set_metadata(to_record)
+
+    def has_fingerprints(self):
+        self.cursor.execute("SELECT 1 FROM postings LIMIT 1")
+        return self.cursor.fetchone() is not None
+
+
+class PostgresSession(StorageSession):
+
+    writer_class = BulkHashWriter
+    set_metadata_query = """
+        INSERT INTO zwazam_metadata (key, value) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    """
+
+    def _lookup_hashes(self, hashes, top_k=None):
+        return match_hashes(self.cursor, hashes, top_k=top_k)
+
+    def lookup_postings(self, hashes):
+        return fetch_postings(self.cursor, hashes)
+
+    def document_frequencies(self, hashes):
+        return fetch_document_frequencies(self.cursor, hashes)
+
+
+class SQLiteSession(StorageSession):
+
+    writer_class = SQLiteHashWriter
+    set_metadata_query = """
+        INSERT INTO zwazam_metadata (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    """
+
+    def _load_query_hashes(self, hashes):
+        """
+        Fills the temporary query_hashes table with the distinct hashes.
+        Return:
+        False if there are no hashes to look up
+        """
+        query_hashes = unique_hashes(hashes)
+        if not query_hashes:
+            return False
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS query_hashes (hash integer PRIMARY KEY)")
+        self.cursor.execute("DELETE FROM query_hashes")
+        self.cursor.executemany("INSERT INTO query_hashes (hash) VALUES (?)", ((hash,) for hash in query_hashes))
+        return True
+
+    def _lookup_hashes(self, hashes, top_k=None):
+        if not self._load_query_hashes(hashes):
+            return []
+        self.cursor.execute(SQLITE_MATCH_QUERY, (-1 if top_k is None else top_k,))
+        return self.cursor.fetchall()
+
+    def lookup_postings(self, hashes):
+        if not self._load_query_hashes(hashes):
+            return []
+        self.cursor.execute(SQLITE_POSTINGS_QUERY)
+        return self.cursor.fetchall()
+
+    def document_frequencies(self, hashes):
+        if not self._load_query_hashes(hashes):
+            return {}
+        self.cursor.execute(SQLITE_FREQUENCY_QUERY)
+        return dict(self.cursor.fetchall())
+
+
+class FingerprintStorage:
+
+    def __init__(self):
+        """
+        Parent class for every place fingerprints can live. Gives the CLI scripts and the
+        API one interface for storing a track's hashes, looking up a clip's hashes and
+        listing the stored tracks, so they do not need to know which database is behind
+        it. Each call runs in its own session; use session() directly to group several
+        calls on one connection. Children implement session, bulk_writer and
+        iter_postings.
+        """
+        pass
+
+    def session(self):
+        """
+        Context manager yielding a StorageSession. The session's work is committed when
+        the block finishes and rolled back if it raises. Raises StorageBusyError if no
+        connection is free in time.
+        """
+        raise NotImplementedError
+
+    def insert_fingerprints(self, track_name, hashes, offsets=None, details=None):
+        """
+        Stores the postings of one track.
+        Input:
+        track_name: name of the track
+        hashes: list or array of hashes for the track
+        offsets: time offset of each hash, None if not known
+        details: optional dict with the track's duration and fingerprint_version, see
+        ProcessAudio.track_details
+        Return:
+        number of new rows stored
+        """
+        with self.session() as session:
+            return session.insert_fingerprints(track_name, hashes, offsets, details)
+
+    def bulk_writer(self, tracks_per_commit=TRACKS_PER_COMMIT):
+        """
+        Context manager yielding a writer with an
+        add_track(track_name, hashes, offsets, details) method for loading many tracks in
+        a row.
+        """
+        raise NotImplementedError
+
+    def lookup_hashes(self, hashes, top_k=None, stage_hook=None):
+        """
+        Counts, per track, how many of the query clip's distinct hashes are stored for
+        that track.
+        Input:
+        hashes: list or array of hashes for the query clip
+        top_k: how many tracks to return, None returns every track with a match
+        stage_hook: optional callable told how long the lookup took, see
+        instrumentation.timed_stage
+        Return:
+        list of (track_name, match_count) sorted from best to worst match
+        """
+        with self.session() as session:
+            return session.lookup_hashes(hashes, top_k=top_k, stage_hook=stage_hook)
+
+    def lookup_postings(self, hashes):
+        """
+        Fetches the stored rows for a set of hashes, uncounted.
+        Input:
+        hashes: list or array of hashes
+        Return:
+        list of (hash, track_name, time_offset), one per stored row
+        """
+        with self.session() as session:
+            return session.lookup_postings(hashes)
+
+    def lookup_alignment(self, hashes, offsets, top_k=None, stage_hook=None):
+        """
+        Scores tracks by how many of the query clip's hashes line up in time.
+        Input:
+        hashes, offsets: the query clip's hashes and the time column of each
+        top_k: how many tracks to return, None returns every track with a match
+        stage_hook: optional callable told how long the lookup and scoring took
+        Return:
+        list of (track_name, aligned_score, offset, match_count), see
+        alignment.score_alignment
+        """
+        with self.session() as session:
+            return session.lookup_alignment(hashes, offsets, top_k=top_k, stage_hook=stage_hook)
+
+    def document_frequencies(self, hashes):
+        """
+        Return:
+        dict of hash -> number of tracks it is stored for, as last collected
+        """
+        with self.session() as session:
+            return session.document_frequencies(hashes)
+
+    def collect_document_frequencies(self):
+        """
+        Counts how many tracks each hash is stored for, for match_by_rarity. Run it after
+        loading tracks; the counts only decide the lookup order, so stale ones cost speed,
+        not correctness.
+        Return:
+        number of distinct hashes counted
+        """
+        with self.session() as session:
+            return session.collect_document_frequencies()
+
+    def match_by_rarity(self, hashes, offsets=None, top_k=None, stage_hook=None):
+        """
+        Looks up the query clip's hashes from the rarest up and stops as soon as the best
+        track can no longer be overtaken. All lookups run in one session.
+        Input:
+        hashes: list or array of hashes for the query clip
+        offsets: time offset of each hash to score by alignment, None to count shared hashes
+        top_k: how many tracks to return, None returns every track with a match
+        stage_hook: optional callable told how long the lookups took
+        Return:
+        list of ranking tuples with an upper bound on each score, see
+        rarity_matcher.match_by_rarity
+        """
+        with self.session() as session:
+            return session.match_by_rarity(hashes, offsets=offsets, top_k=top_k, stage_hook=stage_hook)
+
+    def list_tracks(self):
+        """
+        Return:
+        sorted list of every stored track name
+        """
+        with self.session() as session:
+            return session.list_tracks()
+
+    def track_table(self):
+        """
+        Return:
+        dict of every stored track id to its name, the ids iter_track_postings gives
+        """
+        with self.session() as session:
+            return session.track_table()
+
+    def fingerprint_settings(self):
+        """
+        Return:
+        dict of the peak picking settings the stored fingerprints were made with
+        """
+        with self.session() as session:
+            return dict(UNRECORDED_FINGERPRINT_SETTINGS, **session.get_metadata())
+
+    def check_fingerprint_settings(self, settings, record=False):
+        """
+        Raises IncompatibleFingerprintError if settings differ from the settings the
+        stored fingerprints were made with. Queries call this with their fingerprinter's
+        index_settings(); loaders pass record=True so a new storage remembers them.
+        """
+        with self.session() as session:
+            session.check_fingerprint_settings(settings, record=record)
+
+    def iter_postings(self, batch_size=100000):
+        """
+        Generator over every stored (track, hash, time_offset) row, in batches of lists.
+        """
+        return self._iter_query(EXPORT_QUERY, batch_size)
+
+    def iter_track_postings(self, batch_size=100000):
+        """
+        Generator over every stored (track_id, hash, time_offset) row, in batches of lists.
+        Cheaper than iter_postings for large exports as no row carries the track name, see
+        track_table for the names.
+        """
+        return self._iter_query(EXPORT_TRACK_ID_QUERY, batch_size)
+
+    def _iter_query(self, query, batch_size):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PostgresStorage(FingerprintStorage):
+
+    def __init__(self, dsn, min_connections=DB_POOL_MIN_CONNECTIONS, max_connections=DB_POOL_MAX_CONNECTIONS,
+                 pool_timeout=DB_POOL_TIMEOUT_SECONDS, connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                 statement_timeout=DB_STATEMENT_TIMEOUT_MS):
+        """
+        Postgres backed storage. Connections come out of a thread safe pool and are
+        handed back after every session, so they are reused instead of reopened and
+        concurrent threads never share one.
+
+        Input:
+        dsn: libpq connection string or postgresql:// URL
+        min_connections, max_connections: size limits of the connection pool
+        pool_timeout: seconds to wait for a free connection before raising
+        StorageBusyError, 0 fails immediately when the pool is exhausted
+        connect_timeout: seconds to wait when opening a new connection
+        statement_timeout: milliseconds a single query may run, 0 for no limit
+        """
+        super(PostgresStorage, self).__init__()
+        from psycopg2.pool import ThreadedConnectionPool
+        self.pool_timeout = pool_timeout
+        self.free_connections = threading.BoundedSemaphore(max_connections)
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, dsn,
+                                           connect_timeout=connect_timeout,
+                                           options="-c statement_timeout={}".format(int(statement_timeout)))
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the length of a with block. The work
+        done in the block is committed when it finishes and rolled back if it raises.
+        """
+        if not self.free_connections.acquire(timeout=self.pool_timeout):
+            raise StorageBusyError("No database connection free after {}s".format(self.pool_timeout))
+        try:
+            connection = self.pool.getconn()
+            try:
+                yield connection
+                connection.commit()
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                self.pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self.free_connections.release()
+
+    @contextmanager
+    def session(self):
+        with self.connection() as connection:
+            yield PostgresSession(connection)
+
+    @contextmanager
+    def bulk_writer(self, tracks_per_commit=TRACKS_PER_COMMIT):
+        with self.connection() as connection:
+            writer = BulkHashWriter(connection, tracks_per_commit=tracks_per_commit)
+            yield writer
+            writer.close()
+
+    def _iter_query(self, query, batch_size):
+        with self.connection() as connection:
+            cursor = connection.cursor(name='zwazam_export')
+            cursor.itersize = batch_size
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+
+    def close(self):
+        self.pool.closeall()
+
+
+class SQLiteStorage(FingerprintStorage):
+
+    def __init__(self, path, pool_timeout=DB_POOL_TIMEOUT_SECONDS):
+        """
+        SQLite backed storage for running the whole pipeline on a laptop without a
+        Postgres server. The tables are created from the SQLite version of the schema, and
+        databases still holding the old single zwazam table are migrated to tracks and
+        postings when opened. There is a single connection, shared between threads behind
+        a lock, so only one session runs at a time.
+
+        Input:
+        path: location of the database file, ':memory:' for a throwaway database
+        pool_timeout: seconds to wait for the connection before raising StorageBusyError
+        """
+        super(SQLiteStorage, self).__init__()
+        self.path = path
+        self.pool_timeout = pool_timeout
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        with open(SQLITE_SCHEMA_FILE) as schema_file:
+            self.connection.executescript(schema_file.read())
+        legacy_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(zwazam)")]
+        if legacy_columns:
+            if 'time_offset' not in legacy_columns:
+                self.connection.execute("ALTER TABLE zwazam ADD COLUMN time_offset integer")
+            with open(MIGRATION_FILE) as migration_file:
+                self.connection.executescript(migration_file.read())
+
+    @contextmanager
+    def _locked_connection(self):
+        if not self.lock.acquire(timeout=self.pool_timeout):
+            raise StorageBusyError("SQLite connection busy after {}s".format(self.pool_timeout))
+        try:
+            yield self.connection
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def session(self):
+        with self._locked_connection() as connection:
+            connection.execute("BEGIN")
+            try:
+                yield SQLiteSession(connection)
+            except Exception:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+            else:
+                if connection.in_transaction:
+                    connection.execute("COMMIT")
+
+    @contextmanager
+    def bulk_writer(self, tracks_per_commit=TRACKS_PER_COMMIT):
+        with self._locked_connection() as connection:
+            writer = SQLiteHashWriter(connection, tracks_per_commit=tracks_per_commit)
+            yield writer
+            writer.close()
+
+    def _iter_query(self, query, batch_size):
+        with self._locked_connection() as connection:
+            cursor = connection.execute(query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def close(self):
+        self.connection.close()
+
+
+class IndexStorage(FingerprintStorage):
+
+    def __init__(self, path):
+        """
+        Read-only storage answering lookups from a memory-mapped HashIndex file.
+        Lookups only read the mapped arrays, so any number of threads can share it.
+        Build the file with export_hash_index.py.
+
+        Input:
+        path: location of the index file
+        """
+        super(IndexStorage, self).__init__()
+        self.index = HashIndex.load(path)
+
+    @contextmanager
+    def session(self):
+        yield self
+
+    def insert_fingerprints(self, track_name, hashes, offsets=None, details=None):
+        raise TypeError("Hash index storage is read-only, rebuild it with export_hash_index.py")
+
+    def bulk_writer(self, tracks_per_commit=TRACKS_PER_COMMIT):
+        raise TypeError("Hash index storage is read-only, rebuild it with export_hash_index.py")
+
+    def lookup_hashes(self, hashes, top_k=None, stage_hook=None):
+        with timed_stage(stage_hook, 'lookup') as counts:
+            matches = self.index.match_hashes(hashes, top_k=top_k)
+            counts.update(hashes=len(hashes), rows=len(matches))
+        return matches
+
+    def lookup_postings(self, hashes):
+        postings = self.index.lookup_postings(hashes)
+        names = [self.index.track_names[track_id] for track_id in self.index.track_ids[postings]]
+        offsets = [None if offset == NO_OFFSET else offset for offset in self.index.offsets[postings].tolist()]
+        return list(zip(self.index.hashes[postings].tolist(), names, offsets))
+
+    def lookup_alignment(self, hashes, offsets, top_k=None, stage_hook=None):
+        return lookup_alignment(self, hashes, offsets, top_k=top_k, stage_hook=stage_hook)
+
+    def document_frequencies(self, hashes):
+        return self.index.document_frequencies(hashes)
+
+    def collect_document_frequencies(self):
+        # The index answers frequencies exactly from its sorted hashes
+        return len(np.unique(self.index.hashes))
+
+    def match_by_rarity(self, hashes, offsets=None, top_k=None, stage_hook=None):
+        return match_by_rarity(self.lookup_postings, self.document_frequencies, hashes, offsets=offsets,
+                               top_k=top_k, stage_hook=stage_hook)
+
+    def get_metadata(self):
+        return dict(self.index.metadata.get('fingerprint_settings', {}))
+
+    def check_fingerprint_settings(self, settings, record=False):
+        to_record = _settings_to_record(self.get_metadata(), settings, len(self.index) > 0)
+        if record and to_record:
+            raise TypeError("Hash index storage is read-only, rebuild it with export_hash_index.py")
+
+    def list_tracks(self):
+        return sorted(self.index.list_tracks())
+
+    def track_table(self):
+        return dict(enumerate(self.index.track_names))
+
+    def iter_postings(self, batch_size=100000):
+        for rows in self.iter_track_postings(batch_size):
+            yield [(self.index.track_names[track_id], hash, offset) for track_id, hash, offset in rows]
+
+    def iter_track_postings(self, batch_size=100000):
+        for start in range(0, len(self.index), batch_size):
+            stop = start + batch_size
+            offsets = [None if offset == NO_OFFSET else offset for offset in self.index.offsets[start:stop].tolist()]
+            yield list(zip(self.index.track_ids[start:stop].tolist(), self.index.hashes[start:stop].tolist(), offsets))
+
+
+def _path_from_url(url, scheme):
+    """
+    Strips the scheme off a file based storage URL. Three slashes give a relative path,
+    four an absolute one: sqlite:///zwazam.db, sqlite:////tmp/zwazam.db.
+    """
+    prefix = scheme + ":///"
+    return url[len(prefix):] if url.startswith(prefix) else ""
+
+
+def open_storage(url=STORAGE_URL):
+    """
+    Opens the storage described by a URL:
+    postgresql://user@host/dbname  Postgres with a connection pool
+    sqlite:///path/to/file.db      SQLite database file (sqlite:// alone is in memory)
+    index:///path/to/file.idx      read-only memory-mapped hash index
+    """
+    if url.startswith("postgres"):
+        return PostgresStorage(url)
+    if url.startswith("sqlite:"):
+        return SQLiteStorage(_path_from_url(url, "sqlite") or ":memory:")
+    if url.startswith("index:"):
+        return IndexStorage(_path_from_url(url, "index"))
+    raise ValueError("Unknown storage URL {}".format(url))
@@ -12,9 +12,10 @@ class StreamFingerprint(ProcessAudio):
         super class.
 
         Input:
-        read_data: array in binary format
+        read_data: 1D array (or list) of samples. Arrays are used as they are, without
+        a copy, so views straight onto a request body work.
         """
-        self.raw_data = np.array(read_data)
+        self.raw_data = np.asarray(read_data)
         self.final_sample = self.raw_data.shape[0]
         super(StreamFingerprint, self).__init__(**kwargs)
 
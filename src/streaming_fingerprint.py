@@ -0,0 +1,143 @@
+import numpy as np
+from array_utils import window_matches
+from process_audio import ProcessAudio
+
+
+class StreamingFingerprint(ProcessAudio):
+
+    def __init__(self, **kwargs):
+        """
+        Fingerprints audio that arrives a piece at a time. Call feed() with each new block
+        of samples and flush() once the input ends. Of the audio and its spectrogram, only
+        the samples of the spectrogram frame that is not complete yet and the columns still
+        needed by the peak neighbourhood search are kept between calls. The peaks found so
+        far are all kept, as a new peak pairs with earlier peaks of any age whose first
+        coordinate is within look_forward_time, and hashes and offsets collect every hash
+        returned, so memory still grows with the length of the input, by the peaks and
+        hashes rather than the samples. New hashes are returned as soon as both peaks of a
+        pair can no longer change. Taken together they are the same hashes as processing
+        the concatenated audio in one pass, only in a different order; offsets always ends
+        with the anchor time columns of the hashes the last call returned. All major
+        methodology inherited from ProcessAudio super class.
+
+        Input:
+        Same keyword arguments as ProcessAudio.
+        """
+        super(StreamingFingerprint, self).__init__(**kwargs)
+        # Samples from the start of the next spectrogram frame onwards
+        self.sample_tail = np.zeros(0)
+        self.samples_seen = 0
+        # Spectrogram columns [spectrogram_start, frames_computed) still needed for peaks
+        self.spectrogram_tail = None
+        self.spectrogram_start = 0
+        self.frames_computed = 0
+        # Columns before final_column have had their peaks found
+        self.final_column = 0
+        self.peak_locations = np.zeros((0, 2), dtype=np.int64)
+        self.hashes = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.final_sample = 0
+
+    def _neighborhood_radius(self):
+        """
+        How many spectrogram columns on either side of a column the peak strategy looks at.
+        """
+        return self.peak_picker.context_columns(self)
+
+    def feed(self, samples):
+        """
+        Adds a block of samples to the stream.
+        Input:
+        samples: 1D array of the next samples, any length
+        Return:
+        int64 array of the hashes that became final with this block
+        """
+        samples = np.asarray(samples)
+        self.samples_seen += len(samples)
+        self.final_sample = self.samples_seen
+        if not len(self.sample_tail):
+            self.sample_tail = samples
+        elif len(samples):
+            self.sample_tail = np.concatenate([self.sample_tail, samples])
+
+        fft_size, fft_hop = self.stft.fft_size, self.stft.fft_hop
+        new_frames = 0
+        if len(self.sample_tail) >= fft_size:
+            new_frames = (len(self.sample_tail) - fft_size) // fft_hop + 1
+        if new_frames:
+            frame_samples = self.sample_tail[:(new_frames - 1) * fft_hop + fft_size]
+            self._add_spectrogram_columns(self.make_spectrogram(frame_samples))
+            self.sample_tail = self.sample_tail[new_frames * fft_hop:]
+        return self._emit_final_peaks(self.frames_computed - self._neighborhood_radius())
+
+    def flush(self):
+        """
+        Ends the stream and finalises the peaks near its end.
+        Return:
+        int64 array of the remaining hashes
+        """
+        if not self.frames_computed and len(self.sample_tail):
+            # Shorter than one frame: make_spectrogram pads it to a single frame, as a
+            # one pass run over the same audio would
+            self._add_spectrogram_columns(self.make_spectrogram(self.sample_tail))
+        self.sample_tail = np.zeros(0)
+        return self._emit_final_peaks(self.frames_computed)
+
+    def _add_spectrogram_columns(self, columns):
+        if self.spectrogram_tail is None:
+            self.spectrogram_tail = columns
+        else:
+            self.spectrogram_tail = np.concatenate([self.spectrogram_tail, columns], axis=1)
+        self.frames_computed += columns.shape[1]
+
+    def _emit_final_peaks(self, final_column):
+        """
+        Finds the peaks of every column before final_column that has not been searched yet
+        and pairs them with each other and with all earlier peaks.
+        """
+        if final_column <= self.final_column or self.spectrogram_tail is None:
+            return np.zeros(0, dtype=np.int64)
+
+        # The window starts radius columns before the first new column, so every new
+        # column sees the same neighbourhood it would in a one pass run
+        window_peaks, _ = self.find_peaks(self.spectrogram_tail)
+        window_peaks[:, 1] += self.spectrogram_start
+        is_new = (window_peaks[:, 1] >= self.final_column) & (window_peaks[:, 1] < final_column)
+        new_hashes, new_offsets = self._pair_new_peaks(window_peaks[is_new].astype(np.int64))
+
+        self.final_column = final_column
+        keep_from = max(final_column - self._neighborhood_radius(), 0)
+        self.spectrogram_tail = self.spectrogram_tail[:, keep_from - self.spectrogram_start:]
+        self.spectrogram_start = keep_from
+        self.hashes = np.concatenate([self.hashes, new_hashes])
+        self.offsets = np.concatenate([self.offsets, new_offsets])
+        return new_hashes
+
+    def _pair_new_peaks(self, new_peaks):
+        """
+        Hashes every pair that has at least one peak in new_peaks: new anchors with old
+        or new partners, and old anchors with new partners. Uses the same pairing rule
+        as find_partner_indices.
+        Return:
+        (hashes, anchor time columns) int64 arrays
+        """
+        old_peaks = self.peak_locations
+        all_peaks = np.concatenate([old_peaks, new_peaks])
+        self.peak_locations = all_peaks
+        if not len(new_peaks):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        order = np.argsort(all_peaks[:, 0], kind='stable')
+        new_anchors, partner_positions = window_matches(all_peaks[order, 0], new_peaks[:, 0],
+                                                        0, self.look_forward_time)
+        anchor_peaks = [new_peaks[new_anchors]]
+        partner_peaks = [all_peaks[order[partner_positions]]]
+
+        old_order = np.argsort(old_peaks[:, 0], kind='stable')
+        new_partners, anchor_positions = window_matches(old_peaks[old_order, 0], new_peaks[:, 0],
+                                                        -self.look_forward_time, 0)
+        anchor_peaks.append(old_peaks[old_order[anchor_positions]])
+        partner_peaks.append(new_peaks[new_partners])
+
+        anchor_peaks = np.concatenate(anchor_peaks)
+        return self.hash_peak_pairs(anchor_peaks, np.concatenate(partner_peaks)), anchor_peaks[:, 1]
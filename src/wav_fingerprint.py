@@ -1,11 +1,11 @@
-from scipy.io import wavfile
 import numpy as np
 from process_audio import ProcessAudio
+from streaming_fingerprint import StreamingFingerprint
 
 
 class WavFingerprint(ProcessAudio):
 
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, chunked=False, cache=None, **kwargs):
         """
         Class that reads in a wav file and uses the ProcessAudio methods
         to clean and fingerprint a given WAV. Loads the file, extracts left
@@ -15,11 +15,22 @@ class WavFingerprint(ProcessAudio):
 
         Input:
         filename: location on disk of the file to be processed
+        chunked: memory-map the file and fingerprint it chunk_seconds at a time instead
+        of loading it whole, so neither the samples nor the spectrogram of the whole file
+        are ever in memory; the peaks and hashes, which are much smaller, still grow with
+        the length of the file. Gives the same hashes.
+        cache: optional FingerprintCache. The hashes and offsets are taken from it when this
+        audio was already fingerprinted with the same parameters, and stored in it otherwise.
         """
-        self.sample_rate, read_data = wavfile.read(filename)
-        self.raw_data = np.array(read_data)
+        # scipy.io drags in scipy.sparse and the matlab readers, so only importers
+        # that actually read a wav pay for it
+        from scipy.io import wavfile
+        self.sample_rate, read_data = wavfile.read(filename, mmap=chunked or cache is not None)
+        self.raw_data = np.asarray(read_data)
+        self.chunked = chunked
+        self.cache_hit = False
         self.final_sample = self.raw_data.shape[0]
-        super(WavFingerprint, self).__init__(**kwargs)
+        super(WavFingerprint, self).__init__(sample_rate=self.sample_rate, **kwargs)
 
         try:
             self.raw_data_left = self.raw_data[:, 0]
@@ -28,8 +39,37 @@ class WavFingerprint(ProcessAudio):
             self.raw_data_left = self.raw_data
             self.raw_data_right = None
 
+        if cache is not None:
+            cache_key = cache.key(self.raw_data, self.sample_rate, self.fingerprint_parameters())
+            cached = cache.get(cache_key)
+            self.cache_hit = cached is not None
+            if self.cache_hit:
+                self.hashes, self.offsets = cached
+                return
+
         if self.raw_data_left.any():
-            self.process_track(self.raw_data_left)
+            if chunked:
+                self.process_track_in_chunks(self.raw_data_left)
+            else:
+                self.process_track(self.raw_data_left)
+            if cache is not None:
+                cache.put(cache_key, self.hashes, self.offsets)
+
+    def process_track_in_chunks(self, track_data):
+        """
+        Feeds the track through a StreamingFingerprint one chunk at a time. The streaming
+        fingerprinter carries the overlapping spectrogram frame and the peak neighbourhood
+        between chunks, so peaks and time offsets are the same as for the whole file.
+        Input:
+        track_data: Array (or memory map) of the amplitude at a given time.
+        """
+        stream = StreamingFingerprint(**self.fingerprint_parameters())
+        for chunk in self._generate_chunks_of_wav(track_data):
+            stream.feed(chunk)
+        stream.flush()
+        self.hashes = stream.hashes
+        self.offsets = stream.offsets
+
 
 if __name__ == "__main__":
     track = WavFingerprint("../test_wav/samples_for_test/Bust_This_subsection.wav", peak_sensitivity=20, min_peak_amplitude=40)
@@ -1,35 +1,19 @@
-from scipy.io import wavfile
-import numpy as np
-from process_audio_test_method import ProcessAudioTest
+from wav_fingerprint import WavFingerprint as BaseWavFingerprint
 
 
-class WavFingerprint(ProcessAudioTest):
+class WavFingerprint(BaseWavFingerprint):
 
     def __init__(self, filename, **kwargs):
         """
-        Class that reads in a wav file and uses the ProcessAudio methods
-        to clean and fingerprint a given WAV. Loads the file, extracts left
-        and right channels if available, then computes hashes from those
-        channels individually. All major methodology inherited from ProcessAudioTest
-        super class.
+        Fingerprints a WAV with the spectral centroid experiment, which is now the
+        'weighted_centroid' peak strategy of the regular WavFingerprint.
 
         Input:
         filename: location on disk of the file to be processed
         """
-        self.sample_rate, read_data = wavfile.read(filename)
-        self.raw_data = np.array(read_data)
-        self.final_sample = self.raw_data.shape[0]
-        super(WavFingerprint, self).__init__(**kwargs)
+        kwargs.setdefault('peak_strategy', 'weighted_centroid')
+        super(WavFingerprint, self).__init__(filename, **kwargs)
 
-        try:
-            self.raw_data_left = self.raw_data[:, 0]
-            self.raw_data_right = self.raw_data[:, 1]
-        except IndexError:
-            self.raw_data_left = self.raw_data
-            self.raw_data_right = None
-
-        if self.raw_data_left.any():
-            self.process_track(self.raw_data_left)
 
 if __name__ == "__main__":
     track = WavFingerprint("../test_wav/samples_for_test/Bust_This_subsection.wav", peak_sensitivity=20,
@@ -41,4 +25,4 @@ if __name__ == "__main__":
 
     spectrogram = track.make_spectrogram(track.raw_data_left)
     track._plot_spectrograms(spectrogram)
-    print(track.hashes)
\ No newline at end of file
+    print(track.hashes)
@@ -1,2 +1,53 @@
+import os
+
 MIN_FINGER_PRINT_WAV=60
 MIN_FINGER_PRINT_MIC=12
+TOP_K_MATCHES=5
+TRACKS_PER_COMMIT=1
+INGEST_WORKERS=None
+
+# Where fingerprints are stored, see storage.open_storage for the URL formats.
+# You'll have to update the Postgres URL to your host, user and database.
+STORAGE_URL=os.environ.get('ZWAZAM_STORAGE', 'postgresql://zachariahmiller@/zachariahmiller')
+DB_POOL_MIN_CONNECTIONS=1
+DB_POOL_MAX_CONNECTIONS=10
+DB_POOL_TIMEOUT_SECONDS=0.5
+DB_CONNECT_TIMEOUT_SECONDS=5
+DB_STATEMENT_TIMEOUT_MS=10000
+LISTEN_WINDOW_SECONDS=10.
+LISTEN_HOP_SECONDS=2.5
+LISTEN_MIN_MATCHES=8
+LISTEN_MIN_MARGIN=2.
+CHUNKED_WAV_INGEST=True
+# Columns either side of the best offset difference that still count as aligned
+ALIGNMENT_TOLERANCE_COLUMNS=1
+# Look query hashes up from the rarest and stop once the best track is certain, see
+# rarity_matcher.py; collect_hash_frequencies.py counts the hashes it orders by. Off by
+# default: on real catalogues the bound rarely stops the lookup before most hashes are
+# fetched, so the extra batches cost more than they save
+RARITY_ORDERED_MATCHING=False
+RARITY_BATCH_SIZE=128
+# Peak picking method used to store and to match tracks, see peak_strategies.py
+PEAK_STRATEGY='local_maximum'
+# Hash format, see process_audio.HASH_VERSIONS. Existing storage keeps its format until it
+# is rebuilt with reindex_storage.py
+HASH_VERSION=1
+# On-disk fingerprint cache shared by ingest, match_wav and the API, empty string turns it off
+FINGERPRINT_CACHE_DIR=os.environ.get('ZWAZAM_CACHE', os.path.join(os.path.expanduser('~'), '.zwazam_cache'))
+FINGERPRINT_CACHE_MAX_BYTES=512 * 1024 ** 2
+# A full fingerprint cache drops its least recently used entries until it is this share of the cap
+FINGERPRINT_CACHE_EVICT_FRACTION=0.9
+# In-process cache of the tracks stored for each hash, used by the API and the listener
+POSTING_CACHE_MAX_BYTES=64 * 1024 ** 2
+POSTING_CACHE_TTL_SECONDS=300
+# Merge the storage lookups of /match requests arriving within this many ms of each other
+# into one query, which adds up to that much latency; 0 turns it off. A batch closes early
+# once MATCH_COALESCE_MAX_REQUESTS lookups have joined it
+MATCH_COALESCE_WINDOW_MS=0
+MATCH_COALESCE_MAX_REQUESTS=32
+# Background jobs for /add_track_to_database and /wav_upload, see flask_api/README.md.
+# ASYNC_JOBS makes queuing the default, ?async=1 or ?async=0 picks per request
+ASYNC_JOBS=False
+JOB_WORKERS=None
+JOB_QUEUE_MAX_PENDING=64
+JOB_KEEP_SECONDS=3600